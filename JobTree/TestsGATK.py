@@ -5,8 +5,32 @@
 Unit tests for functions within the SupportGATK class within jobtree_gatk_pipeline.py
 """
 
+import hashlib
+import json
+import random
+import shutil
+import struct
+import threading
 import unittest
 from jobtree_gatk_pipeline import *
+import jobtree_gatk_pipeline
+import autotune
+import bam_slice
+import bgzf
+import cram
+import metrics
+import preflight
+import provision
+import reference_bundle
+import scratch
+import simulate
+import speculation
+import transfer_scheduler
+import transfers
+import upload_queue
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Pipeline_Complete'))
+import GATK_pipelined_all_test_pairs as pipelined
 
 
 class TestSupportGATK(unittest.TestCase):
@@ -84,6 +108,1255 @@ class TestSupportGATK(unittest.TestCase):
         bucket.delete_keys(keys)
 
 
+class RecordingTarget(object):
+    """ Stands in for a jobTree Target: records the targets it is asked to spawn """
+
+    def __init__(self):
+        self.children = []
+        self.follow_on = None
+
+    def addChildTargetFn(self, fn, args=(), memory=None):
+        self.children.append((fn, args, memory))
+
+    def setFollowOnTargetFn(self, fn, args=()):
+        self.follow_on = (fn, args)
+
+
+class TestSampleReuse(unittest.TestCase):
+    def test_SampleIdAndKeys(self):
+        entry = {'etag': '"0123456789abcdef0123456789abcdef"', 'size': 1000}
+        sid = sample_id(entry, 'refv1')
+        self.assertEqual(sid, sample_id(dict(entry), 'refv1'))
+        self.assertNotEqual(sid, sample_id(entry, 'refv2'))
+        self.assertNotEqual(sid, sample_id(dict(entry, size=1001), 'refv1'))
+        self.assertIsNone(sample_id({'etag': None, 'size': 1000}, 'refv1'))
+        self.assertNotEqual(sid, sample_id(entry, 'refv1', targets='kit1'))
+
+        gatk = SupportGATK({}, '/mnt/', '/mnt/script/run1', '/mnt/script/run1/pair', sample_ids={'normal': sid})
+        self.assertEqual(gatk.s3_key('/mnt/script/run1/pair/normal.bqsr.bam'),
+                         '{}/samples/{}/bqsr.bam'.format(gatk.script_name, sid))
+        self.assertEqual(gatk.s3_key('/mnt/script/run1/pair/normal.indel.bam'), 'script/run1/pair/normal.indel.bam')
+        self.assertEqual(gatk.s3_key('/mnt/script/run1/pair/tumor.bqsr.bam'), 'script/run1/pair/tumor.bqsr.bam')
+
+    def test_ClaimRenewedWhileStepRuns(self):
+        renewed = []
+
+        class Claiming(SupportGATK):
+            def renew_claim(self, sample):
+                renewed.append(sample)
+        gatk = Claiming({}, '/mnt/', '/mnt/script/run1', '/mnt/script/run1/pair')
+        jobtree_gatk_pipeline.CLAIM_RENEW_SECONDS, renew_seconds = 0.05, CLAIM_RENEW_SECONDS
+        try:
+            with gatk.keep_claim('normal'):
+                time.sleep(0.5)
+        finally:
+            jobtree_gatk_pipeline.CLAIM_RENEW_SECONDS = renew_seconds
+        count = len(renewed)
+        self.assertGreater(count, 3)
+        self.assertEqual(set(renewed), {'normal'})
+        # Nothing is renewed once the step is over
+        time.sleep(0.2)
+        self.assertEqual(len(renewed), count)
+
+    def test_LostClaimStopsTheChain(self):
+        class Losing(SupportGATK):
+            def renew_claim(self, sample):
+                raise ClaimLost('Run other has taken over {} sample'.format(sample))
+        gatk = Losing({}, '/mnt/', '/mnt/script/run1', '/mnt/script/run1/pair')
+        jobtree_gatk_pipeline.CLAIM_RENEW_SECONDS, renew_seconds = 0.05, CLAIM_RENEW_SECONDS
+        try:
+            with self.assertRaises(ClaimLost):
+                with gatk.keep_claim('normal') as lost:
+                    # The running tool is told to stop
+                    self.assertTrue(lost.wait(5))
+        finally:
+            jobtree_gatk_pipeline.CLAIM_RENEW_SECONDS = renew_seconds
+
+        # The step's target drops the rest of the chain and waits for the other run's outputs
+        target = RecordingTarget()
+        with wait_if_claim_lost(target, gatk, 'normal'):
+            gatk.renew_claim('normal')
+            target.addChildTargetFn(normal_rtc, (gatk,))
+        self.assertEqual(target.children, [(wait_for_sample, (gatk, 'normal'), None)])
+
+    def test_WaitReissuesItself(self):
+        processed, claimable = [False], [False]
+
+        class Waiting(SupportGATK):
+            def sample_is_processed(self, sample):
+                return processed[0]
+
+            def claim_sample(self, sample):
+                return claimable[0]
+        gatk = Waiting({}, '/mnt/', '/mnt/script/run1', '/mnt/script/run1/pair')
+        jobtree_gatk_pipeline.CLAIM_POLL_SECONDS, poll_seconds = 0, CLAIM_POLL_SECONDS
+        try:
+            # Still being processed elsewhere: checks again later as a fresh target
+            target = RecordingTarget()
+            wait_for_sample(target, gatk, 'tumor')
+            self.assertEqual((target.follow_on, target.children), ((wait_for_sample, (gatk, 'tumor')), []))
+            # The other run stopped renewing its claim: the chain is taken over
+            claimable[0] = True
+            target = RecordingTarget()
+            wait_for_sample(target, gatk, 'tumor')
+            self.assertEqual((target.follow_on, target.children), (None, [(tumor_index, (gatk,), None)]))
+            # Done
+            processed[0] = True
+            target = RecordingTarget()
+            wait_for_sample(target, gatk, 'tumor')
+            self.assertEqual((target.follow_on, target.children), (None, []))
+        finally:
+            jobtree_gatk_pipeline.CLAIM_POLL_SECONDS = poll_seconds
+
+
+class TestTargetIntervals(unittest.TestCase):
+    def test_PadClipAndMerge(self):
+        contigs = [('chr1', 1000), ('chr2', 500)]
+        bed = ['track name=targets\n',
+               'chr2\t100\t200\n',
+               'chr1\t950\t990\n',
+               'chr1\t10\t20\tNM_1\n',
+               'chr1\t40\t60\n',
+               'chrUn_gl000220\t0\t10\n']
+        self.assertEqual(pad_and_merge(bed, 20, contigs),
+                         [('chr1', 1, 80), ('chr1', 931, 1000), ('chr2', 81, 220)])
+        self.assertRaises(RuntimeError, pad_and_merge, ['1\t10\t20\n'], 20, contigs)
+
+        gatk = SupportGATK({'targets.bed': 'http://x/kit.bed'}, '/mnt/', '/mnt/script/run1',
+                           '/mnt/script/run1/pair', targets_version='abc')
+        self.assertEqual(gatk.s3_key('/mnt/script/run1/' + TARGET_INTERVALS),
+                         '{}/targets/abc/{}'.format(gatk.script_name, TARGET_INTERVALS))
+        self.assertNotEqual(targets_version(gatk.input_URLs, padding=20), targets_version(gatk.input_URLs))
+        self.assertIsNone(targets_version({}))
+
+
+class TestKnownSites(unittest.TestCase):
+    def test_IndexedOnceAndFetchedFromBucket(self):
+        SupportGATK.mkdir_p('test_out/run1/pair')
+        self.addCleanup(shutil.rmtree, 'test_out', True)
+        local_dir = os.path.join(os.getcwd(), 'test_out')
+        in_s3, published, fetched, commands = set(), [], [], []
+
+        class Indexing(SupportGATK):
+            def exists_in_s3(self, file_path):
+                return self.s3_key(file_path) in in_s3
+
+            def publish(self, file_path, consumed_elsewhere=True):
+                published.append(os.path.basename(file_path))
+                in_s3.add(self.s3_key(file_path))
+
+            def get_input_path(self, name):
+                fetched.append(('input', name))
+                path = os.path.join(self.shared_dir, name)
+                if not os.path.exists(path):
+                    open(path, 'w').close()
+                return path
+
+            def get_intermediate_path(self, name, return_path=True):
+                fetched.append(('intermediate', name))
+                path = os.path.join(self.shared_dir, name)
+                open(path, 'a').close()
+                return path
+
+        def check_call(cmd, stdout=None):
+            # bgzip writes to stdout, tabix and GATK write their index beside the file they read
+            commands.append(cmd[0])
+            if cmd[0] == 'tabix':
+                open(cmd[-1] + '.tbi', 'w').close()
+            elif cmd[0] == 'java':
+                open(cmd[-1] + '.idx', 'w').close()
+        self.addCleanup(setattr, subprocess, 'check_call', subprocess.check_call)
+        subprocess.check_call = check_call
+
+        gatk = Indexing({}, local_dir, os.path.join(local_dir, 'run1'), os.path.join(local_dir, 'run1', 'pair'),
+                        reference_version='refv1')
+        self.assertEqual(gatk.s3_key(os.path.join(gatk.shared_dir, 'dbsnp.vcf')),
+                         '{}/references/refv1/dbsnp.vcf'.format(gatk.script_name))
+
+        # Built and published once; MuTect's plain VCFs are published along with the indexes
+        index_known_sites(gatk, 'dbsnp')
+        index_known_sites(gatk, 'phase')
+        self.assertEqual(commands, ['bgzip', 'tabix', 'java'] * 2)
+        self.assertEqual(published, ['dbsnp.vcf.gz', 'dbsnp.vcf.gz.tbi', 'dbsnp.vcf.idx', 'dbsnp.vcf',
+                                     'phase.vcf.gz', 'phase.vcf.gz.tbi', 'phase.vcf.idx'])
+        index_known_sites(gatk, 'mills')
+        index_known_sites(gatk, 'cosmic')
+
+        # Later runs find everything in S3 and skip the whole step
+        del commands[:], published[:], fetched[:]
+        for name in KNOWN_SITES:
+            index_known_sites(gatk, name)
+        self.assertEqual((commands, published, fetched), ([], [], []))
+
+        # A bucket indexed before the plain VCF was published gets it on the next run
+        in_s3.remove(gatk.s3_key(os.path.join(gatk.shared_dir, 'cosmic.vcf')))
+        index_known_sites(gatk, 'cosmic')
+        self.assertEqual(published[-1], 'cosmic.vcf')
+
+        # MuTect's VCFs come from the bucket, never from their URL
+        del fetched[:]
+        self.assertEqual(gatk.get_known_sites('dbsnp', compressed=False), os.path.join(gatk.shared_dir, 'dbsnp.vcf'))
+        self.assertEqual(fetched, [('intermediate', 'dbsnp.vcf'), ('intermediate', 'dbsnp.vcf.idx')])
+        del fetched[:]
+        gatk.get_known_sites('mills')
+        self.assertEqual(fetched, [('intermediate', 'mills.vcf.gz'), ('intermediate', 'mills.vcf.gz.tbi')])
+
+
+class TestArtifactPolicy(unittest.TestCase):
+    # File name -> policy, one for every suffix in ARTIFACT_POLICIES plus one that is not listed
+    POLICIES = [('tumor.vcf.gz.summary.json', DELIVERABLE),
+                ('tumor.indel.bam', EPHEMERAL),
+                ('tumor.indel.bai', EPHEMERAL),
+                ('tumor.indel.cram', EPHEMERAL),
+                ('tumor.bam.bai', EPHEMERAL),
+                (TARGET_INTERVALS, CHECKPOINT),
+                ('tumor.intervals', EPHEMERAL),
+                ('tumor.bqsr.bam', CHECKPOINT),
+                ('tumor.bqsr.bai', CHECKPOINT),
+                ('tumor.bqsr.cram', CHECKPOINT),
+                ('tumor.recal.table', CHECKPOINT),
+                ('tumor.contamination.txt', CHECKPOINT),
+                ('reference.fasta.fai', CHECKPOINT),
+                ('reference.dict', CHECKPOINT),
+                ('mutect.vcf', DELIVERABLE),
+                ('dbsnp.vcf.gz', DELIVERABLE),
+                ('dbsnp.vcf.gz.tbi', DELIVERABLE),
+                ('popfile.vcf.tbi', CHECKPOINT),
+                ('dbsnp.vcf.idx', CHECKPOINT),
+                ('mutect.out', CHECKPOINT)]
+
+    def test_SuffixOrder(self):
+        suffixes = [suffix for suffix, policy in ARTIFACT_POLICIES]
+        self.assertEqual(len(set(suffixes)), len(suffixes))
+        # No suffix is shadowed by a more general one listed before it
+        for i, general in enumerate(suffixes):
+            for specific in suffixes[i + 1:]:
+                self.assertFalse(specific.endswith(general), '{} is listed before {}'.format(general, specific))
+        # The table below covers every suffix
+        self.assertEqual(set(suffixes), set(next(s for s in suffixes if name.endswith(s))
+                                            for name, policy in self.POLICIES[:-1]))
+
+    def test_PolicyAndUpload(self):
+        multi = SupportGATK({}, '/mnt/', '/mnt/script/run1', '/mnt/script/run1/pair')
+        single = SupportGATK({}, '/mnt/', '/mnt/script/run1', '/mnt/script/run1/pair', single_node=True)
+        upload_all = SupportGATK({}, '/mnt/', '/mnt/script/run1', '/mnt/script/run1/pair', single_node=True,
+                                 upload_all=True)
+        for name, policy in self.POLICIES:
+            path = '/mnt/script/run1/pair/' + name
+            self.assertEqual(artifact_policy(path), policy, name)
+            kept = policy != EPHEMERAL
+            # (needs_upload, needs_upload with every consumer in the producing target)
+            self.assertEqual((multi.needs_upload(path), multi.needs_upload(path, consumed_elsewhere=False)),
+                             (True, kept), name)
+            self.assertEqual((single.needs_upload(path), single.needs_upload(path, consumed_elsewhere=False)),
+                             (kept, kept), name)
+            self.assertEqual((upload_all.needs_upload(path), upload_all.needs_upload(path, consumed_elsewhere=False)),
+                             (True, True), name)
+
+
+class TestContEst(unittest.TestCase):
+    def test_ParseReport(self):
+        report = os.path.join(os.getcwd(), 'test_contest.txt')
+        self.addCleanup(os.remove, report)
+        with open(report, 'w') as f:
+            f.write('name\tpopulation\tpopulation_fit\tcontamination\tconfidence_interval_95_width\t'
+                    'confidence_interval_95_low\tconfidence_interval_95_high\tsites\n')
+            f.write('META\tCEU\t-310.2\t2.1\t0.6\t1.8\t2.4\t4120\n')
+            f.write('META\tALL\t-305.9\t1.5\t0.4\t1.3\t1.7\t4120\n')
+            f.write('SM-1234\tALL\t-300.0\t9.9\t0.4\t9.7\t10.1\t4120\n')
+        self.assertAlmostEqual(parse_contest(report), 0.015)
+
+        with open(report, 'w') as f:
+            f.write('name\tpopulation\tpopulation_fit\tcontamination\n')
+        self.assertIsNone(parse_contest(report))
+
+
+    def test_SpawnedBesideEveryTumorChain(self):
+        state = {'processed': False, 'claimable': True}
+
+        class Spawning(SupportGATK):
+            def sample_is_processed(self, sample):
+                return state['processed']
+
+            def claim_sample(self, sample):
+                return state['claimable']
+
+        def spawned(fuse_chains=False, tumor_id=None, urls=None):
+            gatk = Spawning(urls or {'popfile.vcf': 'http://x/pop.vcf'}, '/mnt/', '/mnt/script/run1',
+                            '/mnt/script/run1/pair', fuse_chains=fuse_chains, sample_ids={'tumor': tumor_id})
+            target = RecordingTarget()
+            spawn_samples(target, gatk)
+            return [(fn.__name__,) + tuple(a for a in args if a is not gatk) for fn, args, memory in target.children]
+
+        # A split tumor chain spawns ContEst itself, from tumor_ir
+        self.assertEqual(spawned(), [('normal_index',), ('tumor_index',)])
+        self.assertEqual(spawned(fuse_chains=True), [('process_sample', 'normal'), ('process_sample', 'tumor'),
+                                                     ('contamination',)])
+        self.assertEqual(spawned(fuse_chains=True, urls={'x': 'y'}),
+                         [('process_sample', 'normal'), ('process_sample', 'tumor')])
+        # Tumor processed elsewhere: reused, or waited for
+        state['processed'] = True
+        self.assertEqual(spawned(tumor_id='abc'), [('normal_index',), ('contamination',)])
+        state['processed'], state['claimable'] = False, False
+        self.assertEqual(spawned(tumor_id='abc'), [('normal_index',), ('wait_for_sample', 'tumor'),
+                                                   ('contamination',)])
+
+
+class TestTransfers(unittest.TestCase):
+    def test_MultipartETag(self):
+        data = b'0123456789' * 25
+        digest = transfers.StreamingDigest(part_size=100)
+        # Feed in pieces that do not line up with part boundaries
+        for i in range(0, len(data), 7):
+            digest.update(data[i:i + 7])
+
+        parts = [data[i:i + 100] for i in range(0, len(data), 100)]
+        expected = hashlib.md5(b''.join(hashlib.md5(p).digest() for p in parts)).hexdigest() + '-3'
+
+        self.assertEqual(digest.md5(), hashlib.md5(data).hexdigest())
+        self.assertEqual(digest.etag(multipart=True), expected)
+        self.assertTrue(transfers.verify(digest, len(data), '"{}"'.format(expected)))
+        self.assertFalse(transfers.verify(digest, len(data) - 1, expected))
+
+    def test_SidecarInvalidatedByTruncation(self):
+        path = os.path.join('test_out', 'sidecar_test.bin')
+        SupportGATK.mkdir_p('test_out')
+        with open(path, 'wb') as f:
+            f.write(b'x' * 1000)
+        md5 = hashlib.md5(b'x' * 1000).hexdigest()
+
+        self.assertTrue(transfers.local_matches_remote(path, 1000, md5))
+        self.assertIsNotNone(transfers.read_sidecar(path))
+
+        with open(path, 'wb') as f:
+            f.write(b'x' * 10)
+        self.assertIsNone(transfers.read_sidecar(path))
+        self.assertFalse(transfers.local_matches_remote(path, 1000, md5))
+
+        os.remove(path)
+        transfers.remove_sidecar(path)
+
+    def test_UploadCheckNeedsAChecksum(self):
+        path = os.path.join('test_out', 'upload_check.bin')
+        SupportGATK.mkdir_p('test_out')
+        self.addCleanup(shutil.rmtree, 'test_out', True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 1000)
+        md5 = hashlib.md5(b'x' * 1000).hexdigest()
+        kms_etag = '"not-an-md5"'
+
+        # Downloads may trust a size match when the ETag is not an MD5; uploads may not
+        self.assertTrue(transfers.local_matches_remote(path, 1000, kms_etag))
+        self.assertFalse(transfers.local_matches_remote(path, 1000, kms_etag, trust_size=False))
+        # The MD5 stored in the object's metadata stands in for the ETag
+        self.assertTrue(transfers.local_matches_remote(path, 1000, kms_etag, trust_size=False, remote_md5=md5))
+        self.assertFalse(transfers.local_matches_remote(path, 1000, kms_etag, trust_size=False, remote_md5='0' * 32))
+        # Without a sidecar and without hashing there is nothing to compare
+        transfers.remove_sidecar(path)
+        self.assertFalse(transfers.local_matches_remote(path, 1000, md5, allow_hash=False))
+        self.assertIsNone(transfers.read_sidecar(path))
+
+    def test_ResumesAfterInterruption(self):
+        data = os.urandom(3 * 1024 * 1024 + 17)
+        path = os.path.join('test_out', 'resume_test.bin')
+        SupportGATK.mkdir_p('test_out')
+        starts = []
+
+        def flaky_fetch(start, fp):
+            starts.append(start)
+            if len(starts) == 1:
+                fp.write(data[:1000000])
+                raise transfers.TransferError('connection reset')
+            fp.write(data[start:])
+
+        transfers.BACKOFF_BASE, base = 0, transfers.BACKOFF_BASE
+        try:
+            transfers.resumable_download(flaky_fetch, path, len(data), hashlib.md5(data).hexdigest(),
+                                         attempts=2)
+        finally:
+            transfers.BACKOFF_BASE = base
+        self.assertEqual(starts, [0, 1000000])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertFalse(os.path.exists(transfers.partial_path(path)))
+        self.assertEqual(transfers.read_sidecar(path)['md5'], hashlib.md5(data).hexdigest())
+        transfers.remove_sidecar(path)
+        os.remove(path)
+
+    def test_ConcurrentRequestsShareOneDownload(self):
+        data = os.urandom(200000)
+        path = os.path.join('test_out', 'single_flight.bin')
+        SupportGATK.mkdir_p('test_out')
+        self.addCleanup(shutil.rmtree, 'test_out', True)
+        fetches = []
+
+        def slow_fetch(start, fp):
+            fetches.append(start)
+            time.sleep(0.5)
+            fp.write(data[start:])
+
+        def get():
+            if transfers.read_sidecar(path) is None:
+                with transfers.download_lock(path):
+                    if transfers.read_sidecar(path) is None:
+                        transfers.resumable_download(slow_fetch, path, len(data), hashlib.md5(data).hexdigest())
+
+        threads = [threading.Thread(target=get) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(fetches, [0])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_UploadStateInvalidatedByChange(self):
+        path = os.path.join('test_out', 'upload_state_test.bin')
+        SupportGATK.mkdir_p('test_out')
+        with open(path, 'wb') as f:
+            f.write(b'x' * 1000)
+        st = os.stat(path)
+        transfers.save_upload_state(path, {'key': 'run/pair/x.bin', 'upload_id': 'abc', 'size': st.st_size,
+                                           'mtime': st.st_mtime, 'part_size': transfers.PART_SIZE,
+                                           'parts': {'1': 'd41d8cd98f00b204e9800998ecf8427e'}})
+        state = transfers.load_upload_state(path)
+        self.assertEqual(state['parts']['1'], 'd41d8cd98f00b204e9800998ecf8427e')
+        self.assertTrue(transfers.upload_state_is_current(state, path, 'run/pair/x.bin'))
+        self.assertFalse(transfers.upload_state_is_current(state, path, 'run/pair/y.bin'))
+
+        with open(path, 'ab') as f:
+            f.write(b'y')
+        self.assertFalse(transfers.upload_state_is_current(state, path, 'run/pair/x.bin'))
+
+        transfers.remove_upload_state(path)
+        self.assertIsNone(transfers.load_upload_state(path))
+        os.remove(path)
+
+
+class TestReferenceBundle(unittest.TestCase):
+    def setUp(self):
+        SupportGATK.mkdir_p('test_out')
+        self.addCleanup(shutil.rmtree, 'test_out', True)
+        self.root = os.path.abspath('test_out')
+        sources = {}
+        for name, dest in reference_bundle.INPUTS:
+            sources[dest] = os.path.join(self.root, 'src_' + name)
+            with open(sources[dest], 'wb') as f:
+                f.write(os.urandom(2500))
+        args = argparse.Namespace(out_dir=os.path.join(self.root, 'bundle'), chunk_size=1000, bucket=None, **sources)
+        # Indexing needs samtools/picard/GATK; the members stand in for what it would have produced
+        build_indexes, reference_bundle.build_indexes = reference_bundle.build_indexes, lambda work_dir: None
+        try:
+            self.manifest = reference_bundle.build(args)
+        finally:
+            reference_bundle.build_indexes = build_indexes
+        self.location = os.path.join(args.out_dir, 'manifest.json')
+        self.sources = dict((name, sources[dest]) for name, dest in reference_bundle.INPUTS)
+        self.fetched = []
+        fetch_chunk = reference_bundle._fetch_chunk
+
+        def counting_fetch_chunk(base, dest_path, chunk):
+            self.fetched.append(chunk['path'])
+            return fetch_chunk(base, dest_path, chunk)
+        reference_bundle._fetch_chunk = counting_fetch_chunk
+        self.addCleanup(setattr, reference_bundle, '_fetch_chunk', fetch_chunk)
+
+    def assertMembersMatch(self, dest):
+        for name, source in self.sources.items():
+            with open(os.path.join(dest, name), 'rb') as a, open(source, 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+
+    def test_FetchSkipAndRepair(self):
+        self.assertEqual(len(self.manifest['members'][0]['chunks']), 3)
+        dest = os.path.join(self.root, 'node')
+        reference_bundle.fetch(self.location, dest, threads=4)
+        self.assertMembersMatch(dest)
+        self.assertEqual(len(self.fetched), 3 * len(self.sources))
+
+        # Verified members are not fetched again
+        del self.fetched[:]
+        reference_bundle.fetch(self.location, dest, threads=4)
+        self.assertEqual(self.fetched, [])
+
+        # A member damaged on disk is fetched again, and a chunk that arrives corrupted is retried
+        damaged = os.path.join(dest, 'dbsnp.vcf')
+        with open(damaged, 'r+b') as f:
+            f.write(b'damaged')
+        st = os.stat(damaged)
+        os.utime(damaged, (st.st_atime, st.st_mtime + 10))
+        chunk = os.path.join(self.root, 'bundle', 'chunks', 'dbsnp.vcf.0001')
+        with open(chunk, 'rb') as f:
+            good = f.read()
+        with open(chunk, 'wb') as f:
+            f.write(good[::-1])
+
+        retries = []
+
+        def restore(attempt):
+            retries.append(attempt)
+            with open(chunk, 'wb') as f:
+                f.write(good)
+            return 0
+        backoff, transfers.backoff = transfers.backoff, restore
+        try:
+            reference_bundle.fetch(self.location, dest, threads=4)
+        finally:
+            transfers.backoff = backoff
+        self.assertEqual(sorted(self.fetched), ['chunks/dbsnp.vcf.0000', 'chunks/dbsnp.vcf.0001',
+                                                'chunks/dbsnp.vcf.0002'])
+        self.assertEqual(retries, [0])
+        self.assertMembersMatch(dest)
+
+    def test_SharedAcrossRuns(self):
+        loads = []
+        load_manifest = reference_bundle.load_manifest
+        reference_bundle.load_manifest = lambda location: loads.append(location) or load_manifest(location)
+        self.addCleanup(setattr, reference_bundle, 'load_manifest', load_manifest)
+        cache = os.path.join(self.root, 'references', self.manifest['version'])
+        for run in ('run1', 'run2'):
+            run_dir = os.path.join(self.root, 'script', run)
+            gatk = SupportGATK({}, self.root, run_dir, os.path.join(run_dir, 'pair'), reference_bundle=self.location)
+            path = gatk.get_input_path('dbsnp.vcf')
+            self.assertEqual(os.path.realpath(path), os.path.join(cache, 'dbsnp.vcf'))
+            gatk.get_input_path('reference.fasta')
+            # Files the bundle does not list are left to their URLs, without reloading the manifest
+            self.assertNotIn('targets.bed', gatk.bundle_members())
+            self.assertMembersMatch(run_dir)
+        self.assertEqual(len(loads), 2)
+        # Fetched once for both runs
+        self.assertEqual(len(self.fetched), 3 * len(self.sources))
+
+
+class TestScratch(unittest.TestCase):
+    def test_PlacedFileKeepsItsPath(self):
+        root, volume = os.path.join('test_out', 'root'), os.path.join('test_out', 'volume')
+        self.addCleanup(shutil.rmtree, 'test_out', True)
+        # Both are on one device, so only the first counts as a volume
+        self.assertEqual(scratch.volumes([root, volume]), [root])
+
+        # What place() does when another volume is less loaded
+        path, real = os.path.join(root, 'pair', 'tumor.bam'), os.path.join(volume, 'pair', 'tumor.bam')
+        SupportGATK.mkdir_p(os.path.dirname(path))
+        SupportGATK.mkdir_p(os.path.dirname(real))
+        os.symlink(os.path.abspath(real), path)
+        self.assertEqual(scratch.place(path, root, [root, volume]), path)
+
+        data = os.urandom(100000)
+        transfers.resumable_download(lambda start, fp: fp.write(data[start:]), path, len(data),
+                                     hashlib.md5(data).hexdigest())
+        self.assertTrue(os.path.islink(path))
+        with open(real, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertTrue(os.path.exists(transfers.sidecar_path(real)))
+        self.assertIsNotNone(transfers.read_sidecar(path))
+
+        scratch.remove(path)
+        self.assertFalse(os.path.lexists(path) or os.path.exists(real))
+
+
+class TestTransferScheduler(unittest.TestCase):
+    def test_BackgroundWaitsForCriticalAndSharesBandwidth(self):
+        state_dir = os.path.join('test_out', 'slots')
+        self.addCleanup(shutil.rmtree, 'test_out', True)
+        scheduler = transfer_scheduler.Scheduler(state_dir, max_active=2, bandwidth=100)
+        order = []
+
+        def upload():
+            with scheduler.slot(transfer_scheduler.BACKGROUND, 'bqsr.bam'):
+                order.append('upload')
+
+        with scheduler.slot(transfer_scheduler.CRITICAL, 'indel.bam'):
+            t = threading.Thread(target=upload)
+            t.start()
+            time.sleep(3 * transfer_scheduler.POLL_SECONDS)
+            order.append('download')
+        t.join()
+        self.assertEqual(order, ['download', 'upload'])
+
+        # A download arriving while an upload is in flight gets most of the budget
+        with scheduler.slot(transfer_scheduler.BACKGROUND, 'bqsr.bam') as upload_slot:
+            with scheduler.slot(transfer_scheduler.CRITICAL, 'indel.bam') as download_slot:
+                self.assertAlmostEqual(download_slot._current_share(), 80)
+                self.assertAlmostEqual(upload_slot._current_share(), 20)
+        self.assertEqual([f for f in os.listdir(state_dir) if f.endswith('.lease')], [])
+
+
+class TestSpeculation(unittest.TestCase):
+    class Node(object):
+        """ The parts of SupportGATK that run_step uses, for one node """
+
+        def __init__(self, store):
+            self.store = store
+            self.published = []
+
+        def speculation_store(self):
+            return self.store
+
+        def publish(self, file_path):
+            self.published.append(file_path)
+
+    def test_StragglerRules(self):
+        now = 100000.0
+        beat = {'updated': now, 'started': now - 3000, 'expected': 1000, 'progress': None}
+        self.assertTrue(speculation.is_straggler(beat, 2.0, now))
+        self.assertFalse(speculation.is_straggler(dict(beat, started=now - 1500), 2.0, now))
+        # Far enough along to extrapolate: 10% in 1500s projects 15000s, so duplicate early
+        self.assertTrue(speculation.is_straggler(dict(beat, started=now - 1500, progress=0.1), 2.0, now))
+        # Nearly done: a fresh start could not catch up
+        self.assertFalse(speculation.is_straggler(dict(beat, progress=0.9), 2.0, now))
+        # Heartbeats stopped
+        self.assertTrue(speculation.is_straggler(dict(beat, started=now - 10, updated=now - 3600), 2.0, now))
+        self.assertFalse(speculation.is_straggler(dict(beat, expected=None), 2.0, now))
+
+    def test_FirstFinisherWins(self):
+        store = speculation.DirStore(os.path.join('test_out', 'speculation'))
+        self.addCleanup(shutil.rmtree, 'test_out', True)
+        SupportGATK.mkdir_p('test_out')
+        speculation.HEARTBEAT_SECONDS, beat = 0.05, speculation.HEARTBEAT_SECONDS
+        speculation.WATCH_SECONDS, watch = 0.05, speculation.WATCH_SECONDS
+        self.addCleanup(setattr, speculation, 'HEARTBEAT_SECONDS', beat)
+        self.addCleanup(setattr, speculation, 'WATCH_SECONDS', watch)
+
+        def step(gatk, sample):
+            output = os.path.join('test_out', '{}.{}.intervals'.format(sample, id(gatk)))
+            with open(output, 'w') as f:
+                f.write('1:100-200\n')
+            # Stands in for run_java: the slow node's tool is stopped once the duplicate has won
+            while gatk is slow and not gatk.attempt.should_stop():
+                time.sleep(0.01)
+            if gatk.attempt.should_stop():
+                raise speculation.Superseded()
+            return output
+
+        slow, fast = self.Node(store), self.Node(store)
+        original = threading.Thread(target=speculation.run_step, args=(slow, 'normal', 'RTC', step))
+        original.start()
+        time.sleep(0.2)
+        speculation.run_step(fast, 'normal', 'RTC', step, speculative=True)
+        original.join(5)
+
+        self.assertFalse(original.is_alive())
+        self.assertEqual(fast.published, [os.path.join('test_out', 'normal.{}.intervals'.format(id(fast)))])
+        self.assertEqual(slow.published, [])
+        states = sorted(json.loads(text)['state'] for name, text in store.list('normal.RTC.')
+                        if name.endswith('.heartbeat'))
+        self.assertEqual(states, ['finished', 'superseded'])
+
+
+class TestProvision(unittest.TestCase):
+    def test_StreamingGunzipStripsChr(self):
+        import gzip
+        text = b'##contig=<ID=chr1>\n#CHROM\tPOS\nchr1\t100\nchr2\t200\nchrX\t300'
+        path = os.path.join('test_out', 'members.gz')
+        SupportGATK.mkdir_p('test_out')
+        self.addCleanup(shutil.rmtree, 'test_out', True)
+        # Two gzip members, as bgzip writes, fed through in awkward pieces
+        with open(path, 'wb') as f:
+            for member in (text[:30], text[30:]):
+                g = gzip.GzipFile(fileobj=f, mode='wb')
+                g.write(member)
+                g.close()
+        with open(path, 'rb') as f:
+            data = f.read()
+        out = io.BytesIO()
+        writer = provision.GunzipWriter(out, strip_chr=True)
+        for i in range(0, len(data), 7):
+            writer.write(data[i:i + 7])
+        writer.close()
+        self.assertEqual(out.getvalue(), b'##contig=<ID=chr1>\n#CHROM\tPOS\n1\t100\n2\t200\nX\t300')
+
+
+class TestAutotune(unittest.TestCase):
+    def setUp(self):
+        SupportGATK.mkdir_p('test_out')
+        self.db = os.path.join('test_out', 'history_{}.sqlite'.format(uuid.uuid4()))
+        self.history = autotune.RunHistory(self.db)
+
+    def tearDown(self):
+        os.remove(self.db)
+
+    def test_DefaultsWithoutHistory(self):
+        settings = self.history.choose('IndelRealigner', 10 ** 9, cores=8, ram_gb=60)
+        self.assertEqual(settings, autotune.default_settings('IndelRealigner', 8))
+
+    def test_PicksFastestAndAvoidsOOM(self):
+        fast = dict(autotune.default_settings('PrintReads', 8), threads=8, heap_gb=4)
+        slow = dict(fast, threads=2, heap_gb=7)
+        self.history.record('PrintReads', 10 ** 9, slow, 8, 60, runtime=1000, peak_rss=0, oom=False)
+        self.history.record('PrintReads', 10 ** 9, fast, 8, 60, runtime=100, peak_rss=0, oom=False)
+        self.assertEqual(self.history.choose('PrintReads', 2 * 10 ** 9, cores=8, ram_gb=60), fast)
+
+        # Once the fast setting has run out of memory on a smaller input it is no longer eligible
+        self.history.record('PrintReads', 10 ** 9, fast, 8, 60, runtime=50, peak_rss=0, oom=True)
+        self.assertEqual(self.history.choose('PrintReads', 2 * 10 ** 9, cores=8, ram_gb=60), slow)
+
+    def test_ExploresBeyondTheDefault(self):
+        default = autotune.default_settings('PrintReads', 8)
+        self.history.record('PrintReads', 10 ** 9, default, 8, 60, runtime=1000, peak_rss=0, oom=False)
+        # One run of the default is enough to predict it; without exploring it would be all that ever runs
+        self.assertEqual(self.history.choose('PrintReads', 10 ** 9, cores=8, ram_gb=60), default)
+        self.assertEqual(autotune.DEFAULT_EXPLORE, 0)
+        # Only one step away: 4 or 8 (all) threads, 4, 7 or 10 GB heap -- never -nct 1 on all those cores
+        near = set([(4, 7), (8, 4), (8, 10)])
+        random.seed(0)
+        draws = [self.history.choose('PrintReads', 10 ** 9, cores=8, ram_gb=60, explore=1.0) for _ in range(30)]
+        self.assertEqual(set((d['threads'], d['heap_gb']) for d in draws), near)
+        tried = draws[0]
+
+        # Once the explored setting has proved faster, it is chosen without exploring
+        self.history.record('PrintReads', 10 ** 9, tried, 8, 60, runtime=600, peak_rss=0, oom=False)
+        self.assertEqual(self.history.choose('PrintReads', 2 * 10 ** 9, cores=8, ram_gb=60), tried)
+
+
+class TestOomRetry(unittest.TestCase):
+    def test_OomClassifiedAndRetryAdjusted(self):
+        self.assertEqual(autotune.classify_failure(1, 'java.lang.OutOfMemoryError: Java heap space'), autotune.HEAP)
+        self.assertEqual(autotune.classify_failure(
+            1, 'java.lang.OutOfMemoryError: unable to create new native thread'), autotune.NATIVE)
+        self.assertEqual(autotune.classify_failure(-9, '', oom_kills=1), autotune.NATIVE)
+        # Killed, but not by the OOM killer
+        self.assertIsNone(autotune.classify_failure(-9, '', oom_kills=0))
+        self.assertIsNone(autotune.classify_failure(1, 'ERROR MESSAGE: Invalid command line'))
+
+        # Heap exhausted: more heap while the node has room, then less held in memory
+        ir = autotune.default_settings('IndelRealigner', 8)
+        retry = autotune.adjust_for_oom('IndelRealigner', ir, autotune.HEAP, 8, 60, concurrent=2)
+        self.assertEqual(retry['heap_gb'], 20)
+        retry = autotune.adjust_for_oom('IndelRealigner', ir, autotune.HEAP, 8, 30, concurrent=2)
+        self.assertEqual((retry['heap_gb'], retry['max_in_memory']), (15, 2700000))
+        # Killed by the kernel: a heap that fits beside the other chain, then fewer threads
+        pr = dict(autotune.default_settings('PrintReads', 8), heap_gb=30)
+        retry = autotune.adjust_for_oom('PrintReads', pr, autotune.NATIVE, 8, 30, concurrent=2)
+        self.assertEqual((retry['heap_gb'], retry['threads']), (10, 8))
+        retry = autotune.adjust_for_oom('PrintReads', retry, autotune.NATIVE, 8, 30, concurrent=2)
+        self.assertEqual((retry['heap_gb'], retry['threads']), (10, 4))
+        # Nothing left on this node: the step needs a bigger one
+        mutect = autotune.default_settings('MuTect', 8)
+        self.assertIsNone(autotune.adjust_for_oom('MuTect', mutect, autotune.HEAP, 8, 16))
+        self.assertEqual(autotune.next_heap(mutect, autotune.HEAP), 20)
+
+
+class TestFusedChain(unittest.TestCase):
+    def setUp(self):
+        SupportGATK.mkdir_p('test_out/run1/pair')
+        self.addCleanup(shutil.rmtree, 'test_out', True)
+        local_dir = os.path.join(os.getcwd(), 'test_out')
+        self.published, self.steps, self.out_of_memory = [], [], {}
+        published = self.published
+
+        class Publishing(SupportGATK):
+            def publish(self, file_path, consumed_elsewhere=True):
+                published.append(os.path.basename(file_path))
+                return True
+        self.gatk = Publishing({}, local_dir, os.path.join(local_dir, 'run1'), os.path.join(local_dir, 'run1', 'pair'),
+                               fuse_chains=True)
+
+        # Each step writes its outputs into the pair directory, or runs out of memory if told to
+        outputs = {'index_bam': ['.bam.bai'], 'realigner_target_creator': ['.intervals'],
+                   'indel_realignment': ['.indel.bam', '.indel.bai'], 'base_recalibration': ['.recal.table'],
+                   'print_reads': ['.bqsr.bam', '.bqsr.bai']}
+        for name, suffixes in outputs.items():
+            self.addCleanup(setattr, jobtree_gatk_pipeline, name, getattr(jobtree_gatk_pipeline, name))
+            setattr(jobtree_gatk_pipeline, name, self.step(name, suffixes))
+        open(self.path('tumor.bam'), 'w').close()
+
+    def path(self, name):
+        return os.path.join(self.gatk.pair_dir, name)
+
+    def step(self, name, suffixes):
+        def run(gatk, sample):
+            self.steps.append(name)
+            if name in self.out_of_memory:
+                raise autotune.NeedsBiggerNode(*self.out_of_memory[name])
+            paths = [self.path(sample + suffix) for suffix in suffixes]
+            for f in paths:
+                open(f, 'w').close()
+            return paths if len(paths) > 1 else paths[0]
+        return run
+
+    def test_OnlyFinalBamPublished(self):
+        target = RecordingTarget()
+        process_sample(target, self.gatk, 'tumor')
+        self.assertEqual(self.steps, ['index_bam', 'realigner_target_creator', 'indel_realignment',
+                                      'base_recalibration', 'print_reads'])
+        self.assertEqual(self.published, ['tumor.bqsr.bam', 'tumor.bqsr.bai'])
+        # The input and the realigned BAM are gone once they have been read; the published BAM stays
+        self.assertFalse(os.path.exists(self.path('tumor.bam')))
+        self.assertFalse(os.path.exists(self.path('tumor.indel.bam')))
+        self.assertTrue(os.path.exists(self.path('tumor.bqsr.bam')))
+        self.assertEqual((target.children, target.follow_on), ([], None))
+
+    def test_OutOfMemoryReissuesWholeChain(self):
+        self.out_of_memory['base_recalibration'] = ('BaseRecalibrator', 24)
+        target = RecordingTarget()
+        process_sample(target, self.gatk, 'tumor')
+        self.assertEqual(self.published, [])
+        self.assertEqual(target.children, [(process_sample, (self.gatk, 'tumor'),
+                                            autotune.NeedsBiggerNode('BaseRecalibrator', 24).memory_bytes)])
+        # The reissued chain starts BaseRecalibrator from the heap that was missing here
+        self.assertEqual(self.gatk.memory_floor, {'BaseRecalibrator': 24})
+
+        # On a single node there is nowhere bigger to go
+        open(self.path('tumor.bam'), 'w').close()
+        self.gatk.single_node = True
+        self.assertRaises(RuntimeError, process_sample, RecordingTarget(), self.gatk, 'tumor')
+
+
+def make_bam_header(refs):
+    """ Uncompressed BAM header (magic, text, reference list) for the given [(name, length)] """
+    text = b'@HD\tVN:1.4\n'
+    raw = bgzf.BAM_MAGIC + struct.pack('<i', len(text)) + text + struct.pack('<i', len(refs))
+    for name, length in refs:
+        raw += struct.pack('<i', len(name) + 1) + name.encode('ascii') + b'\x00' + struct.pack('<i', length)
+    return raw
+
+
+class TestPreflight(unittest.TestCase):
+    refs = [('1', 249250621), ('2', 243199373)]
+
+    def test_BamHeaderFromPartialRead(self):
+        data = bgzf.compress(make_bam_header(self.refs) + b'\x00' * 200000)
+        # Only the first block is needed to get the reference list
+        text, refs = bgzf.parse_bam_header(bgzf.decompress(data[:bgzf.block_size(data)]))
+        self.assertEqual(refs, self.refs)
+        self.assertRaises(bgzf.IncompleteData, bgzf.parse_bam_header, make_bam_header(self.refs)[:20])
+
+    def test_ContigMismatches(self):
+        results = {'reference.fasta': {'contigs': self.refs},
+                   'normal.bam': {'contigs': self.refs},
+                   'tumor.bam': {'contigs': [('1', 12345)]},
+                   'mills.vcf': {'contigs': [('chr1', None)]}}
+        problems = preflight.check_contigs(results)
+        self.assertEqual(len(problems), 2)
+        self.assertTrue(any('tumor.bam' in p for p in problems))
+        self.assertTrue(any('mills.vcf' in p for p in problems))
+
+
+class TestBgzfWriter(unittest.TestCase):
+    def test_VirtualOffsetsAndByteRanges(self):
+        path = 'test_out_bgzf.vcf.gz'
+        lines = [b'1\t{}\t.\tA\tC\t.\tPASS\t.\n'.format(i) for i in range(20000)]
+        writer = bgzf.BgzfWriter(path)
+        start = writer.tell()
+        for line in lines[:10000]:
+            writer.write(line)
+        middle = writer.tell()
+        for line in lines[10000:]:
+            writer.write(line)
+        end = writer.tell()
+        writer.close()
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.remove(path)
+
+        self.assertTrue(data.endswith(bgzf.EOF_BLOCK))
+        self.assertEqual(bgzf.decompress(data), b''.join(lines))
+        # The bytes [start, byte_end(middle)) hold at least the first half, starting at middle's block
+        first = bgzf.decompress(data[start >> 16:writer.byte_end(middle)])
+        self.assertTrue(first.startswith(b''.join(lines[:10000])))
+        second = bgzf.decompress(data[middle >> 16:writer.byte_end(end)])[middle & 0xffff:]
+        self.assertEqual(second, b''.join(lines[10000:]))
+
+
+class TestBamSlice(unittest.TestCase):
+    refs = [('1', 3000000), ('2', 500000)]
+
+    @staticmethod
+    def reg2bin(start, end):
+        for shift, first in reversed(bam_slice.BIN_LEVELS):
+            if start >> shift == (end - 1) >> shift:
+                return first + (start >> shift)
+        return 0
+
+    def make_bam(self, path, reads):
+        """ Writes reads [(tid, pos, cigar)] as a BAM and returns its .bai contents """
+        writer = bgzf.BgzfWriter(path)
+        writer.write(make_bam_header(self.refs))
+        index = [({}, []) for _ in self.refs]
+        for i, (tid, pos, cigar) in enumerate(reads):
+            name = 'r{}\x00'.format(i).encode('ascii')
+            seq = os.urandom(50)
+            end = pos + sum(n for n, op in cigar if op in bam_slice.REF_OPS)
+            body = (struct.pack('<iiBBHHHiiii', tid, pos, len(name), 60, self.reg2bin(pos, end), len(cigar), 0,
+                                100, -1, -1, 0) + name + b''.join(struct.pack('<I', n << 4 | op) for n, op in cigar) +
+                    seq + b'\xff' * 100)
+            start = writer.tell()
+            writer.write(struct.pack('<i', len(body)) + body)
+            bins, linear = index[tid]
+            chunks = bins.setdefault(self.reg2bin(pos, end), [])
+            if chunks and chunks[-1][1] == start:
+                chunks[-1][1] = writer.tell()
+            else:
+                chunks.append([start, writer.tell()])
+            while len(linear) <= (end - 1) >> 14:
+                linear.append(None)
+            for w in range(pos >> 14, ((end - 1) >> 14) + 1):
+                if linear[w] is None:
+                    linear[w] = start
+        writer.close()
+
+        bai = bam_slice.BAI_MAGIC + struct.pack('<i', len(index))
+        for bins, linear in index:
+            bai += struct.pack('<i', len(bins))
+            for b, chunks in sorted(bins.items()):
+                bai += struct.pack('<Ii', b, len(chunks)) + b''.join(struct.pack('<QQ', *c) for c in chunks)
+            # Empty windows point at the previous one's reads, as samtools writes them
+            for w in range(1, len(linear)):
+                linear[w] = linear[w - 1] if linear[w] is None else linear[w]
+            bai += struct.pack('<i', len(linear)) + b''.join(struct.pack('<Q', l or 0) for l in linear)
+        return bai
+
+    @staticmethod
+    def read_names(path):
+        with open(path, 'rb') as f:
+            raw = bgzf.decompress(f.read())
+        names, pos = [], bam_slice.header_length(raw)
+        while pos < len(raw):
+            size, = struct.unpack_from('<i', raw, pos)
+            l_read_name, = struct.unpack_from('<B', raw, pos + 12)
+            names.append(raw[pos + 36:pos + 35 + l_read_name].decode('ascii'))
+            pos += 4 + size
+        return raw[:bam_slice.header_length(raw)], names
+
+    def test_OnlyRegionBytesFetched(self):
+        SupportGATK.mkdir_p('test_out')
+        self.addCleanup(shutil.rmtree, 'test_out', True)
+        bam = os.path.abspath(os.path.join('test_out', 'sample.bam'))
+        reads = [(0, pos, [(100, 0)]) for pos in range(0, 3000000, 150)]
+        # A spliced read starting well before the region but spanning into it
+        reads.insert(3000, (0, 450000, [(50, 0), (60000, 3), (50, 0)]))
+        reads += [(1, pos, [(100, 0)]) for pos in range(0, 500000, 150)]
+        with open(bam + '.bai', 'wb') as f:
+            f.write(self.make_bam(bam, reads))
+
+        out = os.path.join('test_out', 'sample.region.bam')
+        # The whole file is smaller than the gap worth bridging with a single request
+        bam_slice.COALESCE_BYTES, coalesce = 0, bam_slice.COALESCE_BYTES
+        try:
+            with metrics.Transfer(None, 'download', 'http', 'sample', 'sample.bam') as t:
+                md5 = bam_slice.fetch_regions('file://' + bam, ['1:500,001-600,000', '2:1-30000'], out, stats=t)
+        finally:
+            bam_slice.COALESCE_BYTES = coalesce
+
+        expected = ['r{}'.format(i) for i, (tid, pos, cigar) in enumerate(reads)
+                    if (tid == 0 and pos < 600000 and pos + sum(n for n, op in cigar if op in (0, 3)) > 500000) or
+                    (tid == 1 and pos < 30000)]
+        header, names = self.read_names(out)
+        self.assertEqual(header, make_bam_header(self.refs))
+        self.assertEqual(names, expected)
+        self.assertIn('r3000', names)
+        with open(out, 'rb') as f:
+            self.assertEqual(hashlib.md5(f.read()).hexdigest(), md5)
+        # Header, index and the regions' blocks: a small fraction of the file
+        self.assertLess(t.bytes, os.path.getsize(bam) / 3)
+        self.assertRaises(RuntimeError, bam_slice.fetch_regions, 'file://' + bam, ['chr1'], out)
+
+
+class TestCram(unittest.TestCase):
+    def test_KeysAndLosslessRoundTrip(self):
+        sid = '0123456789abcdef'
+        gatk = SupportGATK({}, '/mnt/', '/mnt/script/run1', '/mnt/script/run1/pair', sample_ids={'normal': sid},
+                           cram=True)
+        self.assertEqual(gatk.s3_key('/mnt/script/run1/pair/normal.bqsr.bam'),
+                         '{}/samples/{}/bqsr.cram'.format(gatk.script_name, sid))
+        self.assertEqual(gatk.s3_key('/mnt/script/run1/pair/tumor.indel.bam'), 'script/run1/pair/tumor.indel.cram')
+        self.assertEqual(gatk.s3_key('/mnt/script/run1/pair/tumor.bam'), 'script/run1/pair/tumor.bam')
+        self.assertFalse(gatk.needs_upload('/mnt/script/run1/pair/normal.bqsr.bai'))
+        self.assertTrue(gatk.needs_upload('/mnt/script/run1/pair/tumor.bam.bai'))
+
+        SupportGATK.mkdir_p('test_out')
+        self.addCleanup(shutil.rmtree, 'test_out', True)
+        rng = random.Random(0)
+        ref = ''.join(rng.choice('ACGT') for _ in range(10000))
+        reference = os.path.join('test_out', 'reference.fasta')
+        with open(reference, 'w') as f:
+            f.write('>ref\n' + ''.join(ref[i:i + 60] + '\n' for i in range(0, len(ref), 60)))
+        with open(reference + '.fai', 'w') as f:
+            f.write('ref\t{}\t5\t60\t61\n'.format(len(ref)))
+
+        # Reads matching the reference but for one base, with binned qualities and their originals as OQ
+        bam = os.path.join('test_out', 'normal.bqsr.bam')
+        writer = bgzf.BgzfWriter(bam)
+        writer.write(make_bam_header([('ref', len(ref))]))
+        for i, pos in enumerate(range(0, len(ref) - 50, 45)):
+            name = 'r{}\x00'.format(i).encode('ascii')
+            seq = ref[pos:pos + 10] + 'T' + ref[pos + 11:pos + 50]
+            packed = bytearray(('=ACMGRSVTWYHKDBN'.index(a) << 4) | '=ACMGRSVTWYHKDBN'.index(b)
+                               for a, b in zip(seq[::2], seq[1::2]))
+            quals = bytearray(rng.choice((2, 12, 23, 37)) for _ in seq)
+            oq = 'OQZ'.encode('ascii') + bytes(bytearray(q + 33 for q in reversed(quals))) + b'\x00'
+            body = (struct.pack('<iiBBHHHiiii', 0, pos, len(name), 60, TestBamSlice.reg2bin(pos, pos + 50), 1, 0,
+                                len(seq), -1, -1, 0) + name + struct.pack('<I', 50 << 4) + bytes(packed) +
+                    bytes(quals) + oq)
+            writer.write(struct.pack('<i', len(body)) + body)
+        writer.close()
+
+        stored = os.path.join('test_out', 'normal.bqsr.cram')
+        bam_digest, cram_digest = cram.to_cram(bam, reference, stored)
+        self.assertLess(os.path.getsize(stored), os.path.getsize(bam))
+        rebuilt, bai = os.path.join('test_out', 'rebuilt.bam'), os.path.join('test_out', 'rebuilt.bai')
+        rebuilt_digest = cram.to_bam(stored, reference, rebuilt, bai)
+        # Each file was hashed as it streamed through
+        for path, digest in ((bam, bam_digest), (stored, cram_digest), (rebuilt, rebuilt_digest)):
+            with open(path, 'rb') as f:
+                self.assertEqual(digest.md5(), hashlib.md5(f.read()).hexdigest())
+
+        records = []
+        for path in (bam, rebuilt):
+            with open(path, 'rb') as f:
+                raw = bgzf.decompress(f.read())
+            records.append(raw[bam_slice.header_length(raw):])
+        self.assertEqual(records[0], records[1])
+        with open(bai, 'rb') as f:
+            self.assertEqual(f.read(4), bam_slice.BAI_MAGIC)
+        self.assertGreaterEqual(os.path.getmtime(bai), os.path.getmtime(rebuilt))
+
+
+    def test_StoredCramNotRebuilt(self):
+        SupportGATK.mkdir_p('test_out/run1/pair')
+        self.addCleanup(shutil.rmtree, 'test_out', True)
+        local_dir = os.path.abspath('test_out') + '/'
+        bam = os.path.join(local_dir, 'run1', 'pair', 'tumor.indel.bam')
+        with open(bam, 'wb') as f:
+            f.write(b'bam' * 1000)
+        md5 = hashlib.md5(b'bam' * 1000).hexdigest()
+        stored = {}
+
+        class Key(object):
+            def get_metadata(self, name):
+                return stored.get(name)
+
+        class Bucket(object):
+            def get_key(self, name):
+                return Key() if stored else None
+
+        class Connection(object):
+            def lookup(self, name):
+                return Bucket()
+
+        converted, uploaded = [], []
+
+        class Uploading(SupportGATK):
+            def cram_reference(self):
+                return 'reference.fasta'
+
+            def upload_to_s3(self, file_path, priority=transfer_scheduler.NORMAL, key_name=None, metadata=None):
+                if not file_path.endswith('.cram'):
+                    return SupportGATK.upload_to_s3(self, file_path, priority, key_name, metadata)
+                uploaded.append((key_name, metadata))
+
+        def to_cram(bam_path, reference, cram_path):
+            converted.append(bam_path)
+            with open(cram_path, 'wb') as f:
+                f.write(b'cram')
+            return transfers.digest_file(bam_path), transfers.digest_file(cram_path)
+
+        gatk = Uploading({}, local_dir, os.path.join(local_dir, 'run1'), os.path.join(local_dir, 'run1', 'pair'),
+                         cram=True)
+        connect_s3, to_cram_, jobtree_gatk_pipeline.boto.connect_s3, cram.to_cram = \
+            jobtree_gatk_pipeline.boto.connect_s3, cram.to_cram, Connection, to_cram
+        try:
+            # Nothing stored yet: converted and uploaded, recording which BAM the CRAM came from
+            gatk.upload_to_s3(bam)
+            self.assertEqual(uploaded, [('run1/pair/tumor.indel.cram', {'bam-md5': md5})])
+            self.assertEqual(transfers.read_sidecar(bam)['md5'], md5)
+            self.assertFalse(os.path.lexists(bam[:-len('bam')] + 'cram'))
+            # Stored from this BAM: neither converted nor uploaded again
+            stored['bam-md5'] = md5
+            gatk.upload_to_s3(bam)
+            self.assertEqual(len(converted), 1)
+            self.assertEqual(len(uploaded), 1)
+            # Stored from another BAM
+            stored['bam-md5'] = '0' * 32
+            gatk.upload_to_s3(bam)
+            self.assertEqual(len(uploaded), 2)
+        finally:
+            jobtree_gatk_pipeline.boto.connect_s3, cram.to_cram = connect_s3, to_cram_
+
+
+class TestMetrics(unittest.TestCase):
+    def test_SummariesByStepAndRole(self):
+        metrics_dir = os.path.join('test_out', 'metrics_{}'.format(uuid.uuid4()))
+        metrics.set_step('PrintReads')
+        with metrics.Transfer(metrics_dir, 'download', 's3', 'checkpoint', 'normal.indel.bam') as t:
+            t.bytes = 4000
+        try:
+            with metrics.Transfer(metrics_dir, 'upload', 's3', 'checkpoint', 'normal.bqsr.bam') as t:
+                t.retries = 2
+                raise RuntimeError('upload failed')
+        except RuntimeError:
+            pass
+        metrics.record_compute(metrics_dir, 'PrintReads', 100.0, 130.0)
+
+        # Summarised on the first event, then not again within SUMMARY_SECONDS
+        with open(os.path.join(metrics_dir, metrics.JSON_FILE)) as f:
+            self.assertEqual(json.load(f)['steps']['PrintReads']['compute_seconds'], 0.0)
+        metrics.flush(metrics_dir)
+        with open(os.path.join(metrics_dir, metrics.JSON_FILE)) as f:
+            summary = json.load(f)
+        groups = dict(((g['kind'], g['direction']), g) for g in summary['groups'])
+        self.assertEqual(groups[('transfer', 'download')]['bytes'], 4000)
+        self.assertEqual(groups[('transfer', 'upload')]['failures'], 1)
+        self.assertEqual(groups[('transfer', 'upload')]['retries'], 2)
+        self.assertEqual(summary['steps']['PrintReads']['compute_seconds'], 30.0)
+        with open(os.path.join(metrics_dir, metrics.PROM_FILE)) as f:
+            prom = f.read()
+        self.assertIn('gatk_transfer_bytes_total{kind="transfer",direction="download",source="s3",'
+                      'step="PrintReads",role="checkpoint"} 4000', prom)
+        shutil.rmtree(metrics_dir)
+
+    def test_ConcurrencyAndRotation(self):
+        def transfer(start, end):
+            return {'kind': 'transfer', 'start': start, 'end': end}
+        events = [transfer(0, 10), transfer(2, 5), transfer(5, 6), transfer(5, 5), transfer(10, 12), transfer(7, 3)]
+        # Brute force over [start, end), each transfer counting itself
+        expected = [sum(1 for o in events if o['start'] <= t['start'] < o['end'] or o is t) for t in events]
+        self.assertEqual(metrics._concurrency(events), expected)
+        self.assertEqual(expected, [1, 2, 2, 3, 1, 2])
+
+        metrics_dir = os.path.join('test_out', 'metrics_{}'.format(uuid.uuid4()))
+        self.addCleanup(shutil.rmtree, metrics_dir, True)
+        metrics.record_compute(metrics_dir, 'PrintReads', 0.0, 30.0)
+        metrics.record_compute(metrics_dir, 'PrintReads', 30.0, 40.0)
+        rotate_bytes, metrics.ROTATE_BYTES = metrics.ROTATE_BYTES, 1
+        try:
+            summary = metrics.flush(metrics_dir)
+        finally:
+            metrics.ROTATE_BYTES = rotate_bytes
+        self.assertEqual(summary['groups'], [])
+        self.assertFalse(os.path.exists(os.path.join(metrics_dir, metrics.EVENTS_FILE)))
+        with open(os.path.join(metrics_dir, metrics.EVENTS_FILE + '.1')) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+
+class TestPipelinedDriver(unittest.TestCase):
+    def setUp(self):
+        SupportGATK.mkdir_p('test_out')
+        self.addCleanup(shutil.rmtree, 'test_out', True)
+        self.data = os.path.abspath(os.path.join('test_out', 'data'))
+        for name in ('remote_size', 'run_parallel', 'free_bytes', 'POLL_SECONDS'):
+            self.addCleanup(setattr, pipelined, name, getattr(pipelined, name))
+        pipelined.POLL_SECONDS = 0.05
+        pipelined.remote_size = lambda url: 10
+        pipelined.free_bytes = lambda path: 10 ** 12
+        self.fetched, self.computed = [], []
+
+        def run_parallel(commands):
+            if commands[0][0] == 'wget':
+                num = int(os.path.basename(os.path.dirname(commands[0][3]))[len('pair'):])
+                # Pairs whose compute had finished when this pair's download started
+                self.fetched.append((num, len(self.computed)))
+        pipelined.run_parallel = run_parallel
+
+    def driver(self, lookahead, fail_on=None):
+        args = argparse.Namespace(data=self.data, out=os.path.join(self.data, 'out'), footprint=1.0,
+                                  lookahead=lookahead, bucket=None)
+        driver = pipelined.PipelinedDriver(args)
+        computed = self.computed
+
+        def gatk(pair):
+            time.sleep(0.1)
+            if pair.num == fail_on:
+                raise RuntimeError('pair{} failed'.format(pair.num))
+            computed.append(pair.num)
+        driver.gatk = gatk
+        return driver
+
+    def test_AdmitWaitsForRoomOrStop(self):
+        pipelined.free_bytes = lambda path: 100
+        budget = pipelined.DiskBudget(self.data, 1.0)
+        pairs = [pipelined.Pair(n, self.data) for n in (1, 2, 3)]
+        for p in pairs:
+            p.input_size = 80
+        # Nothing in flight: admitted even though it would not fit beside anything else
+        self.assertTrue(budget.admit(pairs[0]))
+        stop, admitted = threading.Event(), []
+        t = threading.Thread(target=lambda: admitted.append(budget.admit(pairs[1], stop)))
+        t.start()
+        time.sleep(0.3)
+        self.assertEqual(admitted, [])
+        budget.release(pairs[0])
+        t.join(5)
+        self.assertEqual(admitted, [True])
+        stop.set()
+        self.assertFalse(budget.admit(pairs[2], stop))
+        self.assertEqual(sorted(budget.reserved), [2])
+
+    def test_LookaheadBoundsFetching(self):
+        for lookahead in (1, 2):
+            del self.fetched[:], self.computed[:]
+            self.driver(lookahead).run([pipelined.Pair(n, self.data) for n in range(1, 7)])
+            self.assertEqual(self.computed, list(range(1, 7)))
+            self.assertEqual([num for num, done in self.fetched], list(range(1, 7)))
+            # Pair N is only fetched once compute has taken pair N - lookahead, i.e. finished the one before it
+            for num, done in self.fetched:
+                self.assertGreaterEqual(done, num - lookahead - 1)
+            self.assertIn((lookahead + 2, 1), self.fetched)
+
+    def test_FailureStopsEveryStage(self):
+        driver = self.driver(1, fail_on=2)
+        start = time.time()
+        self.assertRaises(RuntimeError, driver.run, [pipelined.Pair(n, self.data) for n in range(1, 7)])
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(self.computed, [1])
+        self.assertLessEqual(max(num for num, done in self.fetched), 3)
+        self.assertNotIn(2, driver.budget.reserved)
+
+
+class TestSimulate(unittest.TestCase):
+    def run_pairs(self, pairs, nodes, fuse_chains=False):
+        tasks = []
+        for pair in range(pairs):
+            tasks.extend(simulate.pair_tasks(pair, {'normal': 10, 'tumor': 20}, 12, fuse_chains))
+        return simulate.simulate(tasks, nodes, 32, 244, 100, simulate.STEP_MODELS)
+
+    def test_CriticalPathFollowsLargerSample(self):
+        result = self.run_pairs(1, 1)
+        path = [step['task'] for step in result['critical_path']]
+        self.assertEqual(path[0], '0:start_node')
+        self.assertEqual(path[-2:], ['0:MuTect', '0:teardown'])
+        self.assertTrue(all('tumor' in t for t in path[1:-2]))
+        self.assertEqual(result['critical_path'][-1]['end'], result['makespan'])
+
+    def test_MoreNodesFinishSooner(self):
+        one, four = self.run_pairs(8, 1), self.run_pairs(8, 4)
+        self.assertLess(four['makespan'], one['makespan'])
+        self.assertLessEqual(four['utilization'], 1.0)
+        self.assertRaises(RuntimeError, simulate.simulate, simulate.pair_tasks(0, {'normal': 1, 'tumor': 1}, 1),
+                          1, 32, 8, 100, simulate.STEP_MODELS)
+
+    def test_ShardsSplitReadsNotReference(self):
+        sizes = {'normal': 10, 'tumor': 20}
+        whole = simulate.cohort_tasks(2, sizes, 12)
+        sharded = simulate.cohort_tasks(2, sizes, 12, shards=4)
+        self.assertEqual(len(sharded), 4 * len(whole))
+        by_name = dict((t.name, t) for t in sharded)
+        # Each region run reads and writes a quarter of the sample, but fetches the whole reference
+        pr = by_name['1/3:tumor_PrintReads']
+        self.assertEqual(pr.input_gb, 5)
+        self.assertEqual(dict(pr.inputs)['1/3:reference'], 12)
+        self.assertEqual(dict((f, gb) for f, gb, _ in pr.outputs)['1/3:tumor.bqsr.bam'], 6.25)
+        self.assertEqual(by_name['1/3:MuTect'].deps, ['1/3:normal_PrintReads', '1/3:tumor_PrintReads'])
+        # Spread over enough nodes the shards run side by side
+        one = simulate.simulate(whole, 8, 32, 244, 100, simulate.STEP_MODELS)
+        four = simulate.simulate(sharded, 8, 32, 244, 100, simulate.STEP_MODELS)
+        self.assertLess(four['makespan'], one['makespan'])
+
+
+class TestUploadQueue(unittest.TestCase):
+    def test_FailedUploadReportedAtBarrier(self):
+        spool = os.path.join('test_out', 'spool_{}'.format(uuid.uuid4()))
+        gatk = SupportGATK({}, 'test_out/', 'test_out/run', 'test_out/run/pair')
+        missing = os.path.join('test_out', 'never_written.bam')
+        upload_queue.enqueue(spool, gatk, missing)
+        failures = upload_queue.wait(spool, [missing], timeout=300)
+        self.assertEqual(list(failures), [missing])
+        self.assertEqual(upload_queue.wait(spool, ['some/other/file']), {})
+        upload_queue.clear_failure(spool, missing)
+        self.assertEqual(upload_queue.wait(spool), {})
+        shutil.rmtree(spool)
+
+
 def main():
     unittest.main()
 
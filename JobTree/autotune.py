@@ -0,0 +1,360 @@
+# John Vivian
+# 10-19-26
+
+"""
+History-driven selection of JVM heap / thread settings for the GATK and MuTect steps.
+
+Every step run through run_monitored() is recorded in a small sqlite database on the node:
+
+    (step, input_bytes, threads, heap_gb, max_in_memory, cores, ram_gb) -> (runtime, peak_rss, oom)
+
+When a step is about to launch, choose() looks at past runs of that step on a node of the same shape,
+throws away any setting that has run out of memory on an input at least this large, and picks the
+setting with the lowest predicted runtime (median seconds-per-byte of its past runs, times the size of
+this input).  With no usable history the pipeline's original constants are returned unchanged.
+
+A setting only gets a prediction once it has run, so choose() can also explore: with probability explore
+(--autotune_explore, off by default) it runs an untried neighbour of the best setting instead -- the next
+thread count, heap size or -maxInMemory up or down, the rest unchanged -- so the history grows beyond
+the defaults one small step at a time.  A neighbour that runs out of memory is retried by the pipeline
+like any other run and is never chosen again for inputs that large.
+
+A run that fails is classified by classify_failure(): the Java heap ran out (HEAP), or the node did
+(NATIVE: the kernel's OOM killer ended the JVM, or it could not get memory for threads).  For either,
+adjust_for_oom() gives the settings to retry with -- a larger heap, a smaller -maxInMemory, fewer
+threads -- or None when nothing on this node would do, in which case the step needs a bigger node.
+"""
+
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+
+# The settings the pipeline has always used; also the fallback when there is no history.
+# threads=None means "all cores".
+STEP_DEFAULTS = {'RealignerTargetCreator': {'threads': None, 'heap_gb': 15},
+                 'IndelRealigner': {'threads': 1, 'heap_gb': 15, 'max_reads': 720000, 'max_in_memory': 5400000},
+                 'BaseRecalibrator': {'threads': None, 'heap_gb': 7},
+                 'PrintReads': {'threads': None, 'heap_gb': 7},
+                 'MuTect': {'threads': 1, 'heap_gb': 15},
+                 'ContEst': {'threads': 1, 'heap_gb': 4}}
+
+# Rough seconds per GB of input with the default settings, for steps without history on this node
+DEFAULT_SECONDS_PER_GB = {'RealignerTargetCreator': 60, 'IndelRealigner': 300, 'BaseRecalibrator': 120,
+                          'PrintReads': 300, 'MuTect': 300, 'ContEst': 60}
+
+# Steps that take -nt/-nct; the rest are single threaded
+THREADED_STEPS = {'RealignerTargetCreator', 'BaseRecalibrator', 'PrintReads'}
+
+HEAP_CHOICES_GB = [4, 7, 10, 15, 20, 30, 45, 60]
+MAX_IN_MEMORY_CHOICES = [1350000, 2700000, 5400000, 10800000]
+
+# Fraction of physical RAM available to JVM heaps; the rest is JVM overhead, page cache, and the OS
+RAM_FRACTION = 0.85
+MIN_SAMPLES = 1
+# Fraction of runs that try an untried neighbour of the best setting (see RunHistory.choose); opt-in
+DEFAULT_EXPLORE = 0.0
+POLL_SECONDS = 2
+
+# Failure classes
+HEAP = 'heap'
+NATIVE = 'native'
+
+# Checked first: these are OutOfMemoryErrors too, but more heap would make them worse
+NATIVE_OOM_SIGNATURES = ('unable to create new native thread', 'Cannot allocate memory',
+                         'insufficient memory for the Java Runtime Environment')
+HEAP_OOM_SIGNATURES = ('java.lang.OutOfMemoryError', 'GC overhead limit exceeded',
+                       'There was a failure because you did not provide enough memory')
+VMSTAT = '/proc/vmstat'
+
+
+class NeedsBiggerNode(RuntimeError):
+    """ A step ran out of memory with every setting this node allows; heap_gb is what to try next """
+
+    def __init__(self, step, heap_gb):
+        RuntimeError.__init__(self, '{} needs a node with room for a {} GB heap'.format(step, heap_gb))
+        self.step = step
+        self.heap_gb = heap_gb
+
+    @property
+    def memory_bytes(self):
+        """ Memory to ask the batch system for: the heap plus the JVM's and the OS's share """
+        return int(self.heap_gb * 1024 ** 3 / RAM_FRACTION)
+
+
+def node_shape():
+    """ (cores, RAM in GB) of this machine """
+    ram = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    return multiprocessing.cpu_count(), int(round(ram / float(1024 ** 3)))
+
+
+def default_settings(step, cores):
+    settings = dict(STEP_DEFAULTS[step])
+    if settings['threads'] is None:
+        settings['threads'] = cores
+    return settings
+
+
+def candidate_settings(step, cores, ram_gb, concurrent=1):
+    """
+    Every setting worth considering on this node.  concurrent is the number of JVM steps expected to
+    share the node (the normal and tumor chains run side by side), which divides the heap budget.
+    """
+    default = default_settings(step, cores)
+    budget = RAM_FRACTION * ram_gb / max(concurrent, 1)
+    heaps = [h for h in HEAP_CHOICES_GB if h <= budget] or [min(HEAP_CHOICES_GB)]
+    if step in THREADED_STEPS:
+        threads = sorted(set([t for t in (1, 2, 4, 8, 16, 32, 64) if t <= cores] + [cores]))
+    else:
+        threads = [1]
+    memory_choices = MAX_IN_MEMORY_CHOICES if 'max_in_memory' in default else [None]
+    candidates = []
+    for t in threads:
+        for h in heaps:
+            for m in memory_choices:
+                c = dict(default, threads=t, heap_gb=h)
+                if m is not None:
+                    c['max_in_memory'] = m
+                candidates.append(c)
+    return candidates
+
+
+def _key(settings):
+    return settings['threads'], settings['heap_gb'], settings.get('max_in_memory')
+
+
+def neighbours(best, candidates):
+    """
+    Candidates one step away from best: the next smaller or larger thread count, heap or -maxInMemory
+    among the candidates, with the other two the same as best's
+    """
+    best_key = _key(best)
+    result = []
+    for dim in range(len(best_key)):
+        values = sorted(set(_key(c)[dim] for c in candidates))
+        if best_key[dim] not in values:
+            continue
+        i = values.index(best_key[dim])
+        adjacent = values[max(i - 1, 0):i] + values[i + 1:i + 2]
+        for c in candidates:
+            key = _key(c)
+            if key[dim] in adjacent and all(key[d] == best_key[d] for d in range(len(key)) if d != dim):
+                result.append(c)
+    return result
+
+
+class RunHistory(object):
+    """
+    sqlite-backed record of past step runs.  A connection is opened per call so the object can be
+    pickled along with SupportGATK and used from any target.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        conn.execute('CREATE TABLE IF NOT EXISTS runs (step TEXT, input_bytes INTEGER, threads INTEGER, '
+                     'heap_gb INTEGER, max_in_memory INTEGER, cores INTEGER, ram_gb INTEGER, '
+                     'runtime REAL, peak_rss INTEGER, oom INTEGER, finished REAL, extra TEXT)')
+        return conn
+
+    def record(self, step, input_bytes, settings, cores, ram_gb, runtime, peak_rss, oom, extra=None):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (step, input_bytes, settings['threads'], settings['heap_gb'],
+                              settings.get('max_in_memory'), cores, ram_gb, runtime, peak_rss, int(bool(oom)),
+                              time.time(), json.dumps(extra or {})))
+        finally:
+            conn.close()
+
+    def runs(self, step, cores, ram_gb):
+        """ Past runs of step on nodes with the same core count and roughly the same RAM """
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT input_bytes, threads, heap_gb, max_in_memory, runtime, peak_rss, oom '
+                                'FROM runs WHERE step = ? AND cores = ? AND ram_gb BETWEEN ? AND ?',
+                                (step, cores, int(ram_gb * 0.9), int(ram_gb * 1.1 + 1))).fetchall()
+        finally:
+            conn.close()
+        return [dict(zip(('input_bytes', 'threads', 'heap_gb', 'max_in_memory', 'runtime', 'peak_rss', 'oom'), r))
+                for r in rows]
+
+    def expected_runtime(self, step, input_bytes, settings, cores=None, ram_gb=None):
+        """
+        Seconds a run of step on input_bytes should take: the median seconds-per-byte of past successful
+        runs with these settings (or any settings, if these have none), else DEFAULT_SECONDS_PER_GB.
+        """
+        if cores is None or ram_gb is None:
+            cores, ram_gb = node_shape()
+        good = [r for r in self.runs(step, cores, ram_gb) if not r['oom'] and r['input_bytes'] and r['runtime']]
+        same = [r for r in good if (r['threads'], r['heap_gb'], r['max_in_memory']) == _key(settings)]
+        rates = sorted(r['runtime'] / float(r['input_bytes']) for r in same or good)
+        if rates:
+            return rates[len(rates) // 2] * input_bytes
+        return DEFAULT_SECONDS_PER_GB.get(step, 300) * input_bytes / 1e9
+
+    def choose(self, step, input_bytes, cores=None, ram_gb=None, concurrent=1, explore=0.0):
+        """
+        Returns the settings dict predicted to finish fastest without running out of memory.
+        :param explore: probability of trying an untested neighbour of the best setting instead
+        """
+        if cores is None or ram_gb is None:
+            cores, ram_gb = node_shape()
+        candidates = candidate_settings(step, cores, ram_gb, concurrent)
+        history = self.runs(step, cores, ram_gb)
+
+        by_setting = {}
+        for run in history:
+            by_setting.setdefault((run['threads'], run['heap_gb'], run['max_in_memory']), []).append(run)
+
+        predictions = []
+        untried = []
+        for c in candidates:
+            runs = by_setting.get(_key(c), [])
+            # Any OOM on an input no bigger than this one rules the setting out
+            if any(r['oom'] and r['input_bytes'] <= input_bytes * 1.1 for r in runs):
+                continue
+            good = [r for r in runs if not r['oom'] and r['input_bytes'] and r['runtime']]
+            if len(good) < MIN_SAMPLES:
+                untried.append(c)
+                continue
+            rates = sorted(r['runtime'] / float(r['input_bytes']) for r in good)
+            predictions.append((rates[len(rates) // 2] * input_bytes, c))
+
+        if not predictions:
+            default = default_settings(step, cores)
+            if _key(default) in [_key(c) for c in untried] or _key(default) not in by_setting:
+                return default
+            # The default has run out of memory here: the most memory and fewest threads left
+            pool = untried or candidates
+            return max(pool, key=lambda c: (c['heap_gb'], -c['threads'], -(c.get('max_in_memory') or 0)))
+
+        best = min(predictions, key=lambda p: p[0])[1]
+        if untried and random.random() < explore:
+            near = neighbours(best, untried + [best])
+            near = [c for c in near if _key(c) != _key(best)]
+            if near:
+                return random.choice(near)
+        return best
+
+
+def _peak_rss(pid):
+    """ High-water mark of resident memory for pid in bytes, from /proc (Linux only) """
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+
+def oom_kill_count():
+    """ Processes the kernel's OOM killer has ended since boot, or None if the kernel does not say """
+    try:
+        with open(VMSTAT) as f:
+            for line in f:
+                if line.startswith('oom_kill '):
+                    return int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def classify_failure(returncode, stderr, oom_kills=None):
+    """
+    HEAP, NATIVE, or None (not a memory problem) for a run that exited with returncode.
+    :param oom_kills: OOM killer kills on the node during the run, None if unknown
+    """
+    if returncode == 0:
+        return None
+    if any(sig in stderr for sig in NATIVE_OOM_SIGNATURES):
+        return NATIVE
+    if any(sig in stderr for sig in HEAP_OOM_SIGNATURES):
+        return HEAP
+    # SIGKILL: the OOM killer's doing unless the kernel says it killed nothing
+    if returncode in (-9, 137) and oom_kills != 0:
+        return NATIVE
+    return None
+
+
+def adjust_for_oom(step, settings, failure, cores, ram_gb, concurrent=1):
+    """
+    Settings to retry step with after it failed with failure (HEAP or NATIVE), or None if this node
+    has nothing left to try.
+    """
+    budget = RAM_FRACTION * ram_gb / max(concurrent, 1)
+    adjusted = dict(settings)
+    threads = settings['threads']
+    if failure == HEAP:
+        bigger = [h for h in HEAP_CHOICES_GB if settings['heap_gb'] < h <= budget]
+        if bigger:
+            adjusted['heap_gb'] = bigger[0]
+            return adjusted
+        # The heap cannot grow here: keep less in it
+        smaller = [m for m in MAX_IN_MEMORY_CHOICES if m < (settings.get('max_in_memory') or 0)]
+        if smaller:
+            adjusted['max_in_memory'] = smaller[-1]
+            return adjusted
+    elif failure == NATIVE:
+        # The node ran out, not the heap: a heap that fits beside the other JVMs, then fewer threads
+        fitting = [h for h in HEAP_CHOICES_GB if h <= budget]
+        if fitting and settings['heap_gb'] > fitting[-1]:
+            adjusted['heap_gb'] = fitting[-1]
+            return adjusted
+    else:
+        return None
+    if step in THREADED_STEPS and threads > 1:
+        adjusted['threads'] = threads // 2
+        return adjusted
+    return None
+
+
+def next_heap(settings, failure):
+    """ Heap to ask a bigger node for once adjust_for_oom has run out of options """
+    if failure == NATIVE:
+        return settings['heap_gb']
+    bigger = [h for h in HEAP_CHOICES_GB if h > settings['heap_gb']]
+    return bigger[0] if bigger else None
+
+
+def run_monitored(cmd, log_path, should_stop=None):
+    """
+    Runs cmd with stderr captured to log_path (and echoed afterwards so jobTree's logs still have it).
+    Returns (returncode, runtime seconds, peak RSS bytes, oom), oom being HEAP, NATIVE or None (see
+    classify_failure).  OSError from Popen propagates.
+
+    :param should_stop: fn() polled while cmd runs; once it returns True cmd is killed (not an OOM)
+    """
+    start = time.time()
+    peak = 0
+    stopped = False
+    kills_before = oom_kill_count()
+    with open(log_path, 'w') as log:
+        proc = subprocess.Popen(cmd, stderr=log)
+        while proc.poll() is None:
+            peak = max(peak, _peak_rss(proc.pid))
+            if should_stop is not None and should_stop():
+                proc.kill()
+                proc.wait()
+                stopped = True
+                break
+            time.sleep(POLL_SECONDS)
+    runtime = time.time() - start
+    kills_after = oom_kill_count()
+
+    with open(log_path) as log:
+        stderr = log.read()
+    sys.stderr.write(stderr)
+    if stopped:
+        return proc.returncode, runtime, peak, None
+    kills = None if kills_before is None or kills_after is None else kills_after - kills_before
+    return proc.returncode, runtime, peak, classify_failure(proc.returncode, stderr, kills)
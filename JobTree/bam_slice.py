@@ -0,0 +1,281 @@
+# John Vivian
+# 10-19-26
+
+"""
+Region-restricted copies of remote BAMs, fetched with HTTP range requests guided by the BAM's index.
+
+A worker that only handles some regions (e.g. one chromosome) does not need the whole BAM:
+
+    1. the .bai is downloaded (a few MB) and parsed
+    2. for each region, the bins overlapping it give chunks of virtual offsets, i.e. (compressed offset
+       of a BGZF block << 16) | offset within its uncompressed data, trimmed with the linear index
+    3. the BAM's header and the blocks those chunks cover are range-fetched; chunks with less than
+       COALESCE_BYTES between them are read as one range, since extra reads cost less than a request
+    4. reads overlapping a region are written, with the original header, to a new BGZF file
+
+The result is a valid, coordinate-sorted BAM holding exactly the reads that overlap the regions, so
+chromosome 22 of a whole genome moves about 1.5% of the bytes.
+
+https://samtools.github.io/hts-specs/SAMv1.pdf  (sections 4.2 and 5)
+"""
+
+import hashlib
+import os
+import struct
+
+import bgzf
+import transfers
+
+BAI_MAGIC = b'BAI\x01'
+# Bins per level of the binning scheme, as (shift, first bin of the level)
+BIN_LEVELS = ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681))
+LINEAR_SHIFT = 14
+# Metadata pseudo-bin samtools adds to each reference; it holds no reads
+PSEUDO_BIN = 37450
+MAX_BLOCK_BYTES = 0x10000
+COALESCE_BYTES = 1024 * 1024
+FETCH_SIZE = 4 * 1024 * 1024
+HEADER_STEPS = [64 * 1024, 1024 * 1024, 8 * 1024 * 1024, 64 * 1024 * 1024]
+# CIGAR operations that consume the reference: M, D, N, =, X
+REF_OPS = frozenset([0, 2, 3, 7, 8])
+
+
+def parse_region(text):
+    """ 'chr22' or 'chr22:1,000-2,000' (1-based, inclusive) -> (contig, start, end) 0-based, half-open """
+    contig, _, span = text.strip().rpartition(':')
+    if not contig or '-' not in span:
+        return text.strip(), 0, None
+    start, end = span.replace(',', '').split('-', 1)
+    try:
+        return contig, int(start) - 1, int(end)
+    except ValueError:
+        return text.strip(), 0, None
+
+
+def parse_bai(data):
+    """ [({bin: [(chunk_beg, chunk_end), ...]}, [linear offsets]), ...] per reference, from a .bai """
+    if data[:4] != BAI_MAGIC:
+        raise RuntimeError('Not a BAM index (bad magic)')
+    n_ref, = struct.unpack_from('<i', data, 4)
+    pos = 8
+    index = []
+    for _ in range(n_ref):
+        n_bin, = struct.unpack_from('<i', data, pos)
+        pos += 4
+        bins = {}
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, pos)
+            pos += 8
+            chunks = struct.unpack_from('<{}Q'.format(2 * n_chunk), data, pos)
+            pos += 16 * n_chunk
+            if bin_id != PSEUDO_BIN:
+                bins[bin_id] = list(zip(chunks[::2], chunks[1::2]))
+        n_intv, = struct.unpack_from('<i', data, pos)
+        pos += 4
+        linear = list(struct.unpack_from('<{}Q'.format(n_intv), data, pos))
+        pos += 8 * n_intv
+        index.append((bins, linear))
+    return index
+
+
+def reg2bins(start, end):
+    """ Every bin that may hold reads overlapping [start, end) """
+    end -= 1
+    bins = [0]
+    for shift, first in BIN_LEVELS:
+        bins.extend(range(first + (start >> shift), first + (end >> shift) + 1))
+    return bins
+
+
+def region_chunks(index, tid, start, end):
+    """ Sorted, merged (virtual start, virtual end) chunks that hold every read overlapping the region """
+    bins, linear = index[tid]
+    # Nothing that ends before the first read of the region's 16 kb window can overlap it
+    min_offset = linear[min(start >> LINEAR_SHIFT, len(linear) - 1)] if linear else 0
+    chunks = [(max(beg, min_offset), c_end) for b in reg2bins(start, end) for beg, c_end in bins.get(b, [])
+              if c_end > min_offset]
+    return merge_chunks(chunks)
+
+
+def merge_chunks(chunks, gap=0):
+    """ Sorts chunks and joins those that overlap or whose blocks are less than gap bytes apart """
+    merged = []
+    for beg, end in sorted(chunks):
+        if merged and (beg >> 16) - (merged[-1][1] >> 16) <= gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([beg, end])
+    return [tuple(c) for c in merged]
+
+
+def alignment_end(record):
+    """ 0-based exclusive reference end of a BAM record (without its block_size) """
+    pos, l_read_name = struct.unpack_from('<iB', record, 4)
+    n_cigar, flag = struct.unpack_from('<HH', record, 12)
+    if flag & 4 or not n_cigar:
+        return pos + 1
+    cigar = struct.unpack_from('<{}I'.format(n_cigar), record, 32 + l_read_name)
+    span = sum(op >> 4 for op in cigar if op & 0xf in REF_OPS)
+    return pos + max(span, 1)
+
+
+def header_length(raw):
+    """ Bytes taken by the BAM header at the start of raw (magic, text and reference list) """
+    l_text, = struct.unpack_from('<i', raw, 4)
+    pos = 8 + l_text
+    n_ref, = struct.unpack_from('<i', raw, pos)
+    pos += 4
+    for _ in range(n_ref):
+        l_name, = struct.unpack_from('<i', raw, pos)
+        pos += 8 + l_name
+    return pos
+
+
+class RangeReader(object):
+    """ Range reads of url (size bytes long), counted into stats.bytes and throttled like a download """
+
+    def __init__(self, url, size, stats=None):
+        self.url = url
+        self.size = size
+        self.stats = stats
+
+    def read(self, start, length):
+        length = min(length, self.size - start)
+        if length <= 0:
+            raise RuntimeError('{} ends before offset {}'.format(self.url, start))
+        data = transfers.range_get(self.url, start, length)
+        if self.stats is not None:
+            self.stats.bytes += len(data)
+            if getattr(self.stats, 'throttle', None):
+                self.stats.throttle(len(data))
+        return data
+
+    def blocks(self, start, last, stop):
+        """
+        Yields (offset, uncompressed data) for every BGZF block starting from start through last, reading
+        nothing at or past stop.  Bytes are fetched lazily, FETCH_SIZE at a time.
+        """
+        offset, buf = start, b''
+        while offset <= last:
+            want = min(FETCH_SIZE, stop - offset - len(buf))
+            if want <= 0:
+                raise RuntimeError('{}: BGZF block at {} runs past {}'.format(self.url, offset, stop))
+            buf += self.read(offset + len(buf), want)
+            consumed = 0
+            for rel, size, data in bgzf.read_blocks(buf):
+                if offset + rel > last:
+                    return
+                yield offset + rel, data
+                consumed = rel + size
+            buf = buf[consumed:]
+            offset += consumed
+
+
+def find_bai(bam_url):
+    """ URL and size of the index beside bam_url (<bam>.bai or <name>.bai), or RuntimeError """
+    candidates = [bam_url + '.bai']
+    if bam_url.endswith('.bam'):
+        candidates.append(bam_url[:-len('.bam')] + '.bai')
+    for url in candidates:
+        size, _ = transfers.head_url(url)
+        if size:
+            return url, size
+    raise RuntimeError('No index found for {} (tried {})'.format(bam_url, ', '.join(candidates)))
+
+
+def read_header(reader):
+    """ The uncompressed header of the BAM behind reader, and its [(name, length), ...] """
+    for length in HEADER_STEPS:
+        data = reader.read(0, length)
+        raw = bgzf.decompress(data)
+        try:
+            refs = bgzf.parse_bam_header(raw)[1]
+        except bgzf.IncompleteData:
+            if len(data) < length:
+                raise RuntimeError('BAM ends inside its header: {}'.format(reader.url))
+            continue
+        return raw[:header_length(raw)], refs
+    raise RuntimeError('BAM header larger than {} bytes: {}'.format(HEADER_STEPS[-1], reader.url))
+
+
+def _records(reader, chunks):
+    """ Yields every complete BAM record (with its block_size) in the chunks, in file order """
+    for beg, end in chunks:
+        if end & 0xffff:
+            # Blocks are under 64 KB, so the one holding the chunk's end finishes within MAX_BLOCK_BYTES
+            last, stop = end >> 16, (end >> 16) + MAX_BLOCK_BYTES
+        else:
+            # The chunk ends where a block starts: everything before it, and nothing more
+            last, stop = (end >> 16) - 1, end >> 16
+        buf = b''
+        for offset, data in reader.blocks(beg >> 16, last, stop):
+            if offset == end >> 16:
+                data = data[:end & 0xffff]
+            if offset == beg >> 16:
+                data = data[beg & 0xffff:]
+            buf += data
+            pos = 0
+            while len(buf) - pos >= 4:
+                size, = struct.unpack_from('<i', buf, pos)
+                if len(buf) - pos < 4 + size:
+                    break
+                yield buf[pos:pos + 4 + size]
+                pos += 4 + size
+            buf = buf[pos:]
+
+
+def fetch_regions(bam_url, regions, out_path, stats=None):
+    """
+    Writes the reads of the BAM at bam_url overlapping any of regions (see parse_region) to out_path,
+    a new BAM with the same header.  Returns the MD5 of out_path.
+
+    :param stats: object with a .bytes counter and optional .throttle(nbytes), e.g. a metrics.Transfer
+    """
+    bai_url, bai_size = find_bai(bam_url)
+    index = parse_bai(RangeReader(bai_url, bai_size, stats).read(0, bai_size))
+    bam_size, _ = transfers.head_url(bam_url)
+    if not bam_size:
+        raise RuntimeError('{} is unreachable'.format(bam_url))
+    reader = RangeReader(bam_url, bam_size, stats)
+    header, refs = read_header(reader)
+    if len(refs) != len(index):
+        raise RuntimeError('Index of {} lists {} references, its header {}'.format(bam_url, len(index), len(refs)))
+
+    tids = dict((name, i) for i, (name, _) in enumerate(refs))
+    wanted, chunks = {}, {}
+    for region in regions:
+        contig, start, end = parse_region(region)
+        if contig not in tids:
+            raise RuntimeError('{} is not a contig of {}'.format(contig, bam_url))
+        tid = tids[contig]
+        end = refs[tid][1] if end is None else min(end, refs[tid][1])
+        if start >= end:
+            continue
+        wanted.setdefault(tid, []).append((start, end))
+        chunks.setdefault(tid, []).extend(region_chunks(index, tid, start, end))
+
+    part = transfers.partial_path(out_path)
+    writer = bgzf.BgzfWriter(part)
+    try:
+        writer.write(header)
+        # One sorted pass per contig, so every read is written once and in order.  Reads are sorted by
+        # position, so the pass ends at the first read past the last region, skipping the remaining
+        # chunks of large bins (which only hold reads further along).
+        for tid in sorted(wanted):
+            spans = wanted[tid]
+            stop = max(end for _, end in spans)
+            for record in _records(reader, merge_chunks(chunks[tid], COALESCE_BYTES)):
+                record_tid, pos = struct.unpack_from('<ii', record, 4)
+                if record_tid != tid or pos >= stop:
+                    break
+                if any(pos < end and alignment_end(record[4:]) > start for start, end in spans):
+                    writer.write(record)
+    finally:
+        writer.close()
+
+    md5 = hashlib.md5()
+    with open(part, 'rb') as f:
+        for block in iter(lambda: f.read(transfers.READ_SIZE), b''):
+            md5.update(block)
+    os.rename(part, os.path.realpath(out_path))
+    return md5.hexdigest()
@@ -0,0 +1,164 @@
+# John Vivian
+# 10-19-26
+
+"""
+Minimal BGZF / BAM header support (pure python, no pysam).
+
+BGZF is a series of gzip members of at most 64 KB each, with the compressed size of the member stored
+in a 'BC' extra subfield.  That lets a reader walk the blocks of a partial download (e.g. the first few
+hundred KB of a BAM fetched with an HTTP range request) without needing the rest of the file.
+
+https://samtools.github.io/hts-specs/SAMv1.pdf  (section 4)
+"""
+
+import bisect
+import struct
+import zlib
+
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BAM_MAGIC = b'BAM\x01'
+HEADER_SIZE = 18
+# Uncompressed bytes per block; leaves room for incompressible data to stay under the 64 KB limit
+MAX_BLOCK_DATA = 0xff00
+EOF_BLOCK = (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00'
+             b'\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+
+class IncompleteData(Exception):
+    """ Raised when a buffer ends part-way through a block or a BAM header """
+    pass
+
+
+def is_bgzf(data):
+    return data[:4] == BGZF_MAGIC and len(data) >= HEADER_SIZE and data[12:14] == b'BC'
+
+
+def compress_block(data, level=6):
+    """ A single BGZF block holding data (at most MAX_BLOCK_DATA bytes) """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    payload = compressor.compress(data) + compressor.flush()
+    bsize = len(payload) + 25
+    return (BGZF_MAGIC + b'\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + struct.pack('<H', bsize) +
+            payload + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+def compress(data, level=6):
+    """ data as a complete BGZF stream, including the EOF marker block """
+    blocks = [compress_block(data[i:i + MAX_BLOCK_DATA], level) for i in range(0, len(data), MAX_BLOCK_DATA)]
+    return b''.join(blocks) + EOF_BLOCK
+
+
+def block_size(data, offset=0):
+    """ Total compressed size of the BGZF block starting at offset """
+    if len(data) < offset + HEADER_SIZE:
+        raise IncompleteData()
+    if data[offset:offset + 4] != BGZF_MAGIC:
+        raise ValueError('Not a BGZF block at offset {}'.format(offset))
+    xlen = struct.unpack('<H', data[offset + 10:offset + 12])[0]
+    pos = offset + 12
+    end = pos + xlen
+    while pos < end:
+        si1, si2, slen = struct.unpack('<BBH', data[pos:pos + 4])
+        if (si1, si2) == (66, 67):
+            return struct.unpack('<H', data[pos + 4:pos + 6])[0] + 1
+        pos += 4 + slen
+    raise ValueError('BGZF block at offset {} has no BC subfield'.format(offset))
+
+
+def read_blocks(data, offset=0):
+    """
+    Yields (offset, compressed size, uncompressed bytes) for every complete block in data.
+    Stops silently at a trailing partial block.
+    """
+    while offset < len(data):
+        try:
+            size = block_size(data, offset)
+        except IncompleteData:
+            return
+        if offset + size > len(data):
+            return
+        xlen = struct.unpack('<H', data[offset + 10:offset + 12])[0]
+        payload = data[offset + 12 + xlen:offset + size - 8]
+        yield offset, size, zlib.decompress(payload, -15)
+        offset += size
+
+
+def decompress(data):
+    """ Uncompressed contents of every complete block in data """
+    return b''.join(block for _, _, block in read_blocks(data))
+
+
+def parse_bam_header(raw):
+    """
+    Parses the uncompressed start of a BAM.  Returns (header text, [(name, length), ...]).
+    Raises IncompleteData if raw stops before the reference list ends.
+    """
+    if len(raw) < 8:
+        raise IncompleteData()
+    if raw[:4] != BAM_MAGIC:
+        raise ValueError('Not a BAM file (bad magic)')
+    l_text = struct.unpack('<i', raw[4:8])[0]
+    pos = 8 + l_text
+    if len(raw) < pos + 4:
+        raise IncompleteData()
+    text = raw[8:pos].rstrip(b'\x00').decode('ascii', 'replace')
+    n_ref = struct.unpack('<i', raw[pos:pos + 4])[0]
+    pos += 4
+    refs = []
+    for _ in range(n_ref):
+        if len(raw) < pos + 4:
+            raise IncompleteData()
+        l_name = struct.unpack('<i', raw[pos:pos + 4])[0]
+        if len(raw) < pos + 8 + l_name:
+            raise IncompleteData()
+        name = raw[pos + 4:pos + 4 + l_name - 1].decode('ascii')
+        length = struct.unpack('<i', raw[pos + 4 + l_name:pos + 8 + l_name])[0]
+        refs.append((name, length))
+        pos += 8 + l_name
+    return text, refs
+
+
+class BgzfWriter(object):
+    """
+    Writes a BGZF file while keeping track of virtual offsets, i.e. (compressed offset of a block << 16)
+    | offset within its uncompressed data -- the coordinates tabix and BAI indexes use.
+    """
+
+    def __init__(self, path, level=6):
+        self.f = open(path, 'wb')
+        self.level = level
+        self.buffer = b''
+        self.block_offsets = []
+
+    def tell(self):
+        """ Virtual offset of the next byte to be written """
+        return (self.f.tell() << 16) | len(self.buffer)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= MAX_BLOCK_DATA:
+            self._flush_block(self.buffer[:MAX_BLOCK_DATA])
+            self.buffer = self.buffer[MAX_BLOCK_DATA:]
+
+    def _flush_block(self, data):
+        self.block_offsets.append(self.f.tell())
+        self.f.write(compress_block(data, self.level))
+
+    def close(self):
+        if self.buffer:
+            self._flush_block(self.buffer)
+            self.buffer = b''
+        # The EOF marker starts where the last data block ends
+        self.block_offsets.append(self.f.tell())
+        self.f.write(EOF_BLOCK)
+        self.f.close()
+
+    def byte_end(self, voffset):
+        """
+        After close(): compressed offset just past the block holding the byte before voffset, i.e. the
+        exclusive end of the byte range needed to read everything up to voffset.
+        """
+        block, within = voffset >> 16, voffset & 0xffff
+        if within == 0:
+            return block
+        return self.block_offsets[bisect.bisect_right(self.block_offsets, block)]
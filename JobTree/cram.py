@@ -0,0 +1,131 @@
+# John Vivian
+# 10-19-26
+
+"""
+Reference-based CRAM copies of the BAMs the pipeline stores in S3 (--cram).
+
+Most of an .indel.bam or .bqsr.bam is read bases and qualities (twice over with --emit_original_quals'
+OQ tags).  CRAM stores the bases as differences from the reference and compresses each field on its
+own, so the S3 copies are 40-60% smaller.  With --cram:
+
+    upload    <name>.bam is converted to <name>.cram, which is stored under the BAM's key with the
+              bam suffix swapped for cram (see CRAM_SUFFIXES)
+    download  the CRAM is fetched and <name>.bam rebuilt from it, together with a fresh <name>.bai:
+              the original index points into the original BAM's compressed blocks, which the rebuilt
+              BAM does not share, so the index is never stored for these BAMs
+
+The GATK and MuTect versions the pipeline runs read BAM only, so every consumer gets a rebuilt BAM.
+Conversion is lossless (read names, qualities and tags all survive) and needs samtools 1.10+ and the same
+reference.fasta (+ .fai) the reads were aligned to; the CRAM records each contig's MD5 and decoding
+against any other reference fails.
+"""
+
+import os
+import shutil
+import subprocess
+import threading
+
+import transfers
+
+# BAM suffix -> suffix of its CRAM copy, for every BAM that is stored as CRAM
+CRAM_SUFFIXES = [('indel.bam', 'indel.cram'), ('bqsr.bam', 'bqsr.cram')]
+
+
+def cram_name(name):
+    """
+    The CRAM counterpart of a BAM file name, path or S3 key (<sample>.bqsr.bam, or samples/<id>/bqsr.bam),
+    or None if it is not stored as CRAM
+    """
+    for bam_suffix, cram_suffix in CRAM_SUFFIXES:
+        stem = name[:-len(bam_suffix)]
+        if name.endswith(bam_suffix) and stem[-1:] in ('.', '/'):
+            return stem + cram_suffix
+    return None
+
+
+def bam_for_index(name):
+    """ 'tumor.bqsr.bai' -> 'tumor.bqsr.bam' if that BAM is stored as CRAM (so its index is rebuilt), else None """
+    base, ext = os.path.splitext(name)
+    if ext == '.bai' and cram_name(base + '.bam'):
+        return base + '.bam'
+    return None
+
+
+def _samtools(args):
+    try:
+        subprocess.check_call(['samtools'] + args)
+    except subprocess.CalledProcessError:
+        raise RuntimeError('samtools {} failed'.format(' '.join(args)))
+    except OSError:
+        raise RuntimeError('Failed to find "samtools". Install samtools 1.10 or later, which reads and writes CRAM')
+
+
+def _popen(args, **kwargs):
+    try:
+        return subprocess.Popen(['samtools'] + args, **kwargs)
+    except OSError:
+        raise RuntimeError('Failed to find "samtools". Install samtools 1.10 or later, which reads and writes CRAM')
+
+
+def _pump(source, dest, digest):
+    """ Copies source to dest, feeding every block to digest on the way """
+    for block in iter(lambda: source.read(transfers.READ_SIZE), b''):
+        dest.write(block)
+        digest.update(block)
+
+
+def _write_output(proc, args, path):
+    """ Streams proc's stdout into path.  Returns its StreamingDigest, or raises if proc failed. """
+    digest = transfers.StreamingDigest()
+    with open(path, 'wb') as out:
+        _pump(proc.stdout, out, digest)
+    if proc.wait() != 0:
+        raise RuntimeError('samtools {} failed'.format(' '.join(args)))
+    return digest
+
+
+def to_cram(bam, reference, cram_path):
+    """
+    Writes the reads of bam to cram_path, encoded against reference.  Both files are hashed as they pass
+    through, so neither needs another read to be verified: returns the StreamingDigests of (bam, cram).
+    """
+    part = transfers.partial_path(cram_path)
+    # MD/NM are kept as they are (present or not) rather than dropped and recomputed on decoding
+    args = ['view', '-O', 'cram,store_md=1,store_nm=1', '-T', reference, '-o', '-', '-']
+    proc = _popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    bam_digest = transfers.StreamingDigest()
+
+    def feed():
+        try:
+            with open(bam, 'rb') as f:
+                _pump(f, proc.stdin, bam_digest)
+        except IOError:
+            # samtools exited early; its status says why
+            pass
+        finally:
+            proc.stdin.close()
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    cram_digest = _write_output(proc, args, part)
+    feeder.join()
+    if bam_digest.size != os.path.getsize(bam):
+        raise RuntimeError('samtools stopped reading {} before its end'.format(bam))
+    os.rename(part, os.path.realpath(cram_path))
+    return bam_digest, cram_digest
+
+
+def to_bam(cram_path, reference, bam, bai):
+    """
+    Rebuilds bam, and its index bai, from cram_path, decoded against reference.  Returns the StreamingDigest
+    of bam, hashed as it was written.
+    """
+    part = transfers.partial_path(bam)
+    args = ['view', '-b', '--input-fmt-option', 'decode_md=0', '-T', reference, '-o', '-', cram_path]
+    digest = _write_output(_popen(args, stdout=subprocess.PIPE), args, part)
+    # Indexed after the BAM is written, so the index is never older than the BAM.  The BAM may have been
+    # placed on another volume than its index, hence a move rather than a rename.
+    _samtools(['index', part])
+    shutil.move(part + '.bai', os.path.realpath(bai))
+    os.rename(part, os.path.realpath(bam))
+    return digest
@@ -11,8 +11,8 @@ Tree Structure of GATK Pipeline
    3   4
    |   |
    5   6
-   |   |
-   7   8
+   |   |\
+   7   8  13
    |   |
    9   10
 
@@ -24,55 +24,303 @@ Tree Structure of GATK Pipeline
 9,10 = Recalibrate (PrintReads)
 11 = MuTect
 12 = teardown / cleanup
+13 = ContEst contamination estimate (with --popfile), alongside the tumor's BR/PR
 
-1-10, and 12 are "Target children"
+1-10, 12 and 13 are "Target children"
 11 is a "Target follow-on", it is executed after completion of children.
 
+With --targets (the exome capture kit's BED), RTC, IR, BaseRecalibrator, PrintReads and MuTect are
+restricted with -L to the kit's targets padded by --interval_padding, so they traverse a few percent
+of the genome; reads outside the padded targets are left out of the .indel.bam/.bqsr.bam.
+
+With --regions (e.g. one chromosome per run), every GATK step is restricted to them the same way, and
+normal.bam/tumor.bam are not downloaded whole: the .bai is fetched first and only the header and the
+blocks holding reads in the regions are range-fetched into a smaller, valid BAM.  See bam_slice.py.
+
+With --fuse_chains, 1-3-5-7-9 and 2-4-6-8-10 each run as a single target (process_sample) so the
+chain's intermediates never leave the node; only the final .bqsr.bam/.bai are uploaded.
+
+ContEst genotypes the normal at --popfile's population-frequency sites and reports the fraction of the
+tumor's reads that come from another individual, which MuTect takes as --fraction_contamination.  It
+runs on whichever copy of each sample's reads is on disk once the tumor is realigned, so the estimate
+is ready by the time MuTect starts.  With fused chains, or a tumor processed by another pair or run, 13
+starts beside the chains instead, on the input BAMs or the tumor's published .bqsr.bam.  MuTect only
+runs it itself if 13 failed.
+
+On multi-node batch systems every chain step from RTC to PR is issued with a watchdog target
+(speculate) beside it.  If the step runs --speculate_after times longer than expected (from run
+history or input size), or its heartbeats stop, the watchdog runs a duplicate on its own node; the
+first attempt to finish publishes and the other is stopped.  See speculation.py.
+
+A GATK/MuTect run that runs out of memory -- Java heap exhausted, or the node's OOM killer -- is retried
+in place with a larger heap, a smaller -maxInMemory or fewer threads (see autotune.adjust_for_oom).
+Once the node has nothing left to try, the target is re-issued as a child that asks the batch system
+for a node with room for the next heap size.
+
+With --cram, .indel.bam and .bqsr.bam go to S3 as CRAM encoded against reference.fasta, 40-60% fewer
+bytes to store and move, and are rebuilt as BAM (with a fresh .bai) on the node that reads them.  Their
+.bai is not stored.  See cram.py.
+
 =========================================================================
 :Directory Structure:
 
 local_dir = /mnt/
 
+With --scratch_dirs (other local volumes), sample BAMs and the .indel.bam/.bqsr.bam outputs are each
+placed on the least-loaded volume when created, behind a symlink at their usual path below local_dir,
+and every JVM gets its java.io.tmpdir the same way.  See scratch.py.
+
 # For "shared" input files
 shared_dir = <local_dir>/<script_name>/<UUID4>
 
+# For a --reference_bundle, kept across runs; its members are symlinked into shared_dir
+<local_dir>/references/<bundle version>/
+
 # For files specific to a tumor/normal pair
 pair_dir = <local_dir>/<script_name>/<UUID4>/<pair>/
     <pair> is defined as UUID-normal:UUID-tumor
 
 files are uploaded to:
-    s3://bd2k-<script>/<UUID4>/ if shared (.fai/.dict)
+    s3://bd2k-<script>/<UUID4>/ if shared
     s3://bd2k-<script>/<UUID4>/<pair> if specific to that T/N pair.
+    s3://bd2k-<script>/references/<version>/ for files derived only from the reference and known-sites
+        VCFs (.fai, .dict, .vcf.gz + .tbi, .vcf.idx).  <version> is a hash of those inputs, so these are
+        built once and reused by every later run with the same inputs; teardown leaves them alone.
+    s3://bd2k-<script>/targets/<version>/ for the padded, merged capture-kit intervals (--targets), keyed
+        by the BED, the padding and the reference version, so each kit's list is built once.
+    s3://bd2k-<script>/samples/<sample_id>/ for a sample's bqsr.bam/.bai.  <sample_id> is a hash of the
+        input BAM's content (ETag), the reference and targets versions, so a normal shared by several tumors is
+        processed once -- by whichever run claims it first -- and every MuTect reads the same copy.
+
+=========================================================================
+:Persistence Policies:
+
+Every artifact has a policy (see ARTIFACT_POLICIES) that decides whether it is uploaded:
+
+ephemeral   - .intervals, .bam.bai, .indel.bam/.bai (.indel.cram with --cram)
+              Only uploaded when its consumer may run on another node (multi-node batch system).
+checkpoint  - .fai, .dict, .padded.intervals, .recal.table, .bqsr.bam/.bai (.bqsr.cram with --cram),
+              .contamination.txt
+              Always uploaded so a failed run can resume; removed by teardown.
+deliverable - .vcf.gz, .vcf.gz.tbi, .vcf.gz.summary.json
+              Always uploaded and kept.  MuTect's calls are delivered bgzipped and tabix-indexed,
+              with a JSON summary (record/PASS counts, per-contig offsets) alongside.
+
+--upload_all restores the old behaviour of uploading everything.
+
+Uploads whose next reader is on the same node go through a background uploader (upload_queue.py), so
+the next step starts as soon as its input is on local disk.  Barriers wait for them before a file is
+deleted locally or from S3, and at the end of MuTect/teardown.  --sync_uploads turns this off.
+
+Every transfer on a node goes through one scheduler (transfer_scheduler.py): downloads a step is blocked
+on first, then synchronous uploads, then queued uploads and deletes, which wait while a blocking
+download is pending.  --max_transfers caps how many run at once and --bandwidth_cap their total rate.
+
+=========================================================================
+:Metrics:
+
+Every download, upload and tool run is logged per node under --metrics_dir (default <local_dir>/metrics),
+tagged by step and by file role (reference, sample, or the artifact's persistence policy).  Summaries
+are refreshed at most once a minute (and at teardown) in gatk_transfers.prom (Prometheus textfile format)
+and gatk_transfers.json, which also totals transfer vs compute seconds per step.  See metrics.py.
 
 =========================================================================
 :Dependencies:
 
 curl            - apt-get install curl
-samtools        - apt-get install samtools
+samtools        - apt-get install samtools (1.10 or later for --cram)
+tabix/bgzip     - apt-get install tabix
 picard-tools    - apt-get install picard-tools
 boto            - pip install boto
-FileChunkIO     - pip install FileChunkIO
 jobTree         - https://github.com/benedictpaten/jobTree
 Active Internet Connection (Boto)
 """
 
 import argparse
+import binascii
+import contextlib
+import email.utils
 import errno
+import io
 import multiprocessing
 import os
+import sqlite3
 import subprocess
 import sys
+import threading
+import time
 import uuid
 import math
-from filechunkio import FileChunkIO
+import hashlib
+import json
+import shutil
+from multiprocessing.pool import ThreadPool
+
+import autotune
+import bam_slice
+import bgzf
+import cram
+import metrics
+import preflight
+import reference_bundle
+import scratch
+import speculation
+import transfer_scheduler
+import transfers
+import upload_queue
 
 import boto
 from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
 from boto.exception import S3ResponseError
 
 from jobTree.scriptTree.stack import Stack
 from jobTree.scriptTree.target import Target
 
+EPHEMERAL = 'ephemeral'
+CHECKPOINT = 'checkpoint'
+DELIVERABLE = 'deliverable'
+
+# First matching suffix wins, so the more specific suffixes come first
+ARTIFACT_POLICIES = [('.vcf.gz.summary.json', DELIVERABLE),
+                     ('.indel.bam', EPHEMERAL),
+                     ('.indel.bai', EPHEMERAL),
+                     ('.indel.cram', EPHEMERAL),
+                     ('.bam.bai', EPHEMERAL),
+                     ('.padded.intervals', CHECKPOINT),
+                     ('.intervals', EPHEMERAL),
+                     ('.bqsr.bam', CHECKPOINT),
+                     ('.bqsr.bai', CHECKPOINT),
+                     ('.bqsr.cram', CHECKPOINT),
+                     ('.recal.table', CHECKPOINT),
+                     ('.contamination.txt', CHECKPOINT),
+                     ('.fai', CHECKPOINT),
+                     ('.dict', CHECKPOINT),
+                     ('.vcf', DELIVERABLE),
+                     ('.vcf.gz', DELIVERABLE),
+                     ('.vcf.gz.tbi', DELIVERABLE),
+                     ('.tbi', CHECKPOINT),
+                     ('.idx', CHECKPOINT)]
+
+KNOWN_SITES = ['phase', 'mills', 'dbsnp', 'cosmic']
+
+# Known sites MuTect reads as plain VCFs: it predates GATK's tabix support and cannot read the .vcf.gz
+PLAIN_SITES = ['dbsnp', 'cosmic']
+
+# Shared files that depend only on the reference/known-sites inputs (see reference_version)
+REFERENCE_ARTIFACTS = ['reference.fasta.fai', 'reference.dict'] + \
+                      ['{}.vcf{}'.format(n, ext) for n in KNOWN_SITES for ext in ('.gz', '.gz.tbi', '.idx')] + \
+                      ['{}.vcf'.format(n) for n in PLAIN_SITES]
+
+# GATK interval list built from the capture BED (see build_target_intervals)
+TARGET_INTERVALS = 'targets.padded.intervals'
+DEFAULT_INTERVAL_PADDING = 100
+
+# Per-sample outputs shared between every pair (and run) with the same input BAM (see sample_id)
+SAMPLE_ARTIFACTS = ['bqsr.bam', 'bqsr.bai']
+# Bump whenever the steps that produce SAMPLE_ARTIFACTS change, so older outputs are not reused
+SAMPLE_PROCESSING_VERSION = 1
+# A claim on a sample not renewed for this long belongs to a run that died
+CLAIM_TTL_HOURS = 6
+# How often a running step renews its sample's claim; well under the TTL, so a long step keeps it
+CLAIM_RENEW_SECONDS = 30 * 60
+CLAIM_SETTLE_SECONDS = 10
+CLAIM_POLL_SECONDS = 120
+
+
+class ClaimLost(Exception):
+    """ Another run has taken over a sample this run was processing; this run waits for its outputs instead """
+    pass
+
+
+def artifact_policy(name):
+    """
+    Returns the persistence policy for a file name.  Anything not listed is a checkpoint, which
+    preserves the old upload-everything behaviour for new artifacts until they are classified.
+    """
+    for suffix, policy in ARTIFACT_POLICIES:
+        if name.endswith(suffix):
+            return policy
+    return CHECKPOINT
+
+
+def reference_version(input_urls, checked=None):
+    """
+    Short hash identifying the reference and known-sites inputs (URL plus ETag when pre-flight found one).
+    Files derived only from these inputs are shared between runs under references/<version>/.
+    """
+    checked = checked or {}
+    names = ['reference.fasta'] + ['{}.vcf'.format(n) for n in KNOWN_SITES]
+    ident = '|'.join('{}={}:{}'.format(n, input_urls[n], (checked.get(n) or {}).get('etag')) for n in names)
+    return hashlib.md5(ident.encode('utf-8')).hexdigest()[:12]
+
+
+def targets_version(input_urls, checked=None, padding=DEFAULT_INTERVAL_PADDING, ref_version=None):
+    """
+    Short hash identifying the padded target intervals: the capture BED (URL plus ETag when pre-flight
+    found one), the padding, and the reference version whose contigs they are clipped to.
+    None when no capture BED was given.
+    """
+    if 'targets.bed' not in input_urls:
+        return None
+    checked = checked or {}
+    ident = '{}:{}|{}|{}'.format(input_urls['targets.bed'], (checked.get('targets.bed') or {}).get('etag'),
+                                 padding, ref_version)
+    return hashlib.md5(ident.encode('utf-8')).hexdigest()[:12]
+
+
+def sample_id(checked_entry, ref_version, targets=None, regions=None):
+    """
+    Content identity of an input BAM: its MD5-based ETag and size (from pre-flight), the reference and
+    targets versions, any --regions, and SAMPLE_PROCESSING_VERSION.  Pairs sharing a BAM -- e.g. one normal with several
+    tumors -- get the same id, whatever URL it came from.  None if the BAM has no usable ETag.
+    """
+    etag = transfers.normalize_etag((checked_entry or {}).get('etag'))
+    if etag is None:
+        return None
+    ident = '{}:{}:{}:{}'.format(etag, checked_entry.get('size'), ref_version, SAMPLE_PROCESSING_VERSION)
+    # Restricting to targets changes the processed BAMs; without targets the id is as it always was
+    if targets:
+        ident += ':' + targets
+    if regions:
+        ident += ':' + ','.join(regions)
+    return hashlib.md5(ident.encode('utf-8')).hexdigest()[:16]
+
+
+def pad_and_merge(bed_lines, padding, contigs):
+    """
+    Pads BED intervals by padding on each side, clips them to the contigs, and merges any that overlap
+    or touch.  Returns [(contig, start, end), ...] 1-based and inclusive (GATK's chr:start-end), in the
+    order of contigs, a list of (name, length) as in the .fai.
+    """
+    order = dict((name, i) for i, (name, _) in enumerate(contigs))
+    lengths = dict(contigs)
+    intervals, unknown = [], set()
+    for line in bed_lines:
+        if not line.strip() or line.startswith(('#', 'track', 'browser')):
+            continue
+        fields = line.split()
+        contig, start, end = fields[0], int(fields[1]), int(fields[2])
+        if contig not in lengths:
+            unknown.add(contig)
+            continue
+        intervals.append([order[contig], max(start - padding, 0), min(end + padding, lengths[contig])])
+    if unknown:
+        if not intervals:
+            raise RuntimeError('No target contig is in the reference (e.g. {}); check the chr prefix'.format(
+                sorted(unknown)[0]))
+        sys.stderr.write('Skipping targets on contigs not in the reference: {}\n'.format(
+            ', '.join(sorted(unknown))))
+
+    merged = []
+    for interval in sorted(intervals):
+        if merged and merged[-1][0] == interval[0] and interval[1] <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], interval[2])
+        else:
+            merged.append(interval)
+    # BED is 0-based and half-open
+    return [(contigs[i][0], start + 1, end) for i, start, end in merged]
+
 
 def build_parser():
     """
@@ -88,6 +336,58 @@ def build_parser():
     parser.add_argument('-c', '--cosmic', required=True, help='b37_cosmic_v54_120711.vcf URL')
     parser.add_argument('-g', '--gatk', required=True, help='GenomeAnalysisTK.jar')
     parser.add_argument('-u', '--mutect', required=True, help='Mutect.jar')
+    parser.add_argument('--targets', default=None,
+                        help='Capture kit BED URL, e.g. whole_exome_agilent_1.1_refseq_plus_3_boosters.'
+                             'targetIntervals.bed. Restricts every GATK step to the padded targets')
+    parser.add_argument('--interval_padding', type=int, default=DEFAULT_INTERVAL_PADDING,
+                        help='Bases added to each side of every target')
+    parser.add_argument('--regions', nargs='+', default=None,
+                        help='Only process reads overlapping these regions, e.g. 22 or 22:1-5000000. Just the '
+                             'needed parts of each BAM are fetched, which requires a .bai beside it')
+    parser.add_argument('--popfile', default=None,
+                        help='hg19_population_stratified_af_hapmap_3.3.vcf URL. Enables ContEst contamination '
+                             'estimation, passed to MuTect as --fraction_contamination')
+    parser.add_argument('--upload_all', action='store_true', default=False,
+                        help='Upload every intermediate to S3, including ephemeral ones')
+    parser.add_argument('--fuse_chains', action='store_true', default=False,
+                        help='Run each sample\'s index/RTC/IR/BR/PR chain as one node-local target')
+    parser.add_argument('--no_autotune', action='store_true', default=False,
+                        help='Always use the default heap/thread settings instead of tuning from run history')
+    parser.add_argument('--autotune_explore', type=float, default=autotune.DEFAULT_EXPLORE,
+                        help='Fraction of step runs that try an untried heap/thread setting next to the best '
+                             'known one, so the run history learns more than the defaults. Default: 0 (off)')
+    parser.add_argument('--reference_bundle', default=None,
+                        help='URL of a reference bundle manifest.json (see reference_bundle.py) providing the '
+                             'reference, its .fai/.dict, the VCFs with indexes, and the jars')
+    parser.add_argument('--no_index_vcfs', action='store_true', default=False,
+                        help='Do not build/fetch compressed and indexed known-sites VCFs')
+    parser.add_argument('--skip_preflight', action='store_true', default=False,
+                        help='Do not check input URLs/headers before scheduling targets')
+    parser.add_argument('--no_sample_reuse', action='store_true', default=False,
+                        help='Always process both samples, even if identical BAMs were processed before')
+    parser.add_argument('--sync_uploads', action='store_true', default=False,
+                        help='Upload every output before spawning the next step, instead of in the background')
+    parser.add_argument('--scratch_dirs', default=None,
+                        help='Comma-separated directories on other local volumes (e.g. /mnt2,/mnt3) to stripe '
+                             'large intermediates and JVM temp files across, in addition to /mnt/')
+    parser.add_argument('--max_transfers', type=int, default=transfer_scheduler.DEFAULT_MAX_ACTIVE,
+                        help='Most S3/HTTP transfers in flight at once on a node')
+    parser.add_argument('--bandwidth_cap', type=float, default=None,
+                        help='Total MB/s for all transfers on a node, shared by priority (downloads a step is '
+                             'waiting for first, background uploads last). Default: no cap')
+    parser.add_argument('--speculate_after', type=float, default=speculation.DEFAULT_FACTOR,
+                        help='Run a duplicate of a chain step on another node once it has taken this many times '
+                             'its expected runtime (multi-node batch systems only). 0 disables')
+    parser.add_argument('--cram', action='store_true', default=False,
+                        help='Store .indel.bam/.bqsr.bam in S3 as CRAM against the reference (needs samtools 1.10+); '
+                             'they are converted back to BAM when read')
+    parser.add_argument('--metrics_dir', default=None,
+                        help='Per-node directory for transfer metrics (Prometheus textfile + JSON). '
+                             'Default: <local_dir>/metrics')
+    parser.add_argument('--sweep_uploads_after', type=float, default=24,
+                        help='Abort unfinished multipart uploads in the bucket older than this many hours')
+    parser.add_argument('--history_db', default=None,
+                        help='Per-node sqlite file of past step runs. Default: <local_dir>/gatk_run_history.sqlite')
     return parser
 
 
@@ -95,403 +395,753 @@ def start_node(target, gatk):
     """
     Create .dict/.fai for reference and start children/follow-on
     """
+    metrics.set_step('start_node')
     reference = gatk.get_input_path('reference.fasta')
 
-    # Create index file for reference genome (.fai)
+    # Reuse the .fai/.dict from an earlier run with the same reference if there is one
+    for name in ['reference.fasta.fai', 'reference.dict']:
+        try:
+            gatk.get_intermediate_path(name, return_path=False)
+        except RuntimeError:
+            pass
+
+    # Create index file for reference genome (.fai) unless it came with a reference bundle
+    if not os.path.exists(reference + '.fai'):
+        try:
+            subprocess.check_call(['samtools', 'faidx', reference])
+        except subprocess.CalledProcessError:
+            raise RuntimeError('\nsamtools failed to create reference index!')
+        except OSError:
+            raise RuntimeError('\nFailed to find "samtools". \nInstall via "apt-get install samtools".')
+
+    # Create dict file for reference genome (.dict)
+    if not os.path.exists(os.path.splitext(reference)[0] + '.dict'):
+        try:
+            subprocess.check_call(['picard-tools', 'CreateSequenceDictionary',
+                                   'R={}'.format(reference),
+                                   'O={}.dict'.format(os.path.splitext(reference)[0])])
+        except subprocess.CalledProcessError:
+            raise RuntimeError('\nPicard failed to create reference dictionary')
+        except OSError:
+            raise RuntimeError('\nFailed to find "picard". \nInstall via "apt-get install picard-tools')
+
+    # Upload to S3 if required by the artifact's policy
+    gatk.publish(reference + '.fai')
+    gatk.publish(os.path.splitext(reference)[0] + '.dict')
+
+    # Padded, merged capture-kit targets, built once per kit
+    if 'targets.bed' in gatk.input_URLs:
+        build_target_intervals(gatk)
+
+    # Compressed + indexed known-sites VCFs, built once per reference version
+    if gatk.index_vcfs:
+        # Fetched up front so the threads below do not race to download them
+        gatk.get_input_path('gatk.jar')
+        pool = ThreadPool(len(KNOWN_SITES))
+        try:
+            for r in [pool.apply_async(index_known_sites, (gatk, name)) for name in KNOWN_SITES]:
+                r.get()
+        finally:
+            pool.close()
+            pool.join()
+
+    # Spawn children and follow-on
+    spawn_samples(target, gatk)
+    target.setFollowOnTargetFn(mutect, (gatk,))
+
+
+def spawn_samples(target, gatk):
+    """
+    Adds each sample's chain as a child of target.  A sample already processed by another pair or run is
+    reused; one being processed right now by another run is waited for rather than processed twice.
+
+    ContEst runs beside the chains.  A tumor chain split into steps spawns it from tumor_ir, once there
+    are realigned reads to estimate from; with a fused chain, or a tumor processed elsewhere, it starts now.
+    """
+    chained = []
+    for sample in gatk.samples_by_size():
+        if gatk.sample_ids.get(sample) is None:
+            spawn_chain(target, gatk, sample)
+            chained.append(sample)
+        elif gatk.sample_is_processed(sample):
+            sys.stderr.write('Reusing processed {} sample {}\n'.format(sample, gatk.sample_ids[sample]))
+        elif gatk.claim_sample(sample):
+            spawn_chain(target, gatk, sample)
+            chained.append(sample)
+        else:
+            target.addChildTargetFn(wait_for_sample, (gatk, sample))
+    if 'popfile.vcf' in gatk.input_URLs and (gatk.fuse_chains or 'tumor' not in chained):
+        target.addChildTargetFn(contamination, (gatk,))
+
+
+def spawn_chain(target, gatk, sample):
+    """
+    Adds the processing chain for sample ('normal' or 'tumor') as a child of target
+    """
+    if gatk.fuse_chains:
+        target.addChildTargetFn(process_sample, (gatk, sample))
+    else:
+        target.addChildTargetFn({'normal': normal_index, 'tumor': tumor_index}[sample], (gatk,))
+
+
+def wait_for_sample(target, gatk, sample):
+    """
+    Another run has claimed an identical <sample>.bam.  Checks, after CLAIM_POLL_SECONDS, whether its
+    .bqsr.bam/.bai are there, takes the sample over (spawning the chain as a child) if that run stopped
+    renewing its claim, or else re-issues itself as a follow-on, so the wait does not hold a slot.
+    """
+    metrics.set_step('wait_for_sample')
+    time.sleep(CLAIM_POLL_SECONDS)
+    if gatk.sample_is_processed(sample):
+        return
+    if gatk.claim_sample(sample):
+        spawn_chain(target, gatk, sample)
+    else:
+        target.setFollowOnTargetFn(wait_for_sample, (gatk, sample))
+
+
+def index_known_sites(gatk, name):
+    """
+    Produces <name>.vcf.gz + .tbi (bgzip/tabix) and <name>.vcf.idx (Tribble, as GATK would build on first
+    use) and publishes them under the reference prefix, along with the plain VCF itself for PLAIN_SITES so
+    MuTect fetches it from the bucket rather than its URL.  Skipped if they are already there.
+    """
+    metrics.set_step('index_known_sites')
+    artifacts = [os.path.join(gatk.shared_dir, '{}.vcf{}'.format(name, ext)) for ext in ('.gz', '.gz.tbi', '.idx')]
+    plain = os.path.join(gatk.shared_dir, '{}.vcf'.format(name))
+    published = artifacts + ([plain] if name in PLAIN_SITES else [])
+    if all(gatk.exists_in_s3(f) for f in published):
+        return
+
+    vcf = gatk.get_input_path('{}.vcf'.format(name))
+    gz, tbi, idx = artifacts
     try:
-        subprocess.check_call(['samtools', 'faidx', reference])
+        with open(gz, 'wb') as f_out:
+            subprocess.check_call(['bgzip', '-c', vcf], stdout=f_out)
+        subprocess.check_call(['tabix', '-f', '-p', 'vcf', gz])
     except subprocess.CalledProcessError:
-        raise RuntimeError('\nsamtools failed to create reference index!')
+        raise RuntimeError('bgzip/tabix failed to index {}'.format(vcf))
     except OSError:
-        raise RuntimeError('\nFailed to find "samtools". \nInstall via "apt-get install samtools".')
+        raise RuntimeError('Failed to find "bgzip"/"tabix". Install via "apt-get install tabix"')
 
-    # Create dict file for reference genome (.dict)
+    # GATK writes <vcf>.idx next to any VCF it reads as a ROD; CountRODs is the cheapest walker that does
     try:
-        subprocess.check_call(['picard-tools', 'CreateSequenceDictionary',
-                               'R={}'.format(reference),
-                               'O={}.dict'.format(os.path.splitext(reference)[0])])
+        subprocess.check_call(['java', '-Xmx4g', '-jar', gatk.get_input_path('gatk.jar'), '-T', 'CountRODs',
+                               '-R', gatk.get_input_path('reference.fasta'), '--rod', vcf])
     except subprocess.CalledProcessError:
-        raise RuntimeError('\nPicard failed to create reference dictionary')
+        raise RuntimeError('GATK failed to index {}'.format(vcf))
     except OSError:
-        raise RuntimeError('\nFailed to find "picard". \nInstall via "apt-get install picard-tools')
-
-    # upload to S3
-    gatk.upload_to_s3(reference + '.fai')
-    gatk.upload_to_s3(os.path.splitext(reference)[0] + '.dict')
+        raise RuntimeError('Failed to find "java" or gatk_jar')
 
-    # Spawn children and follow-on
-    target.addChildTargetFn(normal_index, (gatk,))
-    target.addChildTargetFn(tumor_index, (gatk,))
-    target.setFollowOnTargetFn(mutect, (gatk,))
+    for f in published:
+        gatk.publish(f)
 
 
-def normal_index(target, gatk):
+def build_target_intervals(gatk):
     """
-    Create .bai file for normal.bam
+    Produces the GATK interval list every step is restricted to: the capture BED's targets padded by
+    --interval_padding, clipped to the reference's contigs and merged.  Published under the targets
+    prefix; skipped if an earlier run already built it for this kit.
     """
-    # Retrieve input bam
-    normal = gatk.get_input_path('normal.bam')
+    metrics.set_step('build_target_intervals')
+    try:
+        gatk.get_intermediate_path(TARGET_INTERVALS, return_path=False)
+        return
+    except RuntimeError:
+        pass
+
+    with open(gatk.get_input_path('reference.fasta') + '.fai') as f:
+        contigs = [(line.split('\t')[0], int(line.split('\t')[1])) for line in f if line.strip()]
+    with open(gatk.get_input_path('targets.bed')) as f:
+        intervals = pad_and_merge(f, gatk.interval_padding, contigs)
+    if not intervals:
+        raise RuntimeError('No target intervals in {}'.format(gatk.input_URLs['targets.bed']))
+
+    output = os.path.join(gatk.shared_dir, TARGET_INTERVALS)
+    with open(output, 'w') as f:
+        for contig, start, end in intervals:
+            f.write('{}:{}-{}\n'.format(contig, start, end))
+    gatk.publish(output)
+
+
+def compress_vcf(vcf):
+    """
+    Writes <vcf>.gz as BGZF, indexes it with tabix, and writes <vcf>.gz.summary.json with the record and
+    PASS counts overall and per contig, plus each contig's first virtual offset and compressed byte range
+    so a consumer can range-request a single contig without fetching the index.  Returns the three paths.
+    """
+    gz = vcf + '.gz'
+    summary_path = gz + '.summary.json'
+    writer = bgzf.BgzfWriter(gz)
+    contigs = []
+    totals = {'records': 0, 'pass': 0}
+    with open(vcf, 'rb') as f:
+        for line in f:
+            if not line.startswith(b'#'):
+                fields = line.split(b'\t', 7)
+                contig = fields[0].decode('ascii')
+                if not contigs or contigs[-1]['contig'] != contig:
+                    contigs.append({'contig': contig, 'records': 0, 'pass': 0, 'virtual_offset': writer.tell()})
+                passed = len(fields) > 6 and fields[6] == b'PASS'
+                for counts in (contigs[-1], totals):
+                    counts['records'] += 1
+                    counts['pass'] += passed
+            writer.write(line)
+    # Virtual offset just past each contig's last record
+    ends = [c['virtual_offset'] for c in contigs[1:]] + [writer.tell()]
+    writer.close()
+    for c, end in zip(contigs, ends):
+        c['byte_range'] = [c['virtual_offset'] >> 16, writer.byte_end(end)]
 
-    # Create index file for normal.bam (.bai)
     try:
-        subprocess.check_call(['samtools', 'index', normal])
+        subprocess.check_call(['tabix', '-f', '-p', 'vcf', gz])
     except subprocess.CalledProcessError:
-        raise RuntimeError('samtools failed to index BAM')
+        raise RuntimeError('tabix failed to index {}'.format(gz))
     except OSError:
-        raise RuntimeError('Failed to find "samtools". Install via "apt-get install samtools"')
+        raise RuntimeError('Failed to find "tabix". Install via "apt-get install tabix"')
 
-    # Upload to S3
-    gatk.upload_to_s3(normal + '.bai')
+    with open(summary_path, 'w') as f:
+        json.dump(dict(totals, vcf=os.path.basename(gz), contigs=contigs), f, indent=1)
+    return gz, gz + '.tbi', summary_path
 
-    # Spawn child
-    target.addChildTargetFn(normal_rtc, (gatk,))
 
+# The GATK steps themselves.  Each one takes a sample name ('normal' or 'tumor'), fetches its inputs,
+# runs the tool, and returns the path(s) it produced without uploading anything.  The chained targets
+# below publish after every step; process_sample runs all of them back to back on one node.
 
-def tumor_index(target, gatk):
+def index_bam(gatk, sample):
     """
-    Create .bai file for tumor.bam
+    Create .bai file for <sample>.bam
     """
+    metrics.set_step('samtools_index')
+    gatk.renew_claim(sample)
     # Retrieve input bam
-    tumor = gatk.get_input_path('tumor.bam')
+    bam = gatk.get_input_path('{}.bam'.format(sample))
 
-    # Create index file for normal.bam (.bai)
+    # Create index file for <sample>.bam (.bai)
     try:
-        subprocess.check_call(['samtools', 'index', tumor])
+        subprocess.check_call(['samtools', 'index', bam])
     except subprocess.CalledProcessError:
         raise RuntimeError('samtools failed to index BAM')
     except OSError:
         raise RuntimeError('Failed to find "samtools". Install via "apt-get install samtools"')
 
-    # Upload to S3
-    gatk.upload_to_s3(tumor + '.bai')
+    return bam + '.bai'
 
-    # Spawn child
-    target.addChildTargetFn(tumor_rtc, (gatk,))
 
-
-def normal_rtc(target, gatk):
+def realigner_target_creator(gatk, sample):
     """
-    Creates normal.intervals file
+    Creates <sample>.intervals file
     """
+    metrics.set_step('RealignerTargetCreator')
+    gatk.renew_claim(sample)
     # Retrieve input files
     gatk_jar = gatk.get_input_path('gatk.jar')
     ref = gatk.get_input_path('reference.fasta')
-    phase = gatk.get_input_path('phase.vcf')
-    mills = gatk.get_input_path('mills.vcf')
-    normal = gatk.get_input_path('normal.bam')
+    phase = gatk.get_known_sites('phase')
+    mills = gatk.get_known_sites('mills')
+    bam = gatk.get_input_path('{}.bam'.format(sample))
 
     gatk.get_intermediate_path('reference.fasta.fai', return_path=False)
     gatk.get_intermediate_path('reference.dict', False)
-    gatk.get_intermediate_path('normal.bam.bai', False)
+    gatk.get_intermediate_path('{}.bam.bai'.format(sample), False)
+    targets = gatk.target_interval_args()
 
     # Output File
-    output = os.path.join(gatk.pair_dir, 'normal.intervals')
+    output = os.path.join(gatk.pair_dir, '{}.intervals'.format(sample))
+
+    def command(s):
+        return ['java', '-Xmx{}g'.format(s['heap_gb']), '-jar', gatk_jar, '-T', 'RealignerTargetCreator',
+                '-nt', str(s['threads']), '-R', ref, '-I', bam, '-known', phase,
+                '-known', mills, '--downsampling_type', 'NONE', '-o', output] + targets
 
     # Create interval file
     try:
-        subprocess.check_call(['java', '-Xmx15g', '-jar', gatk_jar, '-T', 'RealignerTargetCreator',
-                               '-nt', str(gatk.cpu_count), '-R', ref, '-I', normal, '-known', phase,
-                               '-known', mills, '--downsampling_type', 'NONE', '-o', output])
+        gatk.run_java('RealignerTargetCreator', command, [bam], output, sample=sample)
     except subprocess.CalledProcessError:
         raise RuntimeError('RealignerTargetCreator failed to finish')
     except OSError:
         raise RuntimeError('Failed to find "java" or gatk_jar')
-    # Upload to S3
-    gatk.upload_to_s3(output)
 
-    # Spawn Child
-    target.addChildTargetFn(normal_ir, (gatk,))
+    return output
 
 
-def tumor_rtc(target, gatk):
+def indel_realignment(gatk, sample):
     """
-    Creates tumor.intervals file
+    Creates realigned <sample> bams.  Returns (bam, bai).
     """
+    metrics.set_step('IndelRealigner')
+    gatk.renew_claim(sample)
     # Retrieve input files
     gatk_jar = gatk.get_input_path('gatk.jar')
     ref = gatk.get_input_path('reference.fasta')
-    phase = gatk.get_input_path('phase.vcf')
-    mills = gatk.get_input_path('mills.vcf')
-    tumor = gatk.get_input_path('tumor.bam')
+    bam = gatk.get_input_path('{}.bam'.format(sample))
+    phase = gatk.get_known_sites('phase')
+    mills = gatk.get_known_sites('mills')
 
+    intervals = gatk.get_intermediate_path('{}.intervals'.format(sample))
     gatk.get_intermediate_path('reference.fasta.fai', return_path=False)
     gatk.get_intermediate_path('reference.dict', False)
-    gatk.get_intermediate_path('tumor.bam.bai', False)
+    gatk.get_intermediate_path('{}.bam.bai'.format(sample), False)
+    targets = gatk.target_interval_args()
 
-    # Output File
-    output = os.path.join(gatk.pair_dir, 'tumor.intervals')
+    # Output file
+    output = gatk.place(os.path.join(gatk.pair_dir, '{}.indel.bam'.format(sample)), os.path.getsize(bam))
 
-    # Create interval file
+    def command(s):
+        return ['java', '-Xmx{}g'.format(s['heap_gb']), '-jar', gatk_jar, '-T', 'IndelRealigner',
+                '-R', ref, '-I', bam, '-known', phase, '-known', mills,
+                '-targetIntervals', intervals, '--downsampling_type', 'NONE',
+                '-maxReads', str(s['max_reads']), '-maxInMemory', str(s['max_in_memory']), '-o', output] + targets
+
+    # Create realigned bam
     try:
-        subprocess.check_call(['java', '-Xmx15g', '-jar', gatk_jar, '-T', 'RealignerTargetCreator',
-                               '-nt', str(gatk.cpu_count), '-R', ref, '-I', tumor, '-known', phase,
-                               '-known', mills, '--downsampling_type', 'NONE', '-o', output])
+        gatk.run_java('IndelRealigner', command, [bam], output, sample=sample)
     except subprocess.CalledProcessError:
-        raise RuntimeError('RealignerTargetCreator failed to finish')
+        raise RuntimeError('IndelRealignment failed to finish')
     except OSError:
         raise RuntimeError('Failed to find "java" or gatk_jar')
-    # Upload to S3
-    gatk.upload_to_s3(output)
 
-    # Spawn Child
-    target.addChildTargetFn(tumor_ir, (gatk,))
+    return output, os.path.splitext(output)[0] + '.bai'
 
 
-def normal_ir(target, gatk):
+def base_recalibration(gatk, sample):
     """
-    Creates realigned normal bams
+    Creates <sample> recal table
     """
+    metrics.set_step('BaseRecalibrator')
+    gatk.renew_claim(sample)
     # Retrieve input files
     gatk_jar = gatk.get_input_path('gatk.jar')
     ref = gatk.get_input_path('reference.fasta')
-    normal = gatk.get_input_path('normal.bam')
-    phase = gatk.get_input_path('phase.vcf')
-    mills = gatk.get_input_path('mills.vcf')
+    dbsnp = gatk.get_known_sites('dbsnp')
 
-    normal_intervals = gatk.get_intermediate_path('normal.intervals')
-    gatk.get_intermediate_path('reference.fasta.fai', return_path=False)
+    indel_bam = gatk.get_intermediate_path('{}.indel.bam'.format(sample))
+    gatk.get_intermediate_path('{}.indel.bai'.format(sample), return_path=False)
+    gatk.get_intermediate_path('reference.fasta.fai', False)
     gatk.get_intermediate_path('reference.dict', False)
-    gatk.get_intermediate_path('normal.bam.bai', False)
+    targets = gatk.target_interval_args()
 
     # Output file
-    output = os.path.join(gatk.pair_dir, 'normal.indel.bam')
+    output = os.path.join(gatk.pair_dir, '{}.recal.table'.format(sample))
 
-    # Create interval file
+    def command(s):
+        return ['java', '-Xmx{}g'.format(s['heap_gb']), '-jar', gatk_jar, '-T', 'BaseRecalibrator',
+                '-nct', str(s['threads']), '-R', ref, '-I', indel_bam,
+                '-knownSites', dbsnp, '-o', output] + targets
+
+    # Create recal table
     try:
-        subprocess.check_call(['java', '-Xmx15g', '-jar', gatk_jar, '-T', 'IndelRealigner',
-                               '-R', ref, '-I', normal, '-known', phase, '-known', mills,
-                               '-targetIntervals', normal_intervals, '--downsampling_type', 'NONE',
-                               '-maxReads', str(720000), '-maxInMemory', str(5400000), '-o', output])
+        gatk.run_java('BaseRecalibrator', command, [indel_bam], output, sample=sample)
     except subprocess.CalledProcessError:
-        raise RuntimeError('IndelRealignment failed to finish')
+        raise RuntimeError('BaseRecalibrator failed to finish')
     except OSError:
         raise RuntimeError('Failed to find "java" or gatk_jar')
-    # Upload to S3
-    gatk.upload_to_s3(output)
-    gatk.upload_to_s3(os.path.splitext(output)[0] + '.bai')
 
-    # Spawn Child
-    target.addChildTargetFn(normal_cleanup_bam, (gatk,))
+    return output
 
 
-def tumor_ir(target, gatk):
+def print_reads(gatk, sample):
     """
-    Creates realigned tumor bams
+    Create <sample>.bqsr.bam.  Returns (bam, bai).
     """
+    metrics.set_step('PrintReads')
+    gatk.renew_claim(sample)
     # Retrieve input files
     gatk_jar = gatk.get_input_path('gatk.jar')
     ref = gatk.get_input_path('reference.fasta')
-    tumor = gatk.get_input_path('tumor.bam')
-    phase = gatk.get_input_path('phase.vcf')
-    mills = gatk.get_input_path('mills.vcf')
 
-    tumor_intervals = gatk.get_intermediate_path('tumor.intervals')
-    gatk.get_intermediate_path('reference.fasta.fai', return_path=False)
+    indel_bam = gatk.get_intermediate_path('{}.indel.bam'.format(sample))
+    recal = gatk.get_intermediate_path('{}.recal.table'.format(sample))
+    gatk.get_intermediate_path('{}.indel.bai'.format(sample), return_path=False)
+    gatk.get_intermediate_path('reference.fasta.fai', False)
     gatk.get_intermediate_path('reference.dict', False)
-    gatk.get_intermediate_path('normal.bam.bai', False)
+    targets = gatk.target_interval_args()
 
     # Output file
-    output = os.path.join(gatk.pair_dir, 'tumor.indel.bam')
+    output = gatk.place(os.path.join(gatk.pair_dir, '{}.bqsr.bam'.format(sample)), os.path.getsize(indel_bam))
 
-    # Create interval file
+    def command(s):
+        return ['java', '-Xmx{}g'.format(s['heap_gb']), '-jar', gatk_jar, '-T', 'PrintReads',
+                '-nct', str(s['threads']), '-R', ref, '--emit_original_quals',
+                '-I', indel_bam, '-BQSR', recal, '-o', output] + targets
+
+    # Create recalibrated bam
     try:
-        subprocess.check_call(['java', '-Xmx15g', '-jar', gatk_jar, '-T', 'IndelRealigner',
-                               '-R', ref, '-I', tumor, '-known', phase, '-known', mills,
-                               '-targetIntervals', tumor_intervals, '--downsampling_type', 'NONE',
-                               '-maxReads', str(720000), '-maxInMemory', str(5400000), '-o', output])
+        gatk.run_java('PrintReads', command, [indel_bam], output, sample=sample)
     except subprocess.CalledProcessError:
-        raise RuntimeError('IndelRealignment failed to finish')
+        raise RuntimeError('PrintReads failed to finish')
     except OSError:
         raise RuntimeError('Failed to find "java" or gatk_jar')
-    # Upload to S3
-    gatk.upload_to_s3(output)
-    gatk.upload_to_s3(os.path.splitext(output)[0] + '.bai')
 
-    # Spawn Child
-    target.addChildTargetFn(tumor_cleanup_start, (gatk,))
+    return output, os.path.splitext(output)[0] + '.bai'
 
 
-def normal_cleanup_bam(target, gatk):
-    """
-    remove intermediate files to reduce storage costs and keep disk space free
+def contest(gatk, tumor_bam, normal_bam):
     """
-    # Remove locally
-    os.remove(os.path.join(gatk.pair_dir, 'normal.bam'))
-
-    target.addChildTargetFn(normal_br, (gatk,))
-
-
-def tumor_cleanup_start(target, gatk):
-    # Remove locally
-    os.remove(os.path.join(gatk.pair_dir, 'tumor.bam'))
-
-    target.addChildTargetFn(tumor_br, (gatk,))
-
-
-def normal_br(target, gatk):
-    """
-    Creates normal recal table
+    Estimates the tumor's contamination with ContEst in array-free mode (the normal is genotyped at the
+    popfile sites).  Returns the path of ContEst's report.
     """
+    metrics.set_step('ContEst')
     # Retrieve input files
     gatk_jar = gatk.get_input_path('gatk.jar')
     ref = gatk.get_input_path('reference.fasta')
-    dbsnp = gatk.get_input_path('dbsnp.vcf')
-
-    normal_indel = gatk.get_intermediate_path('normal.indel.bam')
-    gatk.get_intermediate_path('normal.indel.bai', return_path=False)
-    gatk.get_intermediate_path('reference.fasta.fai', False)
+    popfile = gatk.get_input_path('popfile.vcf')
+    gatk.get_intermediate_path('reference.fasta.fai', return_path=False)
     gatk.get_intermediate_path('reference.dict', False)
 
     # Output file
-    output = os.path.join(gatk.pair_dir, 'normal.recal.table')
+    output = os.path.join(gatk.pair_dir, 'tumor.contamination.txt')
 
-    # Create interval file
+    def command(s):
+        return ['java', '-Xmx{}g'.format(s['heap_gb']), '-jar', gatk_jar, '-T', 'ContEst', '-R', ref,
+                '-I:eval', tumor_bam, '-I:genotype', normal_bam, '--popfile', popfile, '-L', popfile,
+                '-o', output]
+
+    # Estimate contamination
     try:
-        subprocess.check_call(['java', '-Xmx7g', '-jar', gatk_jar, '-T', 'BaseRecalibrator',
-                               '-nct', str(gatk.cpu_count), '-R', ref, '-I', normal_indel,
-                               '-knownSites', dbsnp, '-o', output])
+        gatk.run_java('ContEst', command, [tumor_bam], output, concurrent=3)
     except subprocess.CalledProcessError:
-        raise RuntimeError('BaseRecalibrator failed to finish')
+        # A partial report must not be mistaken for an estimate
+        if os.path.exists(output):
+            os.remove(output)
+        raise RuntimeError('ContEst failed to finish')
     except OSError:
         raise RuntimeError('Failed to find "java" or gatk_jar')
-    # Upload to S3
-    gatk.upload_to_s3(output)
 
-    # Spawn Child
-    target.addChildTargetFn(normal_pr, (gatk,))
+    return output
 
 
-def tumor_br(target, gatk):
+def parse_contest(path):
     """
-    Creates tumor recal table
+    Returns the whole-sample (META) contamination from a ContEst report as a fraction, the unit MuTect's
+    --fraction_contamination expects (ContEst reports a percentage).  None if there is no estimate.
     """
-    # Retrieve input files
-    gatk_jar = gatk.get_input_path('gatk.jar')
-    ref = gatk.get_input_path('reference.fasta')
-    dbsnp = gatk.get_input_path('dbsnp.vcf')
+    header, meta = None, None
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if header is None:
+                if 'name' in fields and 'contamination' in fields:
+                    header = fields
+                continue
+            row = dict(zip(header, fields))
+            if row.get('name') == 'META' and (meta is None or row.get('population') == 'ALL'):
+                meta = row
+    try:
+        return min(max(float(meta['contamination']) / 100, 0.0), 1.0)
+    except (TypeError, KeyError, ValueError):
+        return None
 
-    tumor_indel = gatk.get_intermediate_path('tumor.indel.bam')
-    gatk.get_intermediate_path('tumor.indel.bai', return_path=False)
-    gatk.get_intermediate_path('reference.fasta.fai', False)
-    gatk.get_intermediate_path('reference.dict', False)
 
-    # Output file
-    output = os.path.join(gatk.pair_dir, 'tumor.recal.table')
+def _contest_link(bam):
+    # Beside the data itself, which scratch.place may have put on another volume (hard links cannot
+    # cross devices)
+    real = os.path.realpath(bam)
+    return os.path.join(os.path.dirname(real), 'contest.' + os.path.basename(real))
 
-    # Create interval file
+
+def contest_input(gatk, sample, created):
+    """
+    Hard links the most processed complete copy of sample's reads on this node -- bqsr, indel-realigned,
+    or the input BAM (downloaded if need be) -- and copies its index alongside, so the chain's cleanup
+    targets can delete their copies while ContEst reads.  A sample processed by another pair or run is
+    fetched as its published bqsr.bam.  Returns the linked BAM; every file made is appended to created.
+    """
+    if gatk.sample_ids.get(sample) and gatk.sample_is_processed(sample):
+        # Processed by another pair or run: its published bqsr.bam (then .bai, so the index is the newer)
+        gatk.get_intermediate_path('{}.bqsr.bam'.format(sample), return_path=False)
+        gatk.get_intermediate_path('{}.bqsr.bai'.format(sample), return_path=False)
+    for bam, bai in [('bqsr.bam', 'bqsr.bai'), ('indel.bam', 'indel.bai'), ('bam', 'bam.bai')]:
+        bam, bai = [os.path.join(gatk.pair_dir, '{}.{}'.format(sample, ext)) for ext in (bam, bai)]
+        link = _contest_link(bam)
+        links = [link, os.path.splitext(link)[0] + bai[len(os.path.splitext(bam)[0]):]]
+        try:
+            # An index older than its BAM belongs to a BAM still being written
+            if os.path.getmtime(bai) < os.path.getmtime(bam):
+                continue
+            os.link(os.path.realpath(bam), links[0])
+            created.append(links[0])
+            shutil.copyfile(bai, links[1])
+            created.append(links[1])
+            return link
+        except (IOError, OSError):
+            # Not produced yet, or removed by a cleanup target in the meantime
+            for f in links:
+                if f in created:
+                    os.remove(f)
+                    created.remove(f)
+
+    bam = gatk.get_input_path('{}.bam'.format(sample))
+    link = _contest_link(bam)
+    os.link(os.path.realpath(bam), link)
+    created.extend([link, link + '.bai'])
     try:
-        subprocess.check_call(['java', '-Xmx7g', '-jar', gatk_jar, '-T', 'BaseRecalibrator',
-                               '-nct', str(gatk.cpu_count), '-R', ref, '-I', tumor_indel,
-                               '-knownSites', dbsnp, '-o', output])
+        subprocess.check_call(['samtools', 'index', link])
     except subprocess.CalledProcessError:
-        raise RuntimeError('BaseRecalibrator failed to finish')
+        raise RuntimeError('samtools failed to index {}'.format(link))
     except OSError:
-        raise RuntimeError('Failed to find "java" or gatk_jar')
-    # Upload to S3
-    gatk.upload_to_s3(output)
+        raise RuntimeError('Failed to find "samtools". Install via "apt-get install samtools".')
+    return link
 
-    # Spawn Child
-    target.addChildTargetFn(tumor_pr, (gatk,))
 
+def contamination(target, gatk):
+    """
+    Estimates tumor contamination for MuTect while the chains run (see spawn_samples)
+    """
+    created = []
+    try:
+        gatk.publish(contest(gatk, contest_input(gatk, 'tumor', created), contest_input(gatk, 'normal', created)))
+    except (RuntimeError, OSError) as e:
+        # MuTect retries the estimate with its own inputs
+        sys.stderr.write('ContEst failed alongside the tumor chain: {}\n'.format(e))
+    finally:
+        for f in created:
+            if os.path.exists(f):
+                os.remove(f)
 
-def normal_pr(target, gatk):
+
+def tumor_contamination(gatk, tumor_bam, normal_bam):
     """
-    Create normal.bqsr.bam
+    MuTect's contamination fraction: parsed from the contamination target's report, or estimated now
+    from MuTect's own inputs if that target did not run or failed.  None if there is no estimate.
     """
-    # Retrieve input files
-    gatk_jar = gatk.get_input_path('gatk.jar')
-    ref = gatk.get_input_path('reference.fasta')
+    try:
+        report = gatk.get_intermediate_path('tumor.contamination.txt')
+    except RuntimeError:
+        try:
+            report = contest(gatk, tumor_bam, normal_bam)
+        except RuntimeError as e:
+            sys.stderr.write('Calling without a contamination estimate: {}\n'.format(e))
+            return None
+        gatk.publish(report)
+    return parse_contest(report)
 
-    normal_indel = gatk.get_intermediate_path('normal.indel.bam')
-    normal_recal = gatk.get_intermediate_path('normal.recal.table')
-    gatk.get_intermediate_path('normal.indel.bai', return_path=False)
-    gatk.get_intermediate_path('reference.fasta.fai', False)
-    gatk.get_intermediate_path('reference.dict', False)
 
-    # Output file
-    output = os.path.join(gatk.pair_dir, 'normal.bqsr.bam')
+def process_sample(target, gatk, sample):
+    """
+    Fused chain: index -> RTC -> IR -> BR -> PR for one sample in a single target, so every
+    intermediate stays on this node's disk.  Only <sample>.bqsr.bam/.bai are published, for MuTect.
+    A failure reruns the whole chain, so the per-step checkpoints would not be read and are skipped.
+    """
+    with rerun_if_out_of_memory(target, gatk, process_sample, (gatk, sample)), wait_if_claim_lost(target, gatk, sample):
+        index_bam(gatk, sample)
+        realigner_target_creator(gatk, sample)
+        indel_realignment(gatk, sample)
+        scratch.remove(os.path.join(gatk.pair_dir, '{}.bam'.format(sample)))
 
-    # Create interval file
-    try:
-        subprocess.check_call(['java', '-Xmx7g', '-jar', gatk_jar, '-T', 'PrintReads',
-                               '-nct', str(gatk.cpu_count), '-R', ref, '--emit_original_quals',
-                               '-I', normal_indel, '-BQSR', normal_recal, '-o', output])
-    except subprocess.CalledProcessError:
-        raise RuntimeError('PrintReads failed to finish')
-    except OSError:
-        raise RuntimeError('Failed to find "java" or gatk_jar')
+        base_recalibration(gatk, sample)
+        for f in print_reads(gatk, sample):
+            gatk.publish(f)
 
-    # Upload to S3
-    gatk.upload_to_s3(output)
-    gatk.upload_to_s3(os.path.splitext(output)[0] + '.bai')
+        scratch.remove(os.path.join(gatk.pair_dir, '{}.indel.bam'.format(sample)))
 
-    target.addChildTargetFn(normal_indel_cleaup, (gatk,))
 
+@contextlib.contextmanager
+def rerun_if_out_of_memory(target, gatk, step_target, args):
+    """
+    Runs the block; if a step in it needs more memory than this node has (autotune.NeedsBiggerNode),
+    re-issues step_target(*args) as a child that the batch system only places on a node with that much,
+    starting from the heap that was missing here.  On a single node there is nowhere else to go.
+    """
+    try:
+        yield
+    except autotune.NeedsBiggerNode as e:
+        if gatk.single_node:
+            raise RuntimeError(str(e))
+        sys.stderr.write('{}; rescheduling\n'.format(e))
+        gatk.memory_floor = dict(gatk.memory_floor, **{e.step: e.heap_gb})
+        target.addChildTargetFn(step_target, args, memory=e.memory_bytes)
 
-def tumor_pr(target, gatk):
+
+@contextlib.contextmanager
+def wait_if_claim_lost(target, gatk, sample):
     """
-    Create tumor.bqsr.bam
+    Runs the block; if another run takes sample's claim over meanwhile (ClaimLost), the rest of this
+    run's chain for it is dropped and its outputs are waited for instead
     """
-    # Retrieve input files
-    gatk_jar = gatk.get_input_path('gatk.jar')
-    ref = gatk.get_input_path('reference.fasta')
+    try:
+        yield
+    except ClaimLost as e:
+        sys.stderr.write('{}; waiting for its outputs\n'.format(e))
+        target.addChildTargetFn(wait_for_sample, (gatk, sample))
 
-    tumor_indel = gatk.get_intermediate_path('tumor.indel.bam')
-    tumor_recal = gatk.get_intermediate_path('tumor.recal.table')
-    gatk.get_intermediate_path('tumor.indel.bai', return_path=False)
-    gatk.get_intermediate_path('reference.fasta.fai', False)
-    gatk.get_intermediate_path('reference.dict', False)
 
-    # Output file
-    output = os.path.join(gatk.pair_dir, 'tumor.bqsr.bam')
+def spawn_step(target, gatk, step_target, sample, step):
+    """
+    Adds step_target as a child of target, with a watchdog alongside it that duplicates the step on
+    another node if it straggles (when speculation is on)
+    """
+    target.addChildTargetFn(step_target, (gatk,))
+    if gatk.speculation_store() is not None:
+        target.addChildTargetFn(speculate, (gatk, sample, step))
 
-    # Create interval file
+
+def speculate(target, gatk, sample, step):
+    """
+    Watchdog target for one chain step (see speculation.py)
+    """
+    metrics.set_step('speculate')
+    fn = {'RealignerTargetCreator': realigner_target_creator, 'IndelRealigner': indel_realignment,
+          'BaseRecalibrator': base_recalibration, 'PrintReads': print_reads}[step]
     try:
-        subprocess.check_call(['java', '-Xmx7g', '-jar', gatk_jar, '-T', 'PrintReads',
-                               '-nct', str(gatk.cpu_count), '-R', ref, '--emit_original_quals',
-                               '-I', tumor_indel, '-BQSR', tumor_recal, '-o', output])
-    except subprocess.CalledProcessError:
-        raise RuntimeError('PrintReads failed to finish')
-    except OSError:
-        raise RuntimeError('Failed to find "java" or gatk_jar')
+        speculation.watch(gatk, sample, step, fn, gatk.speculate_after)
+    except ClaimLost as e:
+        # The step's own target finds out too, and waits for the other run's outputs
+        sys.stderr.write('Speculative {} stopped: {}\n'.format(step, e))
+
 
-    # Upload to S3
-    gatk.upload_to_s3(output)
-    gatk.upload_to_s3(os.path.splitext(output)[0] + '.bai')
+def normal_index(target, gatk):
+    """
+    Create .bai file for normal.bam
+    """
+    with wait_if_claim_lost(target, gatk, 'normal'):
+        gatk.publish(index_bam(gatk, 'normal'))
 
-    target.addChildTargetFn(tumor_indel_cleanup, (gatk,))
+        spawn_step(target, gatk, normal_rtc, 'normal', 'RealignerTargetCreator')
 
 
-def normal_indel_cleaup(target, gatk):
+def tumor_index(target, gatk):
+    """
+    Create .bai file for tumor.bam
+    """
+    with wait_if_claim_lost(target, gatk, 'tumor'):
+        gatk.publish(index_bam(gatk, 'tumor'))
+
+        spawn_step(target, gatk, tumor_rtc, 'tumor', 'RealignerTargetCreator')
+
+
+def normal_rtc(target, gatk):
+    """
+    Creates normal.intervals file
+    """
+    with rerun_if_out_of_memory(target, gatk, normal_rtc, (gatk,)), wait_if_claim_lost(target, gatk, 'normal'):
+        speculation.run_step(gatk, 'normal', 'RealignerTargetCreator', realigner_target_creator)
+
+        spawn_step(target, gatk, normal_ir, 'normal', 'IndelRealigner')
+
+
+def tumor_rtc(target, gatk):
+    """
+    Creates tumor.intervals file
+    """
+    with rerun_if_out_of_memory(target, gatk, tumor_rtc, (gatk,)), wait_if_claim_lost(target, gatk, 'tumor'):
+        speculation.run_step(gatk, 'tumor', 'RealignerTargetCreator', realigner_target_creator)
+
+        spawn_step(target, gatk, tumor_ir, 'tumor', 'IndelRealigner')
+
+
+def normal_ir(target, gatk):
+    """
+    Creates realigned normal bams
+    """
+    with rerun_if_out_of_memory(target, gatk, normal_ir, (gatk,)), wait_if_claim_lost(target, gatk, 'normal'):
+        speculation.run_step(gatk, 'normal', 'IndelRealigner', indel_realignment)
+
+        target.addChildTargetFn(normal_cleanup_bam, (gatk,))
+
+
+def tumor_ir(target, gatk):
+    """
+    Creates realigned tumor bams
+    """
+    with rerun_if_out_of_memory(target, gatk, tumor_ir, (gatk,)), wait_if_claim_lost(target, gatk, 'tumor'):
+        speculation.run_step(gatk, 'tumor', 'IndelRealigner', indel_realignment)
+
+        target.addChildTargetFn(tumor_cleanup_start, (gatk,))
+        if 'popfile.vcf' in gatk.input_URLs:
+            target.addChildTargetFn(contamination, (gatk,))
+
+
+def normal_cleanup_bam(target, gatk):
+    """
+    remove intermediate files to reduce storage costs and keep disk space free
+    """
     # Remove locally
-    os.remove(os.path.join(gatk.pair_dir, 'normal.indel.bam'))
+    scratch.remove(os.path.join(gatk.pair_dir, 'normal.bam'))
 
-    # Remove from S3
-    conn = boto.connect_s3()
-    bucket = conn.get_bucket(gatk.bucket_name)
-    key_to_delete = [k for k in bucket.get_all_keys() if 'normal.indel.bam' in k.name][0]
-    bucket.delete_key(key_to_delete)
+    spawn_step(target, gatk, normal_br, 'normal', 'BaseRecalibrator')
 
 
-def tumor_indel_cleanup(target, gatk):
+def tumor_cleanup_start(target, gatk):
     # Remove locally
-    os.remove(os.path.join(gatk.pair_dir, 'tumor.indel.bam'))
+    scratch.remove(os.path.join(gatk.pair_dir, 'tumor.bam'))
 
-    # Remove from S3
-    conn = boto.connect_s3()
-    bucket = conn.get_bucket(gatk.bucket_name)
-    key_to_delete = [k for k in bucket.get_all_keys() if 'tumor.indel.bam' in k.name][0]
-    bucket.delete_key(key_to_delete)
+    spawn_step(target, gatk, tumor_br, 'tumor', 'BaseRecalibrator')
+
+
+def normal_br(target, gatk):
+    """
+    Creates normal recal table
+    """
+    with rerun_if_out_of_memory(target, gatk, normal_br, (gatk,)), wait_if_claim_lost(target, gatk, 'normal'):
+        speculation.run_step(gatk, 'normal', 'BaseRecalibrator', base_recalibration)
+
+        spawn_step(target, gatk, normal_pr, 'normal', 'PrintReads')
+
+
+def tumor_br(target, gatk):
+    """
+    Creates tumor recal table
+    """
+    with rerun_if_out_of_memory(target, gatk, tumor_br, (gatk,)), wait_if_claim_lost(target, gatk, 'tumor'):
+        speculation.run_step(gatk, 'tumor', 'BaseRecalibrator', base_recalibration)
+
+        spawn_step(target, gatk, tumor_pr, 'tumor', 'PrintReads')
+
+
+def normal_pr(target, gatk):
+    """
+    Create normal.bqsr.bam
+    """
+    with rerun_if_out_of_memory(target, gatk, normal_pr, (gatk,)), wait_if_claim_lost(target, gatk, 'normal'):
+        speculation.run_step(gatk, 'normal', 'PrintReads', print_reads)
+
+        target.addChildTargetFn(normal_indel_cleaup, (gatk,))
+
+
+def tumor_pr(target, gatk):
+    """
+    Create tumor.bqsr.bam
+    """
+    with rerun_if_out_of_memory(target, gatk, tumor_pr, (gatk,)), wait_if_claim_lost(target, gatk, 'tumor'):
+        speculation.run_step(gatk, 'tumor', 'PrintReads', print_reads)
+
+        target.addChildTargetFn(tumor_indel_cleanup, (gatk,))
+
+
+def normal_indel_cleaup(target, gatk):
+    # Remove locally, once any queued upload of it has finished reading it
+    indel_files = [os.path.join(gatk.pair_dir, 'normal.indel.{}'.format(ext)) for ext in ('bam', 'bai')]
+    gatk.wait_for_uploads(indel_files, retry_failed=False)
+    scratch.remove(indel_files[0])
+
+    # Remove from S3 (only present if it had to be published)
+    gatk.delete_from_s3(os.path.join(gatk.pair_dir, 'normal.indel.bam'))
+    gatk.delete_from_s3(os.path.join(gatk.pair_dir, 'normal.indel.bai'))
+
+
+def tumor_indel_cleanup(target, gatk):
+    # Remove locally, once any queued upload of it has finished reading it
+    indel_files = [os.path.join(gatk.pair_dir, 'tumor.indel.{}'.format(ext)) for ext in ('bam', 'bai')]
+    gatk.wait_for_uploads(indel_files, retry_failed=False)
+    scratch.remove(indel_files[0])
+
+    # Remove from S3 (only present if it had to be published)
+    gatk.delete_from_s3(os.path.join(gatk.pair_dir, 'tumor.indel.bam'))
+    gatk.delete_from_s3(os.path.join(gatk.pair_dir, 'tumor.indel.bai'))
 
 
 def mutect(target, gatk):
     """
     Create output VCF
     """
+    metrics.set_step('MuTect')
     # Retrieve input files
     ref = gatk.get_input_path('reference.fasta')
-    dbsnp = gatk.get_input_path('dbsnp.vcf')
-    cosmic = gatk.get_input_path('cosmic.vcf')
+    # MuTect predates GATK's tabix support, so it gets the plain VCFs with their Tribble indexes (see PLAIN_SITES)
+    dbsnp = gatk.get_known_sites('dbsnp', compressed=False)
+    cosmic = gatk.get_known_sites('cosmic', compressed=False)
     mutect_jar = gatk.get_input_path('mutect.jar')
 
     normal_bqsr = gatk.get_intermediate_path('normal.bqsr.bam')
@@ -501,6 +1151,14 @@ def mutect(target, gatk):
     gatk.get_intermediate_path('reference.fasta.fai', False)
     gatk.get_intermediate_path('reference.dict', False)
 
+    # Contamination-aware calling when a popfile was given
+    fraction = None
+    if 'popfile.vcf' in gatk.input_URLs:
+        fraction = tumor_contamination(gatk, tumor_bqsr, normal_bqsr)
+        metrics.set_step('MuTect')
+    contamination_args = [] if fraction is None else ['--fraction_contamination', str(fraction)]
+    targets = gatk.target_interval_args()
+
     # Output files
     normal_uuid = gatk.input_URLs['normal.bam'].split('/')[-1].split('.')[0]
     tumor_uuid = gatk.input_URLs['tumor.bam'].split('/')[-1].split('.')[0]
@@ -509,26 +1167,42 @@ def mutect(target, gatk):
     mut_out = os.path.join(gatk.pair_dir, 'mutect.out')
     mut_cov = os.path.join(gatk.pair_dir, 'mutect.coverage')
 
-    # Create interval file
-    try:
-        subprocess.check_call(['java', '-Xmx15g', '-jar', mutect_jar, '--analysis_type', 'MuTect',
-                               '--reference_sequence', ref, '--cosmic', cosmic, '--tumor_lod', str(10),
-                               '--dbsnp', dbsnp, '--input_file:normal', normal_bqsr,
-                               '--input_file:tumor', tumor_bqsr, '--out', mut_out,
-                               '--coverage_file', mut_cov, '--vcf', output])
-    except subprocess.CalledProcessError:
-        raise RuntimeError('Mutect failed to finish')
-    except OSError:
-        raise RuntimeError('Failed to find "java" or mutect.jar')
-    # Upload to S3
-    gatk.upload_to_s3(output)
+    def command(s):
+        return ['java', '-Xmx{}g'.format(s['heap_gb']), '-jar', mutect_jar, '--analysis_type', 'MuTect',
+                '--reference_sequence', ref, '--cosmic', cosmic, '--tumor_lod', str(10),
+                '--dbsnp', dbsnp, '--input_file:normal', normal_bqsr,
+                '--input_file:tumor', tumor_bqsr, '--out', mut_out,
+                '--coverage_file', mut_cov, '--vcf', output] + contamination_args + targets
+
+    # Call somatic mutations; a MuTect that needs more memory than this node has moves to a bigger one
+    with rerun_if_out_of_memory(target, gatk, mutect, (gatk,)):
+        try:
+            gatk.run_java('MuTect', command, [normal_bqsr, tumor_bqsr], output, concurrent=1)
+        except subprocess.CalledProcessError:
+            raise RuntimeError('Mutect failed to finish')
+        except OSError:
+            raise RuntimeError('Failed to find "java" or mutect.jar')
+        # Deliver the calls bgzipped and tabix-indexed, with a summary alongside
+        for f in compress_vcf(output):
+            gatk.publish(f)
+        os.remove(output)
 
-    # Spawn Child
-    if gatk.cleanup:
-        target.addChildTargetFn(teardown, (gatk,))
+        # The run is only finished once everything it queued for upload is durable
+        gatk.wait_for_uploads()
+
+        # Spawn Child
+        if gatk.cleanup:
+            target.addChildTargetFn(teardown, (gatk,))
 
 
 def teardown(target, gatk):
+    # Nothing may be removed while the background uploader could still be reading it
+    gatk.wait_for_uploads()
+
+    # Summaries are otherwise only refreshed by the next event, so bring this node's up to date with the run
+    if os.path.isdir(gatk.metrics_dir):
+        metrics.flush(gatk.metrics_dir)
+
     # Remove local files
     shared_files = [os.path.join(gatk.shared_dir, f) for f in os.listdir(gatk.shared_dir) if os.path.isfile(f)]
     for f in shared_files:
@@ -536,13 +1210,16 @@ def teardown(target, gatk):
 
     paired_files = [os.path.join(gatk.pair_dir, f) for f in os.listdir(gatk.pair_dir) if '.vcf' not in f]
     for f in paired_files:
-        os.remove(f)
+        scratch.remove(f)
+    scratch.remove_run(gatk.scratch_dirs, gatk.local_dir, gatk.shared_dir)
 
-    # Remove intermediate S3 files
+    # Remove intermediate S3 files from this run, keeping deliverables
     conn = boto.connect_s3()
     bucket = conn.get_bucket(gatk.bucket_name)
-    keys_to_delete = [k for k in bucket.get_all_keys() if 'tumor.vcf' not in k.name]
+    run_prefix = gatk.shared_dir[len(gatk.local_dir):].strip('//') + '/'
+    keys_to_delete = [k for k in bucket.list(prefix=run_prefix) if artifact_policy(k.name) != DELIVERABLE]
     bucket.delete_keys(keys_to_delete)
+    transfers.sweep_multipart_uploads(bucket, run_prefix)
 
 
 class SupportGATK(object):
@@ -550,18 +1227,56 @@ class SupportGATK(object):
     Class to encapsulate all necessary data structures and methods used in the pipeline.
     """
 
-    def __init__(self, input_urls, local_dir, shared_dir, pair_dir, cleanup=False):
+    def __init__(self, input_urls, local_dir, shared_dir, pair_dir, cleanup=False, single_node=False,
+                 upload_all=False, fuse_chains=False, autotune=True, history_db=None, input_sizes=None,
+                 reference_bundle=None, index_vcfs=True, reference_version=None, metrics_dir=None,
+                 sample_ids=None, async_uploads=True, interval_padding=DEFAULT_INTERVAL_PADDING,
+                 targets_version=None, scratch_dirs=None, max_transfers=transfer_scheduler.DEFAULT_MAX_ACTIVE,
+                 bandwidth=None, regions=None, speculate_after=speculation.DEFAULT_FACTOR, memory_floor=None,
+                 cram=False, autotune_explore=autotune.DEFAULT_EXPLORE):
         self.input_URLs = input_urls
         self.local_dir = local_dir
         self.shared_dir = shared_dir
         self.pair_dir = pair_dir
         self.cleanup = cleanup
+        self.single_node = single_node
+        self.upload_all = upload_all
+        self.fuse_chains = fuse_chains
+        self.autotune = autotune
+        self.autotune_explore = autotune_explore
+        self.history_db = history_db or os.path.join(local_dir, 'gatk_run_history.sqlite')
+        self.input_sizes = input_sizes or {}
+        self.reference_bundle = reference_bundle
+        self.bundle_manifest = None
+        self.index_vcfs = index_vcfs
+        self.reference_version = reference_version
+        self.metrics_dir = metrics_dir or os.path.join(local_dir, 'metrics')
+        self.sample_ids = sample_ids or {}
+        self.run_id = os.path.basename(shared_dir.rstrip('/'))
+        self.async_uploads = async_uploads
+        self.interval_padding = interval_padding
+        self.targets_version = targets_version
+        self.scratch_dirs = scratch_dirs or [local_dir]
+        self.max_transfers = max_transfers
+        self.bandwidth = bandwidth
+        self.regions = regions
+        self.speculate_after = speculate_after
+        self.memory_floor = memory_floor or {}
+        self.cram = cram
+        self.upload_spool = os.path.join(local_dir, 'upload_spool', self.run_id)
+        self.script_name = os.path.basename(__file__).split('.')[0]
         self.cpu_count = multiprocessing.cpu_count()
         self.bucket_name = 'bd2k-{}'.format(os.path.basename(__file__).split('.')[0])
+        self.max_attempts = 3
 
     def get_input_path(self, name):
         """
         Accepts filename. Downloads if not present. returns path to file.
+
+        A local copy is only trusted once its size/ETag have been verified against the URL.  Downloads
+        resume from a partial file after an interruption and only appear at the final path once verified.
+        Targets on the node asking for the same file at once share a single download.
+        With --regions, a sample BAM is only the reads overlapping them (see bam_slice.py).
         """
         # Get path to file
         shared = name != 'tumor.bam' and name != 'normal.bam'
@@ -571,54 +1286,468 @@ class SupportGATK(object):
         # Create necessary directories if not present
         self.mkdir_p(dir_path)
 
-        # Check if file exists, download if not present
-        if not os.path.exists(file_path):
-            try:
-                subprocess.check_call(['curl', '-fs', self.input_URLs[name], '-o', file_path])
-            except subprocess.CalledProcessError:
-                raise RuntimeError('\nNecessary file could not be acquired: {}. Check input URL')
-            except OSError:
-                raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+        # Shared files come from the reference bundle, if one was given and lists them, in a single parallel fetch
+        if shared and self.reference_bundle and transfers.read_sidecar(file_path) is None \
+                and name in self.bundle_members():
+            self._fetch_bundle()
+
+        # Files with a valid sidecar were verified when they were downloaded
+        if transfers.read_sidecar(file_path) is None:
+            with transfers.download_lock(file_path):
+                if transfers.read_sidecar(file_path) is None:
+                    if self.regions and not shared:
+                        self._fetch_input_regions(name, file_path)
+                    else:
+                        self._fetch_input(name, file_path, shared)
 
         assert os.path.exists(file_path)
 
         return file_path
 
+    def bundle_members(self):
+        """ Names of the files the reference bundle provides.  Its manifest is only loaded once. """
+        if self.bundle_manifest is None:
+            self.bundle_manifest = reference_bundle.load_manifest(self.reference_bundle)
+        return set(m['name'] for m in self.bundle_manifest['members'])
+
+    def _fetch_bundle(self):
+        """
+        Fetches the reference bundle into <local_dir>/references/<version>/, which every run on the node using
+        that version shares, and links its members into shared_dir
+        """
+        cache = reference_bundle.node_dir(self.local_dir, self.bundle_manifest)
+        with self.scheduler().slot(transfer_scheduler.CRITICAL, 'reference_bundle'):
+            reference_bundle.fetch(self.reference_bundle, cache, manifest=self.bundle_manifest)
+        with transfers.download_lock(os.path.join(self.shared_dir, 'reference_bundle')):
+            reference_bundle.link(self.bundle_manifest, cache, self.shared_dir)
+
+    def _fetch_input(self, name, file_path, shared):
+        """ get_input_path's download, made while holding the file's download lock """
+        url = self.input_URLs[name]
+        remote_size, remote_etag = transfers.head_url(url)
+        if not transfers.local_matches_remote(file_path, remote_size, remote_etag):
+            extra_parts = transfers.candidate_part_sizes(remote_size, remote_etag)
+            if not shared:
+                self.place(file_path, remote_size or 0)
+            try:
+                with self.transfer('download', 'http', 'reference' if shared else 'sample', name) as t:
+                    transfers.curl_download(url, file_path, extra_parts, remote_size, remote_etag, stats=t)
+            except RuntimeError:
+                raise RuntimeError('\nNecessary file could not be acquired: {}. Check input URL'.format(name))
+
+    def _fetch_input_regions(self, name, file_path):
+        """ Range-fetches the reads of a sample BAM overlapping self.regions, guided by its index """
+        url = self.input_URLs[name]
+        if os.path.lexists(file_path):
+            scratch.remove(file_path)
+        self.place(file_path, self.input_sizes.get(name, 0))
+        try:
+            with self.transfer('download', 'http', 'sample', name) as t:
+                md5 = bam_slice.fetch_regions(url, self.regions, file_path, stats=t)
+        except RuntimeError as e:
+            raise RuntimeError('\nNecessary file could not be acquired: {} ({}). Check input URL'.format(name, e))
+        transfers.write_sidecar(file_path, md5)
+
     def get_intermediate_path(self, name, return_path=True):
 
         # Get path to file
-        shared = '.fai' in name or '.dict' in name
+        shared = '.fai' in name or '.dict' in name or name in REFERENCE_ARTIFACTS or name == TARGET_INTERVALS
         dir_path = self.shared_dir if shared else self.pair_dir
         file_path = os.path.join(dir_path, name)
 
         # Create necessary directories if not present
         self.mkdir_p(dir_path)
 
-        # Check if file exists, download if not present from s3
-        if not os.path.exists(file_path):
-            try:
-                conn = boto.connect_s3()
-                bucket = conn.get_bucket(self.bucket_name)
-                k = Key(bucket)
-                k.name = file_path[len(self.local_dir):].strip('//')
-            except:
-                raise RuntimeError('Could not connect to S3 and retrieve bucket: {}'.format(self.bucket_name))
+        # The index of a BAM stored as CRAM is not stored: it is rebuilt along with the BAM
+        bam = cram.bam_for_index(name) if self.cram else None
+        if bam is not None:
+            self.get_intermediate_path(bam, return_path=False)
 
-            try:
-                k.get_contents_to_filename(file_path)
-            except:
-                raise RuntimeError('Contents from S3 could not be written to: {}'.format(file_path))
+        # Check if file exists and is verified, download from s3 if not (once per node, see get_input_path)
+        if transfers.read_sidecar(file_path) is None:
+            with transfers.download_lock(file_path):
+                if transfers.read_sidecar(file_path) is None:
+                    self._fetch_intermediate(name, file_path, shared)
 
         if return_path:
             return file_path
 
-    def upload_to_s3(self, file_path):
+    def _fetch_intermediate(self, name, file_path, shared):
+        """ get_intermediate_path's download, made while holding the file's download lock """
+        try:
+            conn = boto.connect_s3()
+            bucket = conn.get_bucket(self.bucket_name)
+            k = bucket.get_key(self.s3_key(file_path))
+        except:
+            raise RuntimeError('Could not connect to S3 and retrieve bucket: {}'.format(self.bucket_name))
+
+        cram_path = self.cram_path(file_path)
+        if k is None:
+            if not os.path.exists(file_path):
+                raise RuntimeError('Intermediate file not found locally or in S3: {}'.format(name))
+        elif cram_path is not None:
+            # Stored as CRAM: fetch it and rebuild the BAM and its index (see cram.py)
+            self._download_key(k, cram_path, shared)
+            bai = os.path.splitext(file_path)[0] + '.bai'
+            for f in (file_path, bai):
+                if os.path.lexists(f):
+                    scratch.remove(f)
+            self.place(file_path, 2 * k.size)
+            try:
+                digest = cram.to_bam(cram_path, self.cram_reference(), file_path, bai)
+            finally:
+                # Sidecars live beside the placed file, so they go before the symlink to it
+                transfers.remove_sidecar(cram_path)
+                scratch.remove(cram_path)
+            # The BAM was hashed as it was written; its index is small enough to simply read again
+            transfers.record_digest(file_path, digest)
+            transfers.record_digest(bai, transfers.digest_file(bai))
+        elif not transfers.local_matches_remote(file_path, k.size, k.etag):
+            self._download_key(k, file_path, shared)
+
+    def _download_key(self, k, file_path, shared):
+        """ Verified download of S3 key k to file_path, placed on a scratch volume unless shared """
+        name = os.path.basename(file_path)
+        part_size = int(k.get_metadata('part-size') or transfers.PART_SIZE)
+        extra_parts = [part_size] + transfers.candidate_part_sizes(k.size, k.etag)
+        if not shared:
+            self.place(file_path, k.size)
+        try:
+            with self.transfer('download', 's3', artifact_policy(name), name) as t:
+                transfers.s3_download(k, file_path, extra_parts, stats=t)
+        except RuntimeError:
+            raise RuntimeError('Contents from S3 could not be written to: {}'.format(file_path))
+
+    def samples_by_size(self):
+        """
+        ['normal', 'tumor'] ordered largest input first, so the longer chain is issued first when
+        there are fewer free slots than chains.
+        """
+        return sorted(['normal', 'tumor'], key=lambda s: -self.input_sizes.get('{}.bam'.format(s), 0))
+
+    def estimated_disk_usage(self):
+        """
+        Peak bytes a pair needs on local disk: every input, plus an .indel.bam and a .bqsr.bam per sample,
+        each roughly the size of the sample's input BAM.
+        """
+        bams = self.input_sizes.get('normal.bam', 0) + self.input_sizes.get('tumor.bam', 0)
+        return sum(self.input_sizes.values()) + 2 * bams
+
+    @staticmethod
+    def free_space(path):
+        st = os.statvfs(path)
+        return st.f_bavail * st.f_frsize
+
+    def run_java(self, step, build_command, inputs, output, concurrent=2, sample=None):
+        """
+        Runs a GATK/MuTect step with the heap/thread settings predicted to be fastest on this node (see
+        autotune.py) and records how it went.  Raises CalledProcessError on failure like check_call.
+
+        A run that runs out of memory is retried (up to max_attempts runs) with settings adjusted for
+        how it failed; when this node has nothing left to try, autotune.NeedsBiggerNode is raised.
+
+        :param build_command: fn(settings dict) -> argument list
+        :param inputs: list of input paths, whose total size the settings are chosen for
+        :param output: output path; stderr is captured next to it as <output>.log
+        :param concurrent: number of JVM steps expected to share this node
+        :param sample: sample whose claim (see claim_sample) is renewed while the tool runs
+        """
+        cores, ram_gb = autotune.node_shape()
+        input_bytes = sum(os.path.getsize(f) for f in inputs)
+        history = autotune.RunHistory(self.history_db)
+        if self.autotune:
+            settings = history.choose(step, input_bytes, cores, ram_gb, concurrent, self.autotune_explore)
+        else:
+            settings = autotune.default_settings(step, self.cpu_count)
+        # Rescheduled here because a smaller node ran out of memory: start from the heap that was missing
+        if settings['heap_gb'] < self.memory_floor.get(step, 0):
+            settings['heap_gb'] = self.memory_floor[step]
+
+        for run in range(self.max_attempts):
+            # A speculated step reports its expected runtime and progress, and stops once another attempt wins
+            attempt = getattr(self, 'attempt', None)
+            if attempt is not None:
+                attempt.begin(history.expected_runtime(step, input_bytes, settings, cores, ram_gb), output + '.log')
+
+            # JVM temp files (sorting, spilled reads) go to the least-loaded scratch volume, not /tmp
+            tmp = scratch.tmpdir(self.scratch_dirs, self.run_id)
+            cmd = build_command(settings)
+            cmd = cmd[:1] + ['-Djava.io.tmpdir={}'.format(tmp)] + cmd[1:]
+            start = time.time()
+            try:
+                # Stopped early if another attempt finished first, or another run took the sample over
+                with self.keep_claim(sample) as lost:
+                    returncode, runtime, peak_rss, oom = autotune.run_monitored(
+                        cmd, output + '.log',
+                        lambda: lost.is_set() or (attempt is not None and attempt.should_stop()))
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+            if attempt is not None and attempt.lost:
+                raise speculation.Superseded('{} was finished first by another attempt'.format(step))
+            metrics.record_compute(self.metrics_dir, step, start, start + runtime, returncode == 0)
+            try:
+                history.record(step, input_bytes, settings, cores, ram_gb, runtime, peak_rss, oom)
+            except sqlite3.Error as e:
+                sys.stderr.write('Could not record run history for {}: {}\n'.format(step, e))
+
+            if returncode == 0:
+                return
+            if not oom:
+                break
+            adjusted = autotune.adjust_for_oom(step, settings, oom, cores, ram_gb, concurrent)
+            if adjusted is None:
+                heap = autotune.next_heap(settings, oom)
+                if heap is None:
+                    break
+                raise autotune.NeedsBiggerNode(step, heap)
+            sys.stderr.write('{} ran out of memory ({}) with {}; retrying with {}\n'.format(
+                step, oom, settings, adjusted))
+            settings = adjusted
+
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+    def s3_key(self, file_path):
+        """
+        Key a local file is stored under: its path below local_dir, except for reference artifacts which
+        live under references/<reference_version>/, target intervals under targets/<targets_version>/,
+        and processed samples under samples/<sample_id>/, so they outlive the run.  With --cram, a BAM
+        stored as CRAM has a .cram key (see cram.CRAM_SUFFIXES).
+        """
+        name = os.path.basename(file_path)
+        if name in REFERENCE_ARTIFACTS and self.reference_version:
+            return '{}/references/{}/{}'.format(self.script_name, self.reference_version, name)
+        if name == TARGET_INTERVALS and self.targets_version:
+            return '{}/targets/{}/{}'.format(self.script_name, self.targets_version, name)
+        sample, _, artifact = name.partition('.')
+        if artifact in SAMPLE_ARTIFACTS and self.sample_ids.get(sample):
+            key = '{}/{}'.format(self._sample_prefix(sample), artifact)
+        else:
+            key = file_path[len(self.local_dir):].strip('//')
+        return (self.cram and cram.cram_name(key)) or key
+
+    def _sample_prefix(self, sample):
+        return '{}/samples/{}'.format(self.script_name, self.sample_ids[sample])
+
+    def sample_is_processed(self, sample):
+        """ True if the .bqsr.bam/.bai for this sample's content are already in S3 (just the .bam with --cram) """
+        paths = [os.path.join(self.pair_dir, '{}.{}'.format(sample, artifact)) for artifact in SAMPLE_ARTIFACTS]
+        return all(self.exists_in_s3(f) for f in paths if self.needs_upload(f))
+
+    def claim_sample(self, sample):
+        """
+        Tries to make this run the one that processes sample.  Returns False while another run holds a
+        live claim.  S3 has no atomic create, so the claim is written, left to settle, and read back: of
+        several runs racing for it, only the last writer finds its own id.
+        """
+        bucket = boto.connect_s3().get_bucket(self.bucket_name)
+        name = '{}/claim'.format(self._sample_prefix(sample))
+        k = bucket.get_key(name)
+        if k is not None and k.get_contents_as_string() != self.run_id:
+            age = time.time() - email.utils.mktime_tz(email.utils.parsedate_tz(k.last_modified))
+            if age < CLAIM_TTL_HOURS * 3600:
+                return False
+        bucket.new_key(name).set_contents_from_string(self.run_id)
+        time.sleep(CLAIM_SETTLE_SECONDS)
+        return bucket.get_key(name).get_contents_as_string() == self.run_id
+
+    def renew_claim(self, sample):
+        """
+        Called by every step of a sample's chain so other runs do not take the sample over.  Raises
+        ClaimLost if another run already has.
+        """
+        if not self.sample_ids.get(sample):
+            return
+        bucket = boto.connect_s3().get_bucket(self.bucket_name)
+        name = '{}/claim'.format(self._sample_prefix(sample))
+        k = bucket.get_key(name)
+        if k is not None:
+            holder = k.get_contents_as_string()
+            if holder != self.run_id:
+                raise ClaimLost('Run {} has taken over {} sample {}'.format(holder, sample, self.sample_ids[sample]))
+        bucket.new_key(name).set_contents_from_string(self.run_id)
+
+    @contextlib.contextmanager
+    def keep_claim(self, sample):
+        """
+        Renews sample's claim every CLAIM_RENEW_SECONDS from a background thread while the block runs, so
+        a step that outlasts CLAIM_TTL_HOURS is not taken over by a waiting run.  Yields a threading.Event
+        that is set if another run takes the claim over anyway; ClaimLost is then raised once the block
+        ends.  No-op if sample is None.
+        """
+        lost = threading.Event()
+        if sample is None:
+            yield lost
+            return
+        stop = threading.Event()
+        errors = []
+
+        def renew():
+            while not stop.wait(CLAIM_RENEW_SECONDS):
+                try:
+                    self.renew_claim(sample)
+                except ClaimLost as e:
+                    errors.append(e)
+                    lost.set()
+                    return
+                except Exception as e:
+                    sys.stderr.write('Could not renew the claim on {}: {}\n'.format(sample, e))
+        thread = threading.Thread(target=renew)
+        thread.daemon = True
+        thread.start()
+        try:
+            yield lost
+        finally:
+            stop.set()
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def exists_in_s3(self, file_path):
+        conn = boto.connect_s3()
+        try:
+            bucket = conn.get_bucket(self.bucket_name)
+        except S3ResponseError:
+            return False
+        return bucket.get_key(self.s3_key(file_path)) is not None
+
+    def get_known_sites(self, name, compressed=True):
+        """
+        Path to a known-sites VCF together with its index, so no GATK step has to build the index itself.
+        compressed=True gives <name>.vcf.gz (+ .tbi); otherwise <name>.vcf (+ Tribble .idx), which for
+        PLAIN_SITES comes from the copy index_known_sites published.  Falls back to the plain VCF from its URL
+        if the indexed versions were not built (--no_index_vcfs).
+        """
+        if not self.index_vcfs:
+            return self.get_input_path('{}.vcf'.format(name))
+        if compressed:
+            gz = self.get_intermediate_path('{}.vcf.gz'.format(name))
+            self.get_intermediate_path('{}.vcf.gz.tbi'.format(name), return_path=False)
+            return gz
+        if name in PLAIN_SITES:
+            vcf = self.get_intermediate_path('{}.vcf'.format(name))
+        else:
+            vcf = self.get_input_path('{}.vcf'.format(name))
+        idx = self.get_intermediate_path('{}.vcf.idx'.format(name))
+        # GATK rebuilds an index that is older than its VCF
+        if os.path.getmtime(idx) < os.path.getmtime(vcf):
+            os.utime(idx, None)
+            transfers.remove_sidecar(idx)
+        return vcf
+
+    def speculation_store(self):
+        """
+        Where attempts at a chain step heartbeat and claim it (see speculation.py), or None when steps
+        are not speculated: a single node has nowhere else to run a duplicate.
+        """
+        if not self.speculate_after or self.single_node:
+            return None
+        return speculation.S3Store(self.bucket_name, self.s3_key(os.path.join(self.pair_dir, 'speculation')))
+
+    def cram_path(self, file_path):
+        """ Local path of the CRAM copy file_path is stored as, or None if it is stored as it is """
+        return cram.cram_name(file_path) if self.cram else None
+
+    def cram_reference(self):
+        """ reference.fasta, with the .fai samtools needs beside it, for encoding and decoding CRAM """
+        reference = self.get_input_path('reference.fasta')
+        self.get_intermediate_path('reference.fasta.fai', return_path=False)
+        return reference
+
+    def place(self, file_path, size=0):
+        """ Puts a new pair file of about size bytes on the least-loaded scratch volume (see scratch.place) """
+        return scratch.place(file_path, self.local_dir, self.scratch_dirs, size)
+
+    def target_interval_args(self):
+        """
+        ['-L', <padded target intervals>] when a capture BED was given, plus ['-L', region] for each of
+        --regions (intersected with the targets); [] if neither (genome-wide)
+        """
+        args = []
+        if 'targets.bed' in self.input_URLs:
+            args += ['-L', self.get_intermediate_path(TARGET_INTERVALS)]
+        for region in self.regions or []:
+            args += ['-L', region]
+        if self.regions and 'targets.bed' in self.input_URLs:
+            args += ['--interval_set_rule', 'INTERSECTION']
+        return args
+
+    def needs_upload(self, file_path, consumed_elsewhere=True):
+        """
+        Decides whether an artifact has to go to S3.  Checkpoints and deliverables always do; an ephemeral
+        artifact only does if the target consuming it could land on a different node.
+        :param consumed_elsewhere: bool, False if every consumer runs in this same target
+        """
+        # The index of a BAM stored as CRAM would not match the rebuilt BAM, which gets a new one
+        if self.cram and cram.bam_for_index(file_path):
+            return False
+        if self.upload_all or artifact_policy(file_path) != EPHEMERAL:
+            return True
+        return consumed_elsewhere and not self.single_node
+
+    def publish(self, file_path, consumed_elsewhere=True):
+        """
+        Uploads file_path if its persistence policy requires it.  Returns True if it was uploaded (or queued).
+
+        With async_uploads the upload is handed to the node's background uploader whenever the next
+        reader of the file is certain to be on this node (single node, or consumed in this target), so
+        the next step starts right away.  A consumer that may run on another node needs the file in S3
+        before this target ends, so then the upload is synchronous.
+        """
+        if not self.needs_upload(file_path, consumed_elsewhere):
+            return False
+        if self.async_uploads and (self.single_node or not consumed_elsewhere):
+            upload_queue.enqueue(self.upload_spool, self, file_path)
+        else:
+            self.upload_to_s3(file_path)
+        return True
+
+    def wait_for_uploads(self, file_paths=None, retry_failed=True):
+        """
+        Durability barrier: returns once the given files (default: everything this run queued) are in S3.
+        Uploads the background uploader gave up on are retried here, synchronously, unless retry_failed
+        is False (e.g. the file is about to be deleted anyway).
+        """
+        if not self.async_uploads:
+            return
+        for file_path in upload_queue.wait(self.upload_spool, file_paths):
+            upload_queue.clear_failure(self.upload_spool, file_path)
+            if retry_failed and os.path.exists(file_path):
+                self.upload_to_s3(file_path)
+
+    def delete_from_s3(self, file_path):
+        """
+        Deletes the S3 copy of file_path if there is one
+        """
+        # A queued upload finishing after the delete would bring the object back
+        self.wait_for_uploads([file_path], retry_failed=False)
+        with self.scheduler().slot(transfer_scheduler.BACKGROUND, 'delete ' + os.path.basename(file_path)):
+            conn = boto.connect_s3()
+            bucket = conn.get_bucket(self.bucket_name)
+            bucket.delete_key(self.s3_key(file_path))
+
+    def upload_to_s3(self, file_path, priority=transfer_scheduler.NORMAL, key_name=None, metadata=None):
         """
         file should be the path to the file, ex:  /mnt/script/uuid4/pair/foo.vcf
         Files will be uploaded to: s3://bd2k-<script_name>/<UUID4> if shared
                               and: s3://bd2k-<script_name>/<UUID4>/<pair> if specific to that T/N pair.
+
+        The upload is skipped if S3 already holds an object with the same size and MD5 (its x-amz-meta-md5,
+        or else its ETag), and the ETag S3 returns is checked against the one computed while the bytes were
+        sent.  An object with neither is uploaded again: matching sizes alone do not make it the same file.
+        With --cram, a BAM stored as CRAM is converted and its CRAM copy uploaded instead (see cram.py).
         :param file_path: str
+        :param priority: transfer_scheduler priority; the background uploader uses BACKGROUND
+        :param key_name: str, key to upload to instead of s3_key(file_path)
+        :param metadata: dict, extra x-amz-meta-* values stored with the object
         """
+        if not os.path.exists(file_path):
+            raise RuntimeError('File at path: {}, does not exist'.format(file_path))
+
+        cram_path = self.cram_path(file_path)
+        if cram_path is not None:
+            self._upload_as_cram(file_path, cram_path, priority)
+            return
+
         # Create S3 Object
         conn = boto.connect_s3()
 
@@ -633,36 +1762,199 @@ class SupportGATK(object):
 
         # Create Key Object -- reference intermediates placed in bucket root, all else in s3://bucket/<pair>
         k = Key(bucket)
-        if not os.path.exists(file_path):
-            raise RuntimeError('File at path: {}, does not exist'.format(file_path))
 
         # Derive the virtual folder and path for S3
-        k.name = file_path[len(self.local_dir):].strip('//')
-
-        # If file_size > 1Gb then upload via multi-part
-        file_size = os.path.getsize(file_path)
-        if (file_size * 1e-9) > 1:
-            # http://boto.readthedocs.org/en/latest/s3_tut.html#storing-large-data
-            mp = bucket.initiate_multipart_upload(k.name)
-            chunk_size = 50000000
-            chunk_count = int(math.ceil(file_size / float(chunk_size)))
-            try:
-                for i in range(chunk_count):
-                    offset = chunk_size * i
-                    bytes = min(chunk_size, file_size - offset)
-                    with FileChunkIO(file_path, 'r', offset=offset, bytes=bytes) as fp:
-                        mp.upload_part_from_file(fp, part_num=i + 1)
-            except:
-                mp.cancel_upload()
-            else:
-                mp.complete_upload()
+        k.name = key_name or self.s3_key(file_path)
+
+        # Skip if the identical object is already there.  Without a sidecar, only a file small enough for a
+        # single-part upload is hashed to find out: boto would hash it before sending anyway, and reuses this
+        # digest.  A larger one is hashed as its parts are sent, so checking first would read it twice.
+        existing = bucket.get_key(k.name)
+        single_part = os.path.getsize(file_path) <= transfers.MULTIPART_THRESHOLD
+        if existing is not None and transfers.local_matches_remote(file_path, existing.size, existing.etag,
+                                                                  allow_hash=single_part, trust_size=False,
+                                                                  remote_md5=existing.get_metadata('md5')):
+            return
+
+        with self.transfer('upload', 's3', artifact_policy(file_path), os.path.basename(file_path), priority) as t:
+            for attempt in range(self.max_attempts):
+                t.retries = attempt
+                # If file_size > 1Gb then upload via multi-part
+                file_size = os.path.getsize(file_path)
+                if file_size > transfers.MULTIPART_THRESHOLD:
+                    try:
+                        local_etag, remote_etag = self._multipart_upload(bucket, k.name, file_path, file_size, t,
+                                                                         self._upload_metadata(file_path, metadata))
+                    except transfers.TransferError as e:
+                        # The parts that made it are kept; the next attempt only sends the rest
+                        sys.stderr.write('{}, retrying\n'.format(e))
+                        time.sleep(transfers.backoff(attempt))
+                        continue
+                else:
+                    # Upload to S3 directly -- boto hashes the file itself to set Content-MD5
+                    progress = [0]
+
+                    def throttle(sent, total):
+                        t.throttle(sent - progress[0])
+                        progress[0] = sent
+                    record = transfers.read_sidecar(file_path)
+                    if record is not None:
+                        md5 = (record['md5'], transfers.b64_md5(record['md5']))
+                    else:
+                        with open(file_path, 'rb') as f:
+                            md5 = k.compute_md5(f)
+                    k.metadata.update(self._upload_metadata(file_path, metadata, md5[0]))
+                    try:
+                        k.set_contents_from_filename(file_path, cb=throttle, num_cb=100, md5=md5)
+                        t.bytes += file_size
+                    except:
+                        raise RuntimeError('File at path: {}, could not be uploaded to S3'.format(file_path))
+                    local_etag, remote_etag = k.md5, k.etag
+                    if local_etag == transfers.normalize_etag(remote_etag):
+                        transfers.write_sidecar(file_path, local_etag)
+
+                if local_etag == transfers.normalize_etag(remote_etag):
+                    return
+                sys.stderr.write('ETag mismatch after uploading {}, retrying\n'.format(file_path))
+                bucket.delete_key(k.name)
+
+            raise RuntimeError('File at path: {}, could not be uploaded and verified in {} attempts'.format(
+                file_path, self.max_attempts))
+
+    def _upload_as_cram(self, file_path, cram_path, priority):
+        """
+        upload_to_s3 for a BAM stored as CRAM.  The CRAM records the MD5 of the BAM it was made from
+        (x-amz-meta-bam-md5), so a BAM whose CRAM is already stored is neither converted nor uploaded again.
+        """
+        key_name = self.s3_key(file_path)
+        bucket = boto.connect_s3().lookup(self.bucket_name)
+        existing = bucket.get_key(key_name) if bucket is not None else None
+        stored_md5 = existing.get_metadata('bam-md5') if existing is not None else None
+        record = transfers.read_sidecar(file_path)
+        if stored_md5 is not None and record is not None and record['md5'] == stored_md5:
+            return
+        self.place(cram_path, os.path.getsize(file_path) // 2)
+        try:
+            bam_digest, cram_digest = cram.to_cram(file_path, self.cram_reference(), cram_path)
+            # The BAM made here is the verified copy, so a later step on this node does not rebuild it
+            transfers.record_digest(file_path, bam_digest)
+            transfers.record_digest(cram_path, cram_digest)
+            if stored_md5 != bam_digest.md5():
+                self.upload_to_s3(cram_path, priority, key_name=key_name, metadata={'bam-md5': bam_digest.md5()})
+        finally:
+            transfers.remove_sidecar(cram_path)
+            transfers.remove_upload_state(cram_path)
+            if os.path.lexists(cram_path):
+                scratch.remove(cram_path)
 
-        else:
-            # Upload to S3 directly
+    @staticmethod
+    def _upload_metadata(file_path, metadata=None, md5=None):
+        """
+        x-amz-meta-* values for uploading file_path: metadata, plus its MD5 (md5, or from its sidecar) if
+        known, so a later upload can tell the object is the same file whatever kind of ETag S3 gives it
+        """
+        values = dict(metadata or {})
+        record = transfers.read_sidecar(file_path)
+        md5 = md5 or (record['md5'] if record is not None else None)
+        if md5 is not None:
+            values['md5'] = md5
+        return values
+
+    @staticmethod
+    def _resume_multipart(bucket, key_name, file_path):
+        """
+        Returns (MultiPartUpload, {part number: ETag}) for an unfinished upload of file_path recorded in
+        its state file, or (None, {}) if there is nothing to resume.
+        """
+        state = transfers.load_upload_state(file_path)
+        if state is None:
+            return None, {}
+        if not transfers.upload_state_is_current(state, file_path, key_name):
+            # The file changed after the upload started, so its parts are useless
             try:
-                k.set_contents_from_filename(file_path)
-            except:
-                raise RuntimeError('File at path: {}, could not be uploaded to S3'.format(file_path))
+                bucket.cancel_multipart_upload(state['key'], state['upload_id'])
+            except S3ResponseError:
+                pass
+            transfers.remove_upload_state(file_path)
+            return None, {}
+        mp = MultiPartUpload(bucket)
+        mp.key_name, mp.id = key_name, state['upload_id']
+        try:
+            parts = dict((str(part.part_number), part.etag) for part in mp)
+        except S3ResponseError:
+            # Completed, aborted, or swept since the state was written
+            transfers.remove_upload_state(file_path)
+            return None, {}
+        return mp, parts
+
+    @staticmethod
+    def _multipart_upload(bucket, key_name, file_path, file_size, stats=None, metadata=None):
+        """
+        Uploads file_path in PART_SIZE parts.  Each part is read once into memory; the same buffer is
+        hashed (for the part's Content-MD5 and the running multipart ETag) and sent.
+
+        The upload ID and each acknowledged part are saved to the file's upload state, and a failed
+        upload is left open rather than cancelled: the next call resumes it, sending only the parts S3
+        does not already have with a matching MD5.  Raises TransferError if a part fails.
+        metadata is stored with the object along with the part size.  Returns (local ETag, ETag reported by S3).
+        """
+        # http://boto.readthedocs.org/en/latest/s3_tut.html#storing-large-data
+        chunk_size = transfers.PART_SIZE
+        mp, parts = SupportGATK._resume_multipart(bucket, key_name, file_path)
+        if mp is None:
+            metadata = dict(metadata or {}, **{'part-size': str(chunk_size)})
+            mp = bucket.initiate_multipart_upload(key_name, metadata=metadata)
+        st = os.stat(file_path)
+        state = {'key': key_name, 'upload_id': mp.id, 'size': st.st_size, 'mtime': st.st_mtime,
+                 'part_size': chunk_size, 'parts': parts}
+        transfers.save_upload_state(file_path, state)
+
+        chunk_count = int(math.ceil(file_size / float(chunk_size)))
+        digest = transfers.StreamingDigest(chunk_size)
+        with open(file_path, 'rb') as f:
+            for i in range(chunk_count):
+                data = f.read(chunk_size)
+                digest.update(data)
+                part_md5 = digest.part_digests()[i]
+                part_hex = binascii.hexlify(part_md5).decode('ascii')
+                if transfers.normalize_etag(parts.get(str(i + 1))) == part_hex:
+                    continue
+                try:
+                    mp.upload_part_from_file(io.BytesIO(data), part_num=i + 1,
+                                             md5=(part_hex, transfers.b64_md5(part_hex)), size=len(data))
+                except Exception as e:
+                    raise transfers.TransferError('Part {} of {} could not be uploaded to S3 ({}); {} of {} '
+                                                  'parts are kept for resuming'.format(i + 1, file_path, e,
+                                                                                       len(parts), chunk_count))
+                parts[str(i + 1)] = part_hex
+                transfers.save_upload_state(file_path, state)
+                if stats is not None:
+                    stats.bytes += len(data)
+                    if getattr(stats, 'throttle', None) is not None:
+                        stats.throttle(len(data))
+        result = mp.complete_upload()
+        transfers.remove_upload_state(file_path)
+        local_etag = digest.etag(True)
+        if local_etag == transfers.normalize_etag(result.etag):
+            transfers.record_digest(file_path, digest)
+        return local_etag, result.etag
+
+    def scheduler(self):
+        """ This node's transfer scheduler, shared by every run on the node """
+        return transfer_scheduler.Scheduler(os.path.join(self.local_dir, 'transfer_slots'), self.max_transfers,
+                                            self.bandwidth)
+
+    @contextlib.contextmanager
+    def transfer(self, direction, source, role, name, priority=transfer_scheduler.CRITICAL):
+        """
+        Waits until the node's transfer scheduler admits the transfer, then yields a metrics.Transfer
+        recording into this node's metrics directory, whose throttle(nbytes) keeps the transfer within its
+        share of the bandwidth budget.  Downloads default to CRITICAL: a step is waiting for them.
+        """
+        with self.scheduler().slot(priority, name) as slot:
+            with metrics.Transfer(self.metrics_dir, direction, source, role, name) as t:
+                t.throttle = slot.consumed
+                yield t
 
     @staticmethod
     def mkdir_p(path):
@@ -698,24 +1990,69 @@ def main():
                   'cosmic.vcf': args.cosmic,
                   'gatk.jar': args.gatk,
                   'mutect.jar': args.mutect}
-
-    # Ensure user supplied URLs to files and that BAMs are in the appropriate format
-    for name in input_urls:
-        if ".com" not in input_urls[name]:
-            sys.stderr.write("Invalid Input: {}".format(name))
-            raise RuntimeError("Inputs must be valid URLs, please check inputs.")
-        if name == 'normal' or name == 'tumor':
-            if len(input_urls[name].split('/')[-1].split('.')) != 3:
-                raise RuntimeError('{} BAM is not in the appropriate format: \
-                UUID.normal.bam or UUID.tumor.bam'.format(name))
+    if args.popfile:
+        input_urls['popfile.vcf'] = args.popfile
+    if args.targets:
+        input_urls['targets.bed'] = args.targets
+
+    # Ensure BAMs are in the appropriate format
+    for name in ['normal.bam', 'tumor.bam']:
+        if len(input_urls[name].split('/')[-1].split('.')) != 3:
+            raise RuntimeError('{} is not in the appropriate format: \
+            UUID.normal.bam or UUID.tumor.bam'.format(name))
+
+    # Ensure every input is reachable and is what it claims to be before anything is scheduled
+    input_sizes, checked = {}, {}
+    if not args.skip_preflight:
+        try:
+            checked = preflight.run(input_urls)
+        except preflight.PreflightError as e:
+            raise RuntimeError('Inputs failed pre-flight checks: {}'.format(e))
+        input_sizes = dict((name, checked[name]['size']) for name in checked if checked[name]['size'])
 
     # Create directories for shared files and for isolating pairs
     shared_dir = os.path.join(local_dir, os.path.basename(__file__).split('.')[0], str(uuid.uuid4()))
     pair_dir = os.path.join(shared_dir, input_urls['normal.bam'].split('/')[-1].split('.')[0] +
                             '-normal:' + input_urls['tumor.bam'].split('/')[-1].split('.')[0] + '-tumor')
 
-    # Create SupportGATK instance
-    gatk = SupportGATK(input_urls, local_dir, shared_dir, pair_dir, cleanup=True)
+    # Create SupportGATK instance.  With singleMachine every target shares one disk, so ephemeral
+    # intermediates never need to leave it.
+    single_node = getattr(args, 'batchSystem', 'singleMachine') == 'singleMachine'
+    # Scratch volumes, local_dir first; directories sharing a device with an earlier one are dropped
+    scratch_dirs = scratch.volumes([local_dir] + (args.scratch_dirs.split(',') if args.scratch_dirs else []))
+
+    version = reference_version(input_urls, checked)
+    targets = targets_version(input_urls, checked, args.interval_padding, version)
+    sample_ids = {}
+    if not args.no_sample_reuse:
+        sample_ids = dict((s, sample_id(checked.get('{}.bam'.format(s)), version, targets, args.regions))
+                          for s in ('normal', 'tumor'))
+    gatk = SupportGATK(input_urls, local_dir, shared_dir, pair_dir, cleanup=True, single_node=single_node,
+                       upload_all=args.upload_all, fuse_chains=args.fuse_chains,
+                       autotune=not args.no_autotune, history_db=args.history_db, input_sizes=input_sizes,
+                       reference_bundle=args.reference_bundle, index_vcfs=not args.no_index_vcfs,
+                       reference_version=version, metrics_dir=args.metrics_dir, sample_ids=sample_ids,
+                       async_uploads=not args.sync_uploads, interval_padding=args.interval_padding,
+                       targets_version=targets, scratch_dirs=scratch_dirs, max_transfers=args.max_transfers,
+                       bandwidth=args.bandwidth_cap * 1e6 if args.bandwidth_cap else None, regions=args.regions,
+                       speculate_after=args.speculate_after, cram=args.cram,
+                       autotune_explore=args.autotune_explore)
+
+    # On a single node everything lands on the scratch volumes, so make sure it fits before starting
+    if single_node and input_sizes:
+        needed, free = gatk.estimated_disk_usage(), sum(gatk.free_space(v) for v in scratch_dirs)
+        if needed > free:
+            raise RuntimeError('{} needs ~{:.1f} GB but only {:.1f} GB is free'.format(', '.join(scratch_dirs),
+                                                                                      needed / 1e9, free / 1e9))
+
+    # Abort multipart uploads orphaned by earlier runs that never finished or resumed them
+    try:
+        swept = transfers.sweep_multipart_uploads(boto.connect_s3().get_bucket(gatk.bucket_name),
+                                                  max_age_hours=args.sweep_uploads_after)
+        if swept:
+            sys.stderr.write('Aborted {} orphaned multipart upload(s)\n'.format(swept))
+    except S3ResponseError:
+        pass
 
     # Create JobTree Stack
     i = Stack(Target.makeTargetFn(start_node, (gatk,))).startJobTree(args)
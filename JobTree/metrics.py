@@ -0,0 +1,223 @@
+# John Vivian
+# 10-19-26
+
+"""
+Per-node transfer metrics for the S3 and HTTP I/O done by SupportGATK.
+
+Every transfer (and every tool run, for comparison) appends one JSON line to <metrics_dir>/events.jsonl:
+
+    {kind, direction, source, step, role, name, bytes, start, end, retries, ok}
+
+kind is 'transfer' or 'compute'.  At most every SUMMARY_SECONDS, and whenever flush() is called, the log
+is summarised, grouped by (kind, direction, source, step, role), into two files that are replaced atomically:
+
+    gatk_transfers.prom  -- Prometheus textfile-collector format (point node_exporter at metrics_dir)
+    gatk_transfers.json  -- the same summary, plus per-step I/O vs compute seconds
+
+Concurrency is derived from the log itself: for each transfer, the number of transfers on this node
+whose [start, end) overlapped its start.  Targets run in separate processes, so nothing else is shared.
+Once the log passes ROTATE_BYTES it is moved to events.jsonl.1 (replacing the one before) and the
+summaries start again from zero, which Prometheus treats as an ordinary counter reset.
+
+The step is set by the pipeline with set_step() before a step fetches its inputs, so a step's
+downloads, its tool run, and the upload of its outputs are all tagged with the same name.
+"""
+
+import bisect
+import errno
+import fcntl
+import json
+import os
+import tempfile
+import time
+
+EVENTS_FILE = 'events.jsonl'
+PROM_FILE = 'gatk_transfers.prom'
+JSON_FILE = 'gatk_transfers.json'
+LOCK_FILE = '.summaries.lock'
+
+# Least time between two summaries of the log, and the size at which the log is rotated
+SUMMARY_SECONDS = 60
+ROTATE_BYTES = 64 * 1024 * 1024
+
+_GROUP_FIELDS = ('kind', 'direction', 'source', 'step', 'role')
+
+_step = 'unknown'
+
+
+def set_step(step):
+    """ Tags every event recorded by this process from now on with step """
+    global _step
+    _step = step
+
+
+def current_step():
+    return _step
+
+
+class Transfer(object):
+    """
+    Context manager timing one transfer.  The body sets .bytes (bytes actually moved) and, if the
+    transfer retried, .retries; an exception leaving the block records the transfer as failed.
+    With metrics_dir None nothing is recorded.
+    """
+
+    def __init__(self, metrics_dir, direction, source, role, name):
+        self.metrics_dir = metrics_dir
+        self.direction = direction
+        self.source = source
+        self.role = role
+        self.name = name
+        self.bytes = 0
+        self.retries = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        record(self.metrics_dir, {'kind': 'transfer', 'direction': self.direction, 'source': self.source,
+                                  'role': self.role, 'name': self.name, 'bytes': self.bytes,
+                                  'start': self.start, 'end': time.time(), 'retries': self.retries,
+                                  'ok': exc_type is None})
+        return False
+
+
+def record_compute(metrics_dir, step, start, end, ok=True):
+    """ Records a tool run so transfer time can be compared with compute time per step """
+    record(metrics_dir, {'kind': 'compute', 'direction': None, 'source': None, 'role': None, 'name': step,
+                         'step': step, 'bytes': 0, 'start': start, 'end': end, 'retries': 0, 'ok': ok})
+
+
+def record(metrics_dir, event):
+    """ Appends event to the node's log and refreshes the summaries if they are due.  Never raises. """
+    if metrics_dir is None:
+        return
+    event.setdefault('step', _step)
+    try:
+        if not os.path.isdir(metrics_dir):
+            os.makedirs(metrics_dir)
+        # A single short O_APPEND write, so concurrent targets on the node do not interleave lines
+        with open(os.path.join(metrics_dir, EVENTS_FILE), 'a') as f:
+            f.write(json.dumps(event, sort_keys=True) + '\n')
+        try:
+            age = time.time() - os.path.getmtime(os.path.join(metrics_dir, JSON_FILE))
+        except OSError:
+            age = None
+        if age is None or age >= SUMMARY_SECONDS:
+            flush(metrics_dir, wait=False)
+    except (IOError, OSError):
+        pass
+
+
+def flush(metrics_dir, wait=True):
+    """
+    Summarises the log now, rotating it first if it has grown past ROTATE_BYTES.  Only one process on the
+    node summarises at a time; without wait, a process that finds another one doing it leaves it to them.
+    Returns the summary, or None if it was left to another process.
+    """
+    with open(os.path.join(metrics_dir, LOCK_FILE), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+        events = os.path.join(metrics_dir, EVENTS_FILE)
+        if os.path.exists(events) and os.path.getsize(events) > ROTATE_BYTES:
+            os.rename(events, events + '.1')
+        return write_summaries(metrics_dir)
+
+
+def load_events(metrics_dir):
+    events = []
+    try:
+        with open(os.path.join(metrics_dir, EVENTS_FILE)) as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+    except IOError:
+        pass
+    return events
+
+
+def _concurrency(transfers):
+    """ For each transfer, how many transfers (itself included) were in flight when it started """
+    starts = sorted(t['start'] for t in transfers)
+    ends = sorted(max(t['end'], t['start']) for t in transfers)
+    # Started at or before t's start, less those already over by then; a zero-length t counts itself
+    return [bisect.bisect_right(starts, t['start']) - bisect.bisect_right(ends, t['start']) +
+            (1 if t['end'] <= t['start'] else 0) for t in transfers]
+
+
+def summarize(events):
+    """
+    Returns {'groups': [...], 'steps': {...}}.  Each group aggregates events sharing _GROUP_FIELDS;
+    steps maps a step name to its total transfer and compute seconds.
+    """
+    transfers = [e for e in events if e['kind'] == 'transfer']
+    concurrency = dict((id(t), c) for t, c in zip(transfers, _concurrency(transfers)))
+
+    groups = {}
+    for e in events:
+        key = tuple(e.get(f) for f in _GROUP_FIELDS)
+        g = groups.setdefault(key, dict(zip(_GROUP_FIELDS, key), count=0, failures=0, bytes=0, seconds=0.0,
+                                        retries=0, max_concurrency=0, _concurrency_sum=0))
+        g['count'] += 1
+        g['failures'] += 0 if e['ok'] else 1
+        g['bytes'] += e['bytes']
+        g['seconds'] += max(e['end'] - e['start'], 0)
+        g['retries'] += e['retries']
+        c = concurrency.get(id(e), 0)
+        g['max_concurrency'] = max(g['max_concurrency'], c)
+        g['_concurrency_sum'] += c
+    for g in groups.values():
+        g['mean_concurrency'] = g.pop('_concurrency_sum') / float(g['count'])
+        g['throughput_bytes_per_second'] = g['bytes'] / g['seconds'] if g['seconds'] else 0.0
+
+    steps = {}
+    for e in events:
+        s = steps.setdefault(e.get('step'), {'transfer_seconds': 0.0, 'compute_seconds': 0.0})
+        s['{}_seconds'.format(e['kind'])] += max(e['end'] - e['start'], 0)
+    return {'groups': sorted(groups.values(), key=lambda g: [str(g[f]) for f in _GROUP_FIELDS]), 'steps': steps}
+
+
+def _labels(group):
+    return ','.join('{}="{}"'.format(f, group[f]) for f in _GROUP_FIELDS if group[f] is not None)
+
+
+def prometheus_text(summary):
+    """ The summary in Prometheus text exposition format """
+    metrics = [('gatk_transfer_bytes_total', 'counter', 'Bytes moved', 'bytes'),
+               ('gatk_transfer_seconds_total', 'counter', 'Wall-clock seconds spent', 'seconds'),
+               ('gatk_transfer_count_total', 'counter', 'Transfers or tool runs', 'count'),
+               ('gatk_transfer_failures_total', 'counter', 'Transfers that raised', 'failures'),
+               ('gatk_transfer_retries_total', 'counter', 'Retried attempts', 'retries'),
+               ('gatk_transfer_throughput_bytes_per_second', 'gauge', 'bytes / seconds',
+                'throughput_bytes_per_second'),
+               ('gatk_transfer_max_concurrency', 'gauge', 'Most transfers in flight at once', 'max_concurrency')]
+    lines = []
+    for metric, kind, help_text, field in metrics:
+        lines.append('# HELP {} {}'.format(metric, help_text))
+        lines.append('# TYPE {} {}'.format(metric, kind))
+        for g in summary['groups']:
+            lines.append('{}{{{}}} {}'.format(metric, _labels(g), g[field]))
+    return '\n'.join(lines) + '\n'
+
+
+def _replace(path, text):
+    # A private temp file per writer, since several targets may refresh the summaries at once
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path))
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, path)
+
+
+def write_summaries(metrics_dir):
+    summary = summarize(load_events(metrics_dir))
+    _replace(os.path.join(metrics_dir, PROM_FILE), prometheus_text(summary))
+    _replace(os.path.join(metrics_dir, JSON_FILE), json.dumps(summary, indent=1, sort_keys=True))
+    return summary
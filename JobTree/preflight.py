@@ -0,0 +1,169 @@
+# John Vivian
+# 10-19-26
+
+"""
+Pre-flight validation of the pipeline's input URLs, run from main() before any target is scheduled.
+
+All inputs are checked concurrently.  For each one a HEAD request establishes that it is reachable and
+records its size, ETag and Content-Type; then a small range request reads just enough of the file to
+check what it is:
+
+    .bam    -- BGZF magic, then the BAM header's reference list (contig names and lengths)
+    .fasta  -- the reference's .fai if it sits next to it, otherwise the first '>' line
+    .vcf    -- '##fileformat=VCF' and any ##contig lines
+    .jar    -- zip magic
+
+Finally the contigs of the BAMs, the reference and the VCFs are compared, so a BAM aligned to a
+different build or a chr-prefixed VCF is caught in seconds rather than hours into a child target.
+"""
+
+import re
+import sys
+from multiprocessing.pool import ThreadPool
+
+import bgzf
+import transfers
+
+# Content-Types that mean the server sent an error page instead of the file
+BAD_CONTENT_TYPES = ('text/html',)
+RANGE_STEPS = [64 * 1024, 1024 * 1024, 8 * 1024 * 1024]
+
+_CONTIG_RE = re.compile(r'##contig=<ID=([^,>]+)(?:,length=(\d+))?')
+
+
+class PreflightError(RuntimeError):
+    pass
+
+
+def _kind(name):
+    for ext in ('.bam', '.fasta', '.vcf', '.jar'):
+        if name.endswith(ext):
+            return ext[1:]
+    return None
+
+
+def bam_contigs(url):
+    """ [(name, length), ...] from the header of a remote BAM, reading as little as possible """
+    for length in RANGE_STEPS:
+        data = transfers.range_get(url, 0, length)
+        if not bgzf.is_bgzf(data):
+            raise PreflightError('Not a BGZF-compressed BAM: {}'.format(url))
+        try:
+            return bgzf.parse_bam_header(bgzf.decompress(data))[1]
+        except bgzf.IncompleteData:
+            if len(data) < length:
+                raise PreflightError('BAM ends inside its header: {}'.format(url))
+    raise PreflightError('BAM header larger than {} bytes: {}'.format(RANGE_STEPS[-1], url))
+
+
+def fasta_contigs(url):
+    """
+    [(name, length), ...] from the .fai next to the reference if there is one.  Otherwise only the first
+    contig name is known (length None), which is still enough to catch a chr-prefix mismatch.
+    """
+    headers = transfers.head_headers(url + '.fai')
+    if headers and headers.get('status') == '200':
+        fai = transfers.range_get(url + '.fai', 0, RANGE_STEPS[-1]).decode('ascii', 'replace')
+        return [(f[0], int(f[1])) for f in (line.split('\t') for line in fai.splitlines()) if len(f) > 1]
+    head = transfers.range_get(url, 0, 4096).decode('ascii', 'replace')
+    if not head.startswith('>'):
+        raise PreflightError('Reference does not look like FASTA: {}'.format(url))
+    return [(head[1:].split()[0], None)]
+
+
+def vcf_contigs(url):
+    head = transfers.range_get(url, 0, RANGE_STEPS[0]).decode('ascii', 'replace')
+    if not head.startswith('##fileformat=VCF'):
+        raise PreflightError('Not a VCF (missing ##fileformat): {}'.format(url))
+    return [(m.group(1), int(m.group(2)) if m.group(2) else None) for m in _CONTIG_RE.finditer(head)]
+
+
+def check_input(name, url):
+    """
+    Checks a single input.  Returns a dict with size, etag, content_type and contigs (None where
+    it does not apply).  Raises PreflightError.
+    """
+    if not re.match(r'^(https?|ftp)://', url):
+        raise PreflightError('{}: not an http(s)/ftp URL: {}'.format(name, url))
+    headers = transfers.head_headers(url)
+    if headers is None:
+        raise PreflightError('{}: unreachable: {}'.format(name, url))
+    content_type = headers.get('content-type', '').split(';')[0].strip().lower()
+    if content_type in BAD_CONTENT_TYPES:
+        raise PreflightError('{}: server returned {} instead of the file: {}'.format(name, content_type, url))
+    size = headers.get('content-length')
+    size = int(size) if size and size.isdigit() else None
+    if size == 0:
+        raise PreflightError('{}: is empty: {}'.format(name, url))
+
+    kind = _kind(name)
+    contigs = None
+    if kind == 'bam':
+        contigs = bam_contigs(url)
+    elif kind == 'fasta':
+        contigs = fasta_contigs(url)
+    elif kind == 'vcf':
+        contigs = vcf_contigs(url)
+    elif kind == 'jar':
+        if transfers.range_get(url, 0, 4)[:4] != b'PK\x03\x04':
+            raise PreflightError('{}: not a jar: {}'.format(name, url))
+    return {'size': size, 'etag': headers.get('etag'), 'content_type': content_type, 'contigs': contigs}
+
+
+def _has_chr(contigs):
+    return bool(contigs) and contigs[0][0].startswith('chr')
+
+
+def check_contigs(results):
+    """
+    Compares contigs between inputs.  BAMs must match the reference exactly (names and lengths) on
+    every contig they share; VCFs and the first reference contig must agree on the 'chr' convention.
+    Returns a list of problems (empty if all is well).
+    """
+    problems = []
+    ref = results.get('reference.fasta', {}).get('contigs')
+    if not ref:
+        return problems
+    ref_lengths = dict((n, l) for n, l in ref if l is not None)
+    for name, result in sorted(results.items()):
+        contigs = result.get('contigs')
+        if not contigs or name == 'reference.fasta':
+            continue
+        if _has_chr(contigs) != _has_chr(ref):
+            problems.append('{} and reference.fasta disagree on "chr" contig prefixes ({} vs {})'.format(
+                name, contigs[0][0], ref[0][0]))
+            continue
+        if name.endswith('.bam') and ref_lengths:
+            missing = [n for n, l in contigs if n not in ref_lengths]
+            wrong = [n for n, l in contigs if n in ref_lengths and l is not None and ref_lengths[n] != l]
+            if missing or wrong:
+                problems.append('{} was not aligned to this reference: {} contigs missing, {} with different '
+                                'lengths (e.g. {})'.format(name, len(missing), len(wrong), (missing + wrong)[0]))
+    return problems
+
+
+def run(input_urls, threads=None):
+    """
+    Checks every input concurrently.  Returns {name: result dict} or raises PreflightError listing
+    everything that is wrong.
+    """
+    names = sorted(input_urls)
+    pool = ThreadPool(threads or len(names))
+    try:
+        async_results = [(name, pool.apply_async(check_input, (name, input_urls[name]))) for name in names]
+        results, problems = {}, []
+        for name, r in async_results:
+            try:
+                results[name] = r.get()
+            except (PreflightError, RuntimeError) as e:
+                problems.append(str(e))
+    finally:
+        pool.close()
+        pool.join()
+
+    problems.extend(check_contigs(results))
+    if problems:
+        for p in problems:
+            sys.stderr.write('Preflight: {}\n'.format(p))
+        raise PreflightError('{} input problem(s) found, see above'.format(len(problems)))
+    return results
@@ -0,0 +1,237 @@
+#!/usr/bin/env python2.7
+# John Vivian
+# 10-19-26
+
+"""
+Provisions a node with the pipeline's tools and data: the parallel, verified replacement for the
+serial wgets in AMI_setup.sh.
+
+The manifest (provision_manifest.json, built from Data_&_Tool_URL_Repository) lists:
+
+    packages   -- apt-get packages, installed while the downloads run (--apt)
+    pip        -- python packages, likewise
+    artifacts  -- [{name, dir, md5, sources: [{url, transform}]}]
+
+Every artifact is fetched concurrently into <root>/<dir>/<name>.  Sources are tried in order, so an
+in-region mirror can come first and the upstream original after it.  A source's transform is applied
+while the bytes stream in, with no intermediate file:
+
+    gunzip            -- decompress (gzip or bgzip)
+    gunzip_strip_chr  -- decompress and strip a leading 'chr' from every line (b37 contig names)
+
+Plain downloads resume after an interruption and are checked against the server's ETag (see
+transfers.py); transformed ones are checked against the ETag of the compressed stream.  Every result is
+checked against the manifest's md5 when it has one.  An artifact whose verified copy (sidecar) is
+already there with that md5 is skipped, so re-running is cheap.  --record fills in missing md5s from
+what was fetched; run it once on a node whose fetch is trusted and commit the manifest, since until then
+an artifact without an md5 is only as trustworthy as the server's ETag (every run lists these).
+
+    python provision.py --root /home/ubuntu [--apt] [--record] [--threads 8]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import transfers
+
+DEFAULT_MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'provision_manifest.json')
+TRANSFORMS = (None, 'gunzip', 'gunzip_strip_chr')
+
+
+class GunzipWriter(object):
+    """
+    File-like object that decompresses the gzip stream written to it (any number of members, as bgzip
+    writes) into out, optionally stripping a leading 'chr' from each line.
+    """
+
+    def __init__(self, out, strip_chr=False):
+        self.out = out
+        self.strip_chr = strip_chr
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.pending = b''
+
+    def write(self, data):
+        while data:
+            self._emit(self.decompressor.decompress(data))
+            data = self.decompressor.unused_data
+            if data:
+                # The next gzip member starts here
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _emit(self, text):
+        if not self.strip_chr:
+            self.out.write(text)
+            return
+        lines = (self.pending + text).split(b'\n')
+        self.pending = lines.pop()
+        if lines:
+            self.out.write(b''.join(l[3:] + b'\n' if l.startswith(b'chr') else l + b'\n' for l in lines))
+
+    def close(self):
+        self._emit(self.decompressor.flush())
+        if self.pending:
+            self.out.write(self.pending[3:] if self.pending.startswith(b'chr') else self.pending)
+            self.pending = b''
+
+
+def _transformed_download(url, path, transform):
+    """ Streams url through transform into path.  Returns the StreamingDigest of what was written. """
+    remote_size, remote_etag = transfers.head_url(url)
+    part = transfers.partial_path(path)
+    source_digest = transfers.StreamingDigest(transfers.PART_SIZE,
+                                              transfers.candidate_part_sizes(remote_size, remote_etag))
+    output_digest = transfers.StreamingDigest(transfers.PART_SIZE)
+    try:
+        proc = subprocess.Popen(['curl', '-fsL', url], stdout=subprocess.PIPE)
+    except OSError:
+        raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+    with open(part, 'wb') as f:
+        writer = GunzipWriter(transfers.HashingWriter(f, output_digest), strip_chr=transform == 'gunzip_strip_chr')
+        try:
+            for chunk in iter(lambda: proc.stdout.read(transfers.READ_SIZE), b''):
+                source_digest.update(chunk)
+                writer.write(chunk)
+            writer.close()
+        except zlib.error as e:
+            proc.kill()
+            raise RuntimeError('{} is not valid gzip: {}'.format(url, e))
+    if proc.wait() != 0 or not transfers.verify(source_digest, remote_size, remote_etag):
+        os.remove(part)
+        raise RuntimeError('Download of {} failed or did not match its ETag'.format(url))
+    os.rename(part, path)
+    transfers.write_sidecar(path, output_digest.md5())
+    return output_digest
+
+
+def _download(url, path):
+    """ Resumable, ETag-verified download.  Returns the StreamingDigest. """
+    remote_size, remote_etag = transfers.head_url(url)
+    if remote_size is None:
+        raise RuntimeError('{} is unreachable'.format(url))
+    return transfers.curl_download(url, path, transfers.candidate_part_sizes(remote_size, remote_etag),
+                                   remote_size, remote_etag)
+
+
+def provision_artifact(artifact, root):
+    """
+    Makes <root>/<dir>/<name> a verified copy of the artifact.  Returns (status, md5, seconds), status
+    being 'present' or the URL it was fetched from.  Raises RuntimeError if no source worked.
+    """
+    start = time.time()
+    dest = os.path.join(root, artifact['dir'])
+    path = os.path.join(dest, artifact['name'])
+    if not os.path.isdir(dest):
+        try:
+            os.makedirs(dest)
+        except OSError:
+            if not os.path.isdir(dest):
+                raise
+    expected = artifact.get('md5')
+    record = transfers.read_sidecar(path)
+    if record and expected in (None, record['md5']):
+        return 'present', record['md5'], time.time() - start
+
+    errors = []
+    for source in artifact['sources']:
+        transform = source.get('transform')
+        if transform not in TRANSFORMS:
+            raise RuntimeError('{}: unknown transform {}'.format(artifact['name'], transform))
+        try:
+            if transform is None:
+                md5 = _download(source['url'], path).md5()
+            else:
+                md5 = _transformed_download(source['url'], path, transform).md5()
+        except RuntimeError as e:
+            errors.append(str(e))
+            continue
+        if expected and md5 != expected:
+            os.remove(path)
+            transfers.remove_sidecar(path)
+            errors.append('{}: md5 {} does not match the manifest ({})'.format(source['url'], md5, expected))
+            continue
+        return source['url'], md5, time.time() - start
+    raise RuntimeError('Could not provision {}: {}'.format(artifact['name'], '; '.join(errors)))
+
+
+def install_packages(manifest):
+    """ apt-get and pip installs; run alongside the downloads since neither needs the other """
+    if manifest.get('packages'):
+        subprocess.check_call(['sudo', 'apt-get', 'update', '-y'])
+        subprocess.check_call(['sudo', 'apt-get', 'install', '-y'] + manifest['packages'])
+    if manifest.get('pip'):
+        subprocess.check_call(['sudo', 'pip', 'install'] + manifest['pip'])
+
+
+def provision(manifest, root, threads=8, apt=False):
+    """
+    Provisions every artifact (and, with apt, the packages) concurrently.
+    Returns ({name: (status, md5, seconds)}, {name: error}).
+    """
+    pool = ThreadPool(threads + (1 if apt else 0))
+    try:
+        packages = pool.apply_async(install_packages, (manifest,)) if apt else None
+        pending = [(a['name'], pool.apply_async(provision_artifact, (a, root))) for a in manifest['artifacts']]
+        results, failures = {}, {}
+        for name, r in pending:
+            try:
+                results[name] = r.get()
+            except RuntimeError as e:
+                failures[name] = str(e)
+        if packages is not None:
+            try:
+                packages.get()
+            except subprocess.CalledProcessError as e:
+                failures['packages'] = str(e)
+    finally:
+        pool.close()
+        pool.join()
+    return results, failures
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--manifest', default=DEFAULT_MANIFEST, help='Provisioning manifest (JSON)')
+    parser.add_argument('--root', default='/home/ubuntu', help='Artifacts go to <root>/<dir>/<name>')
+    parser.add_argument('--threads', type=int, default=8, help='Artifacts fetched at once')
+    parser.add_argument('--apt', action='store_true', default=False,
+                        help='Also install the manifest\'s apt-get and pip packages')
+    parser.add_argument('--record', action='store_true', default=False,
+                        help='Write the md5 of every artifact without one back into the manifest')
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    results, failures = provision(manifest, args.root, args.threads, args.apt)
+
+    for name in sorted(results):
+        status, md5, seconds = results[name]
+        sys.stdout.write('{:<60} {:>7.1f}s  {}\n'.format(name, seconds, status))
+    for name in sorted(failures):
+        sys.stderr.write('FAILED {}: {}\n'.format(name, failures[name]))
+    unpinned = sorted(a['name'] for a in manifest['artifacts'] if not a.get('md5'))
+    if unpinned and not args.record:
+        sys.stderr.write('No md5 in the manifest (checked against the ETag only): {}\n'.format(', '.join(unpinned)))
+
+    if args.record:
+        for artifact in manifest['artifacts']:
+            if not artifact.get('md5') and artifact['name'] in results:
+                artifact['md5'] = results[artifact['name']][1]
+        with open(args.manifest, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True, separators=(',', ': '))
+            f.write('\n')
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
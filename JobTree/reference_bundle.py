@@ -0,0 +1,275 @@
+#!/usr/bin/env python2.7
+# John Vivian
+# 10-19-26
+
+"""
+Versioned reference bundle: everything a node needs besides the BAMs, in one parallel fetch.
+
+A bundle is a directory (local or under an http(s) URL) containing:
+
+    manifest.json           -- {version, chunk_size, members: [{name, size, md5, chunks: [{path, offset, size, md5}]}]}
+    chunks/<name>.<NNNN>    -- consecutive chunk_size slices of each member
+
+Members are named the way SupportGATK names them (reference.fasta, reference.fasta.fai, reference.dict,
+phase.vcf, phase.vcf.idx, gatk.jar, ...).  Building a bundle precomputes the .fai, .dict and the Tribble
+.idx of every VCF, so no node ever has to build them.  Fetching pulls all chunks of all members
+concurrently and writes each one straight to its offset in the final file, so there is no archive to
+unpack afterwards.  Members already present with a verified matching MD5 are skipped.
+
+The pipeline fetches a bundle into <local_dir>/references/<version>/ (node_dir), once per node for every
+run that uses that version, and symlinks its members into each run's shared directory (link).
+
+Build:  python reference_bundle.py build -o bundle/ -r <ref> -p <phase> -m <mills> -d <dbsnp> -c <cosmic>
+                                         -g <gatk.jar> -u <mutect.jar> [--bucket B --prefix P]
+Fetch:  python reference_bundle.py fetch <manifest URL or path> <dest dir>
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+import transfers
+
+CHUNK_SIZE = 256 * 1024 * 1024
+MAX_ATTEMPTS = 3
+
+# Build inputs: member name -> argparse dest
+INPUTS = [('reference.fasta', 'reference'), ('phase.vcf', 'phase'), ('mills.vcf', 'mills'),
+          ('dbsnp.vcf', 'dbsnp'), ('cosmic.vcf', 'cosmic'), ('gatk.jar', 'gatk'), ('mutect.jar', 'mutect')]
+
+# Files GATK rebuilds if they are older than the file they index
+INDEX_SUFFIXES = ('.fai', '.dict', '.idx', '.tbi')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command')
+
+    build = sub.add_parser('build', help='Create a bundle from URLs or local paths')
+    build.add_argument('-o', '--out_dir', required=True, help='Directory the bundle is written to')
+    build.add_argument('-r', '--reference', required=True, help='Reference genome')
+    build.add_argument('-p', '--phase', required=True, help='1000G_phase1.indels.hg19.sites.fixed.vcf')
+    build.add_argument('-m', '--mills', required=True, help='Mills_and_1000G_gold_standard.indels.hg19.sites.vcf')
+    build.add_argument('-d', '--dbsnp', required=True, help='dbsnp_132_b37.leftAligned.vcf')
+    build.add_argument('-c', '--cosmic', required=True, help='b37_cosmic_v54_120711.vcf')
+    build.add_argument('-g', '--gatk', required=True, help='GenomeAnalysisTK.jar')
+    build.add_argument('-u', '--mutect', required=True, help='Mutect.jar')
+    build.add_argument('--chunk_size', type=int, default=CHUNK_SIZE, help='Bytes per chunk')
+    build.add_argument('--bucket', default=None, help='Upload the bundle to this S3 bucket')
+    build.add_argument('--prefix', default='bundles', help='Key prefix in --bucket; the version is appended')
+
+    fetch = sub.add_parser('fetch', help='Fetch a bundle into a directory')
+    fetch.add_argument('manifest', help='URL or path of manifest.json')
+    fetch.add_argument('dest', help='Directory to place members in')
+    fetch.add_argument('--threads', type=int, default=16, help='Concurrent chunk downloads')
+    return parser
+
+
+def _stage(source, dest):
+    """ Copy or download source into dest """
+    if os.path.exists(source):
+        shutil.copy(source, dest)
+    else:
+        transfers.curl_download(source, dest)
+
+
+def _run(cmd, error):
+    try:
+        subprocess.check_call(cmd)
+    except subprocess.CalledProcessError:
+        raise RuntimeError(error)
+    except OSError:
+        raise RuntimeError('Failed to find "{}"'.format(cmd[0]))
+
+
+def build_indexes(work_dir):
+    """ .fai, .dict, and a Tribble .idx for every VCF in work_dir """
+    ref = os.path.join(work_dir, 'reference.fasta')
+    gatk_jar = os.path.join(work_dir, 'gatk.jar')
+    _run(['samtools', 'faidx', ref], 'samtools failed to create reference index')
+    _run(['picard-tools', 'CreateSequenceDictionary', 'R={}'.format(ref),
+          'O={}'.format(os.path.join(work_dir, 'reference.dict'))], 'Picard failed to create reference dictionary')
+    for vcf in sorted(f for f in os.listdir(work_dir) if f.endswith('.vcf')):
+        # GATK writes <vcf>.idx next to any VCF it reads as a ROD; CountRODs is the cheapest walker that does
+        _run(['java', '-Xmx4g', '-jar', gatk_jar, '-T', 'CountRODs', '-R', ref,
+              '--rod', os.path.join(work_dir, vcf)], 'GATK failed to index {}'.format(vcf))
+
+
+def split_member(path, name, out_dir, chunk_size):
+    """ Writes path as chunk files under out_dir/chunks.  Returns the member's manifest entry. """
+    chunk_dir = os.path.join(out_dir, 'chunks')
+    if not os.path.isdir(chunk_dir):
+        os.makedirs(chunk_dir)
+    whole = hashlib.md5()
+    chunks = []
+    with open(path, 'rb') as f:
+        offset = 0
+        for index in range(int(os.path.getsize(path) // chunk_size) + 1):
+            chunk_path = 'chunks/{}.{:04d}'.format(name, index)
+            chunk_md5 = hashlib.md5()
+            size = 0
+            with open(os.path.join(out_dir, chunk_path), 'wb') as out:
+                for block in iter(lambda: f.read(min(transfers.READ_SIZE, chunk_size - size)), b''):
+                    out.write(block)
+                    chunk_md5.update(block)
+                    whole.update(block)
+                    size += len(block)
+                    if size == chunk_size:
+                        break
+            if size == 0 and index > 0:
+                os.remove(os.path.join(out_dir, chunk_path))
+                break
+            chunks.append({'path': chunk_path, 'offset': offset, 'size': size, 'md5': chunk_md5.hexdigest()})
+            offset += size
+    return {'name': name, 'size': offset, 'md5': whole.hexdigest(), 'chunks': chunks}
+
+
+def build(args):
+    work_dir = os.path.join(args.out_dir, 'work')
+    for d in (args.out_dir, work_dir):
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    for name, dest in INPUTS:
+        sys.stdout.write('Staging {}\n'.format(name))
+        _stage(getattr(args, dest), os.path.join(work_dir, name))
+    build_indexes(work_dir)
+
+    members = [split_member(os.path.join(work_dir, f), f, args.out_dir, args.chunk_size)
+               for f in sorted(os.listdir(work_dir))]
+    version = hashlib.md5(''.join(m['name'] + m['md5'] for m in members).encode('ascii')).hexdigest()[:12]
+    manifest = {'version': version, 'created': time.strftime('%Y-%m-%d'), 'chunk_size': args.chunk_size,
+                'members': members}
+    with open(os.path.join(args.out_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    shutil.rmtree(work_dir)
+    sys.stdout.write('Built bundle {} ({} members)\n'.format(version, len(members)))
+
+    if args.bucket:
+        upload(args.out_dir, manifest, args.bucket, '{}/{}'.format(args.prefix.strip('/'), version))
+    return manifest
+
+
+def upload(bundle_dir, manifest, bucket_name, prefix):
+    import boto
+    bucket = boto.connect_s3().get_bucket(bucket_name)
+    paths = ['manifest.json'] + [c['path'] for m in manifest['members'] for c in m['chunks']]
+    for path in paths:
+        bucket.new_key('{}/{}'.format(prefix, path)).set_contents_from_filename(os.path.join(bundle_dir, path))
+    sys.stdout.write('Uploaded to s3://{}/{}/\n'.format(bucket_name, prefix))
+
+
+def load_manifest(location):
+    if os.path.exists(location):
+        with open(location) as f:
+            return json.load(f)
+    return json.loads(subprocess.check_output(['curl', '-fsL', location]).decode('utf-8'))
+
+
+def _fetch_chunk(base, dest_path, chunk):
+    """ Streams one chunk into its offset of dest_path, verifying its MD5; retries on mismatch """
+    source = '{}/{}'.format(base, chunk['path'])
+    for attempt in range(MAX_ATTEMPTS):
+        md5 = hashlib.md5()
+        with open(dest_path, 'r+b') as out:
+            out.seek(chunk['offset'])
+            if os.path.exists(source):
+                stream, proc = open(source, 'rb'), None
+            else:
+                proc = subprocess.Popen(['curl', '-fsL', source], stdout=subprocess.PIPE)
+                stream = proc.stdout
+            for block in iter(lambda: stream.read(transfers.READ_SIZE), b''):
+                out.write(block)
+                md5.update(block)
+            stream.close()
+            failed = proc is not None and proc.wait() != 0
+        if not failed and md5.hexdigest() == chunk['md5']:
+            return chunk['size']
+        time.sleep(transfers.backoff(attempt))
+    raise RuntimeError('Chunk {} failed verification {} times'.format(chunk['path'], MAX_ATTEMPTS))
+
+
+def node_dir(root, manifest):
+    """ Directory below root that the bundle version described by manifest is fetched into """
+    return os.path.join(root, 'references', manifest['version'])
+
+
+def fetch(manifest_location, dest, threads=16, names=None, manifest=None):
+    """
+    Fetches every member (or only `names`) of a bundle into dest.  Returns the manifest, which is only
+    loaded from manifest_location if it is not passed in.
+    """
+    manifest = manifest or load_manifest(manifest_location)
+    base = manifest_location.rsplit('/', 1)[0] if '/' in manifest_location else '.'
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    # Members are written in place, so only one target on the node may fetch the bundle at a time
+    with transfers.download_lock(os.path.join(dest, 'reference_bundle')):
+        _fetch_members(manifest, base, dest, threads, names)
+    return manifest
+
+
+def _fetch_members(manifest, base, dest, threads, names):
+    todo = []
+    for member in manifest['members']:
+        if names is not None and member['name'] not in names:
+            continue
+        path = os.path.join(dest, member['name'])
+        record = transfers.read_sidecar(path)
+        if record and record['md5'] == member['md5']:
+            continue
+        # Preallocate so every chunk can be written at its offset independently
+        with open(path, 'wb') as f:
+            f.truncate(member['size'])
+        todo.append((member, path))
+
+    pool = ThreadPool(threads)
+    try:
+        results = [pool.apply_async(_fetch_chunk, (base, path, chunk)) for member, path in todo
+                   for chunk in member['chunks']]
+        for r in results:
+            r.get()
+    finally:
+        pool.close()
+        pool.join()
+
+    # Every chunk was verified, so each member's MD5 is known without rereading it
+    for member, path in todo:
+        transfers.write_sidecar(path, member['md5'])
+
+    # GATK rebuilds an index that is older than the file it indexes, so every index is touched last
+    for member in manifest['members']:
+        path = os.path.join(dest, member['name'])
+        if member['name'].endswith(INDEX_SUFFIXES) and os.path.exists(path):
+            os.utime(path, None)
+            transfers.write_sidecar(path, member['md5'])
+
+
+def link(manifest, source, dest):
+    """ Points dest/<name> at source/<name> for every member present in source """
+    for member in manifest['members']:
+        target = os.path.join(source, member['name'])
+        path = os.path.join(dest, member['name'])
+        if not os.path.exists(target) or os.path.realpath(path) == os.path.realpath(target):
+            continue
+        if os.path.lexists(path):
+            os.remove(path)
+        os.symlink(target, path)
+
+
+def main():
+    args = build_parser().parse_args()
+    if args.command == 'build':
+        build(args)
+    else:
+        manifest = fetch(args.manifest, args.dest, args.threads)
+        sys.stdout.write('Fetched bundle {} into {}\n'.format(manifest['version'], args.dest))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+# John Vivian
+# 10-19-26
+
+"""
+Striped scratch space for nodes with several local volumes (e.g. multiple NVMe / instance-store disks).
+
+Every file keeps its usual path below local_dir -- S3 keys, sidecars and cleanup are all derived from
+it -- but a large new file can be placed on another volume, with a symlink at the usual path:
+
+    <local_dir>/<script>/<run>/<pair>/tumor.indel.bam -> <volume>/<script>/<run>/<pair>/tumor.indel.bam
+
+place() picks the least-loaded volume: the one with the shortest I/O queue (average requests in
+flight over a short sample of /proc/diskstats), then the most free space, among those the file fits on.
+Steps placed one after another therefore land on whichever disk the other chain is not busy with.
+tmpdir() does the same for a JVM's -Djava.io.tmpdir.  Files placed this way are removed with remove().
+"""
+
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+DISKSTATS = '/proc/diskstats'
+SAMPLE_SECONDS = 0.2
+# Space left free on a volume after a placement, for logs, indexes and other small files
+HEADROOM_BYTES = 1 << 30
+
+
+def _mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def volumes(configured):
+    """
+    The usable volumes among configured (a list of directories): created if need be, writable, and one
+    directory per device, so two directories on the same disk do not count twice.  Order is kept.
+    """
+    found, devices = [], set()
+    for path in configured:
+        try:
+            _mkdir_p(path)
+            dev = os.stat(path).st_dev
+        except OSError as e:
+            sys.stderr.write('Ignoring scratch volume {}: {}\n'.format(path, e))
+            continue
+        if dev in devices or not os.access(path, os.W_OK):
+            continue
+        devices.add(dev)
+        found.append(path)
+    return found
+
+
+def _weighted_io_ms():
+    """ {(major, minor): milliseconds spent by queued I/O, weighted by queue depth} from /proc/diskstats """
+    stats = {}
+    try:
+        with open(DISKSTATS) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 14:
+                    stats[(int(fields[0]), int(fields[1]))] = int(fields[13])
+    except (IOError, ValueError):
+        pass
+    return stats
+
+
+def queue_depths(paths, sample_seconds=SAMPLE_SECONDS):
+    """ Average I/O requests in flight on each path's device over sample_seconds (0 if unknown) """
+    devices = [os.stat(p).st_dev for p in paths]
+    before = _weighted_io_ms()
+    time.sleep(sample_seconds)
+    after = _weighted_io_ms()
+    depths = []
+    for dev in devices:
+        key = (os.major(dev), os.minor(dev))
+        delta = after.get(key, 0) - before.get(key, 0)
+        depths.append(delta / (sample_seconds * 1000.0))
+    return depths
+
+
+def free_bytes(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def choose(volume_list, size=0):
+    """ The least-loaded volume with room for size bytes (the one with the most room if none has) """
+    if len(volume_list) == 1:
+        return volume_list[0]
+    free = [free_bytes(v) for v in volume_list]
+    depths = queue_depths(volume_list)
+    fits = [i for i in range(len(volume_list)) if free[i] - size >= HEADROOM_BYTES]
+    if not fits:
+        return volume_list[free.index(max(free))]
+    return volume_list[min(fits, key=lambda i: (round(depths[i], 1), -free[i]))]
+
+
+def place(path, root, volume_list, size=0):
+    """
+    Makes path (below root) a symlink to the same relative path on the least-loaded volume, unless that
+    volume is root's own or path already exists (a finished file, or a placement being resumed).
+    Returns path, which callers keep using as if nothing had moved.
+    """
+    if len(volume_list) < 2 or os.path.lexists(path):
+        return path
+    volume = choose(volume_list, size)
+    if os.stat(volume).st_dev == os.stat(root).st_dev:
+        return path
+    real = os.path.join(volume, os.path.relpath(path, root))
+    _mkdir_p(os.path.dirname(real))
+    _mkdir_p(os.path.dirname(path))
+    os.symlink(real, path)
+    return path
+
+
+def remove(path):
+    """ os.remove for a path that may have been placed on another volume: removes the data too """
+    if os.path.islink(path):
+        try:
+            os.remove(os.path.realpath(path))
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+    os.remove(path)
+
+
+def tmpdir(volume_list, run_id, size=0):
+    """ A fresh temporary directory on the least-loaded volume; the caller removes it with shutil.rmtree """
+    parent = os.path.join(choose(volume_list, size), 'tmp', run_id)
+    _mkdir_p(parent)
+    return tempfile.mkdtemp(dir=parent)
+
+
+def remove_run(volume_list, root, run_dir):
+    """ Removes what place() and tmpdir() left behind for run_dir (below root) on every volume """
+    run_id = os.path.basename(run_dir.rstrip('/'))
+    for volume in volume_list:
+        shutil.rmtree(os.path.join(volume, 'tmp', run_id), ignore_errors=True)
+        if os.stat(volume).st_dev != os.stat(root).st_dev:
+            shutil.rmtree(os.path.join(volume, os.path.relpath(run_dir, root)), ignore_errors=True)
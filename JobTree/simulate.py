@@ -0,0 +1,310 @@
+#!/usr/bin/env python2.7
+# John Vivian
+# 10-19-26
+
+"""
+Discrete-event simulator for jobtree_gatk_pipeline.py: predicts makespan, critical path, utilization
+and cost of a cohort for a given cluster shape, without launching anything.
+
+The step graph is the tree in the pipeline's docstring, once per tumor/normal pair:
+
+    start_node -> {index -> RTC -> IndelRealigner -> BaseRecalibrator -> PrintReads} x {normal, tumor}
+               -> MuTect -> teardown
+
+(with --fuse_chains each sample's chain is a single task, as in the pipeline).  With --shards N each pair
+is N pipeline runs with --regions, each covering 1/N of the genome: every run has the whole graph above,
+its own shared directory (so its own copy of the reference), and 1/N of each sample's reads to fetch,
+process and upload.  Regions are assumed to hold equal shares of the reads.
+
+Runtime model, per step:   seconds = fixed + per_gb * input_gb * (serial + (1 - serial) / threads)
+
+i.e. Amdahl's law on a per-GB single-thread rate.  The defaults in STEP_MODELS are rough placeholders;
+--history_db calibrates per_gb from the autotune history recorded on a node of the simulated shape.
+Each task also downloads the inputs its node does not already hold and uploads the outputs the
+pipeline's persistence policy would upload, at --bandwidth MB/s per transfer.
+
+Tasks are placed first-fit, in the order they become ready, on the first node with enough free cores
+and memory, which is roughly what jobTree's batch systems do.
+
+Example:  python simulate.py --pairs 20 --normal_gb 12 --tumor_gb 15 --nodes 2,4,8,16 --cores 32 \
+                             --ram_gb 244 --price 2.66 [--shards 4]
+"""
+
+import argparse
+import heapq
+import json
+import math
+import sys
+
+import autotune
+
+# per_gb: single-thread seconds per GB of input; serial: Amdahl serial fraction; fixed: seconds
+STEP_MODELS = {'start_node': {'fixed': 120, 'per_gb': 0, 'serial': 1.0},
+               'samtools_index': {'fixed': 5, 'per_gb': 30, 'serial': 1.0},
+               'RealignerTargetCreator': {'fixed': 60, 'per_gb': 700, 'serial': 0.1},
+               'IndelRealigner': {'fixed': 60, 'per_gb': 450, 'serial': 1.0},
+               'BaseRecalibrator': {'fixed': 60, 'per_gb': 1000, 'serial': 0.1},
+               'PrintReads': {'fixed': 60, 'per_gb': 700, 'serial': 0.15},
+               'MuTect': {'fixed': 120, 'per_gb': 450, 'serial': 1.0},
+               'teardown': {'fixed': 30, 'per_gb': 0, 'serial': 1.0}}
+
+# Size of each output relative to the sample BAM, and whether the pipeline's policy keeps it off S3
+# when the consumer is on the same node (ephemeral)
+OUTPUTS = {'samtools_index': [('bam.bai', 0.0001, True)],
+           'RealignerTargetCreator': [('intervals', 0.0001, True)],
+           'IndelRealigner': [('indel.bam', 1.0, True), ('indel.bai', 0.0001, True)],
+           'BaseRecalibrator': [('recal.table', 0.0001, False)],
+           'PrintReads': [('bqsr.bam', 1.25, False), ('bqsr.bai', 0.0001, False)]}
+CHAIN = ['samtools_index', 'RealignerTargetCreator', 'IndelRealigner', 'BaseRecalibrator', 'PrintReads']
+# Sample files each chain step reads (besides the shared reference files)
+CHAIN_INPUTS = {'samtools_index': ['bam'],
+                'RealignerTargetCreator': ['bam', 'bam.bai'],
+                'IndelRealigner': ['bam', 'bam.bai', 'intervals'],
+                'BaseRecalibrator': ['indel.bam', 'indel.bai'],
+                'PrintReads': ['indel.bam', 'indel.bai', 'recal.table']}
+
+# JVM overhead on top of the heap, GB
+JVM_OVERHEAD_GB = 1.5
+
+
+class Task(object):
+    def __init__(self, name, steps, deps, inputs, outputs, input_gb, threaded, mem_gb):
+        self.name = name
+        self.steps = steps            # [(step, input_gb)] run back to back
+        self.deps = deps
+        self.inputs = inputs          # [(file, gb)]
+        self.outputs = outputs        # [(file, gb, ephemeral)]
+        self.input_gb = input_gb
+        self.threaded = threaded
+        self.mem_gb = mem_gb
+        self.start = self.end = self.ready = None
+        self.node = None
+        self.cores = 1
+        self.transfer_seconds = 0.0
+
+
+def _mem_gb(step):
+    heap = autotune.STEP_DEFAULTS.get(step, {}).get('heap_gb', 1)
+    return heap + JVM_OVERHEAD_GB
+
+
+def pair_tasks(pair, sizes, reference_gb, fuse_chains=False):
+    """
+    The tasks for one tumor/normal pair.  sizes: {'normal': GB, 'tumor': GB}.
+    """
+    p = '{}:'.format(pair)
+    ref = [(p + 'reference', reference_gb)]
+    tasks = [Task(p + 'start_node', [('start_node', 0)], [], ref, [(p + 'fai_dict', 0.001, False)], 0, False, 2)]
+    last = {}
+    for sample in ('normal', 'tumor'):
+        gb = sizes[sample]
+        files = dict((ext, gb * frac) for step in CHAIN for ext, frac, _ in OUTPUTS[step])
+        files['bam'] = gb
+        path = lambda ext: '{}{}.{}'.format(p, sample, ext)
+        if fuse_chains:
+            steps = [(step, gb) for step in CHAIN]
+            name = '{}{}_chain'.format(p, sample)
+            tasks.append(Task(name, steps, [p + 'start_node'], ref + [(path('bam'), gb)],
+                              [(path(ext), files[ext], False) for ext, _, _ in OUTPUTS['PrintReads']], gb, True,
+                              max(_mem_gb(s) for s in CHAIN)))
+            last[sample] = name
+            continue
+        prev = p + 'start_node'
+        for step in CHAIN:
+            name = '{}{}_{}'.format(p, sample, step)
+            inputs = ref + [(path(ext), files[ext]) for ext in CHAIN_INPUTS[step]]
+            outputs = [(path(ext), files[ext], ephemeral) for ext, _, ephemeral in OUTPUTS[step]]
+            tasks.append(Task(name, [(step, gb)], [prev], inputs, outputs, gb,
+                              step in autotune.THREADED_STEPS, _mem_gb(step)))
+            prev = name
+        last[sample] = prev
+    bqsr = [('{}{}.bqsr.bam'.format(p, s), sizes[s] * 1.25) for s in ('normal', 'tumor')]
+    tasks.append(Task(p + 'MuTect', [('MuTect', sum(gb for _, gb in bqsr))], [last['normal'], last['tumor']],
+                      ref + bqsr, [(p + 'vcf', 0.01, False)], sum(gb for _, gb in bqsr), False, _mem_gb('MuTect')))
+    tasks.append(Task(p + 'teardown', [('teardown', 0)], [p + 'MuTect'], [], [], 0, False, 1))
+    return tasks
+
+
+def cohort_tasks(pairs, sizes, reference_gb, fuse_chains=False, shards=1):
+    """
+    The tasks for a cohort of pairs, each split into shards region runs (see the module docstring).
+    Tasks of shard s of pair p are named '<p>/<s>:...' when there is more than one shard.
+    """
+    tasks = []
+    shard_sizes = dict((sample, gb / float(shards)) for sample, gb in sizes.items())
+    for pair in range(pairs):
+        for shard in range(shards):
+            label = '{}/{}'.format(pair, shard) if shards > 1 else pair
+            tasks.extend(pair_tasks(label, shard_sizes, reference_gb, fuse_chains))
+    return tasks
+
+
+def step_seconds(models, step, input_gb, threads):
+    m = models[step]
+    return m['fixed'] + m['per_gb'] * input_gb * (m['serial'] + (1 - m['serial']) / float(threads))
+
+
+def calibrate(models, history_db, cores, ram_gb):
+    """
+    Replaces per_gb with the median rate observed in an autotune history database for nodes of this
+    shape, converted back to single-thread seconds per GB.  Steps without successful runs are unchanged.
+    """
+    models = dict((k, dict(v)) for k, v in models.items())
+    history = autotune.RunHistory(history_db)
+    for step in autotune.STEP_DEFAULTS:
+        runs = [r for r in history.runs(step, cores, ram_gb) if not r['oom'] and r['input_bytes'] and r['runtime']]
+        if not runs or step not in models:
+            continue
+        m = models[step]
+        rates = sorted((r['runtime'] - m['fixed']) / (r['input_bytes'] / 1e9) /
+                       (m['serial'] + (1 - m['serial']) / float(r['threads'])) for r in runs)
+        models[step]['per_gb'] = max(rates[len(rates) // 2], 0)
+    return models
+
+
+class Node(object):
+    def __init__(self, index, cores, ram_gb):
+        self.index = index
+        self.free_cores = cores
+        self.free_mem = ram_gb
+        self.files = set()
+
+
+def simulate(tasks, nodes, cores, ram_gb, bandwidth_mb, models, threads=None):
+    """
+    Runs the schedule.  Returns a result dict (makespan seconds, critical path, utilization, per-task
+    timings).  Raises RuntimeError if a task can never fit on a node.
+    """
+    by_name = dict((t.name, t) for t in tasks)
+    single_node = nodes == 1
+    cluster = [Node(i, cores, ram_gb) for i in range(nodes)]
+    waiting = dict((t.name, set(t.deps)) for t in tasks)
+    dependents = dict((t.name, []) for t in tasks)
+    for t in tasks:
+        for d in t.deps:
+            dependents[d].append(t)
+    ready = [t for t in tasks if not t.deps]
+    for t in ready:
+        t.ready = 0.0
+    running = []
+    now = 0.0
+    seq = 0
+
+    for t in tasks:
+        t.cores = min(threads or cores, cores) if t.threaded else 1
+        if t.mem_gb > ram_gb or t.cores > cores:
+            raise RuntimeError('{} needs {} cores / {:.1f} GB and cannot fit on a {}-core {} GB node'.format(
+                t.name, t.cores, t.mem_gb, cores, ram_gb))
+
+    while ready or running:
+        for t in list(ready):
+            node = next((n for n in cluster if n.free_cores >= t.cores and n.free_mem >= t.mem_gb), None)
+            if node is None:
+                continue
+            ready.remove(t)
+            node.free_cores -= t.cores
+            node.free_mem -= t.mem_gb
+            download_gb = sum(gb for f, gb in t.inputs if f not in node.files)
+            upload_gb = sum(gb for f, gb, ephemeral in t.outputs if not (ephemeral and single_node))
+            node.files.update(f for f, _ in t.inputs)
+            node.files.update(f for f, _, _ in t.outputs)
+            t.transfer_seconds = (download_gb + upload_gb) * 1000.0 / bandwidth_mb
+            compute = sum(step_seconds(models, step, gb, t.cores) for step, gb in t.steps)
+            t.node, t.start, t.end = node.index, now, now + t.transfer_seconds + compute
+            heapq.heappush(running, (t.end, seq, t))
+            seq += 1
+        if not running:
+            break
+        now, _, done = heapq.heappop(running)
+        node = cluster[done.node]
+        node.free_cores += done.cores
+        node.free_mem += done.mem_gb
+        for t in dependents[done.name]:
+            waiting[t.name].discard(done.name)
+            if not waiting[t.name]:
+                t.ready = now
+                ready.append(t)
+
+    makespan = max(t.end for t in tasks)
+    busy = sum(t.cores * (t.end - t.start) for t in tasks)
+    transfer = sum(t.transfer_seconds for t in tasks)
+
+    # Walk back from the last task through whichever dependency finished last
+    path = [max(tasks, key=lambda t: t.end)]
+    while path[-1].deps:
+        path.append(max((by_name[d] for d in path[-1].deps), key=lambda t: t.end))
+    path.reverse()
+
+    return {'makespan': makespan,
+            'utilization': busy / float(nodes * cores * makespan) if makespan else 0.0,
+            'transfer_fraction': transfer / sum(t.end - t.start for t in tasks),
+            'critical_path': [{'task': t.name, 'node': t.node, 'ready': t.ready, 'start': t.start, 'end': t.end,
+                               'queued': t.start - t.ready} for t in path],
+            'tasks': dict((t.name, {'node': t.node, 'start': t.start, 'end': t.end, 'cores': t.cores})
+                          for t in tasks)}
+
+
+def cost(makespan, nodes, price, hourly_billing=False):
+    hours = makespan / 3600.0
+    return nodes * price * (math.ceil(hours) if hourly_billing else hours)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pairs', type=int, default=1, help='Tumor/normal pairs in the cohort')
+    parser.add_argument('--normal_gb', type=float, default=10, help='Size of each normal BAM')
+    parser.add_argument('--tumor_gb', type=float, default=10, help='Size of each tumor BAM')
+    parser.add_argument('--reference_gb', type=float, default=12,
+                        help='Reference, known-sites VCFs and jars; fetched once per pair (or shard) and node, '
+                             'since every pipeline run has its own shared directory')
+    parser.add_argument('--nodes', default='1', help='Node count, or a comma-separated list to compare')
+    parser.add_argument('--cores', type=int, default=32, help='Cores per node')
+    parser.add_argument('--ram_gb', type=float, default=244, help='RAM per node')
+    parser.add_argument('--price', type=float, default=0.0, help='Price per node-hour')
+    parser.add_argument('--hourly_billing', action='store_true', default=False, help='Bill whole node-hours')
+    parser.add_argument('--bandwidth', type=float, default=100, help='MB/s per transfer')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Threads for multithreaded steps. Default: all cores, as the pipeline does')
+    parser.add_argument('--fuse_chains', action='store_true', default=False,
+                        help='Simulate the pipeline\'s --fuse_chains mode')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Region runs each pair is split into (the pipeline\'s --regions), sharing its reads '
+                             'equally')
+    parser.add_argument('--history_db', default=None,
+                        help='autotune history (gatk_run_history.sqlite) to calibrate the step models from')
+    parser.add_argument('--json', default=None, help='Also write full results to this file')
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    models = STEP_MODELS
+    if args.history_db:
+        models = calibrate(models, args.history_db, args.cores, args.ram_gb)
+
+    results = []
+    sys.stdout.write('{:>6} {:>12} {:>12} {:>10} {:>12}\n'.format('nodes', 'makespan(h)', 'utilization',
+                                                                  'transfer', 'cost'))
+    for nodes in [int(n) for n in args.nodes.split(',')]:
+        tasks = cohort_tasks(args.pairs, {'normal': args.normal_gb, 'tumor': args.tumor_gb}, args.reference_gb,
+                             args.fuse_chains, args.shards)
+        result = simulate(tasks, nodes, args.cores, args.ram_gb, args.bandwidth, models, args.threads)
+        result['nodes'] = nodes
+        result['cost'] = cost(result['makespan'], nodes, args.price, args.hourly_billing)
+        results.append(result)
+        sys.stdout.write('{:>6} {:>12.2f} {:>11.0%} {:>9.0%} {:>12.2f}\n'.format(
+            nodes, result['makespan'] / 3600.0, result['utilization'], result['transfer_fraction'], result['cost']))
+
+    best = min(results, key=lambda r: r['makespan'])
+    sys.stdout.write('\nCritical path with {} node(s):\n'.format(best['nodes']))
+    for step in best['critical_path']:
+        sys.stdout.write('  {:<40} {:>8.2f}h -> {:>6.2f}h  (queued {:.2f}h)\n'.format(
+            step['task'], step['start'] / 3600.0, step['end'] / 3600.0, step['queued'] / 3600.0))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+# John Vivian
+# 10-19-26
+
+"""
+Straggler detection and speculative re-execution of the chain steps (RTC, IR, BR, PR).
+
+MuTect waits for the slower of the two chains, so one slow node (noisy neighbour, degraded EBS) delays
+the whole pair.  When speculation is on (multi-node batch systems, --speculate_after > 0), every chain
+step is issued together with a watchdog target (speculate), which jobTree may place on another node.
+
+Each attempt at a step -- the original and at most one duplicate -- heartbeats into a small state
+store (S3, below the pair's prefix), every HEARTBEAT_SECONDS:
+
+    <sample>.<step>.<attempt>.heartbeat  -- JSON {attempt, host, speculative, started, expected,
+                                            progress, updated, state}
+    <sample>.<step>.winner               -- id of the attempt whose outputs count
+    <sample>.<step>.done                 -- written once the winner's outputs are in S3
+
+expected is the step's runtime predicted from this node's run history (or its input size, see
+autotune.RunHistory.expected_runtime); progress is the fraction done from GATK's ProgressMeter lines.
+The watchdog starts a duplicate when the original is a straggler (see is_straggler) or its heartbeats
+have stopped.  Whichever attempt finishes first claims the winner key and publishes; the other one sees
+the claim at its next heartbeat, kills its JVM, and discards what it wrote.  The original target then
+carries on with the chain using the winner's outputs from S3.
+"""
+
+import json
+import os
+import re
+import socket
+import sys
+import threading
+import time
+import uuid
+
+import scratch
+import transfers
+
+DEFAULT_FACTOR = 2.0
+HEARTBEAT_SECONDS = 60
+# A heartbeat older than this means the attempt's node is gone or hung
+STALE_SECONDS = 15 * 60
+WATCH_SECONDS = 60
+# The watchdog gives up if no attempt has been running for this long (e.g. the original failed for good)
+WATCH_IDLE_SECONDS = 6 * 3600
+# Steps expected to be shorter than this are never worth duplicating
+MIN_EXPECTED_SECONDS = 10 * 60
+# Progress below this is too early to extrapolate a finishing time from
+MIN_PROGRESS = 0.05
+CLAIM_SETTLE_SECONDS = 10
+PROGRESS_PATTERN = re.compile(r'ProgressMeter -.*?\s(\d+(?:\.\d+)?)%')
+
+
+class Superseded(Exception):
+    """ Another attempt at the step finished first; this one was stopped and its outputs discarded """
+    pass
+
+
+class S3Store(object):
+    """ Speculation state as small objects below prefix in an S3 bucket """
+
+    def __init__(self, bucket_name, prefix):
+        self.bucket_name = bucket_name
+        self.prefix = prefix.rstrip('/') + '/'
+
+    def _bucket(self):
+        import boto
+        return boto.connect_s3().get_bucket(self.bucket_name)
+
+    def get(self, name):
+        k = self._bucket().get_key(self.prefix + name)
+        return None if k is None else k.get_contents_as_string()
+
+    def put(self, name, text):
+        self._bucket().new_key(self.prefix + name).set_contents_from_string(text)
+
+    def delete(self, name):
+        self._bucket().delete_key(self.prefix + name)
+
+    def list(self, prefix):
+        """ [(name, contents)] for every object whose name starts with prefix """
+        return [(k.name[len(self.prefix):], k.get_contents_as_string())
+                for k in self._bucket().list(prefix=self.prefix + prefix)]
+
+    def claim(self, name, value):
+        """
+        Writes value to name unless it is already set.  True if value is what stays there: S3 has no
+        atomic create, so the claim is left to settle and read back, and only the last writer wins.
+        """
+        current = self.get(name)
+        if current is not None:
+            return current == value
+        self.put(name, value)
+        time.sleep(CLAIM_SETTLE_SECONDS)
+        return self.get(name) == value
+
+
+class DirStore(object):
+    """ The same state as files in a directory, for attempts sharing a filesystem """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, name):
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def put(self, name, text):
+        scratch._mkdir_p(self.path)
+        path = os.path.join(self.path, name)
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.rename(path + '.tmp', path)
+
+    def delete(self, name):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass
+
+    def list(self, prefix):
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return []
+        return [(n, self.get(n)) for n in sorted(names) if n.startswith(prefix) and not n.endswith('.tmp')]
+
+    def claim(self, name, value):
+        scratch._mkdir_p(self.path)
+        try:
+            fd = os.open(os.path.join(self.path, name), os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except OSError:
+            return self.get(name) == value
+        with os.fdopen(fd, 'w') as f:
+            f.write(value)
+        return True
+
+
+def parse_progress(log_path):
+    """ Fraction done reported by the last GATK ProgressMeter line in log_path, or None """
+    try:
+        with open(log_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - 64 * 1024, 0))
+            tail = f.read().decode('utf-8', 'replace')
+    except IOError:
+        return None
+    matches = PROGRESS_PATTERN.findall(tail)
+    return min(float(matches[-1]) / 100, 1.0) if matches else None
+
+
+def is_straggler(beat, factor, now=None):
+    """
+    True if the attempt described by heartbeat beat should get a duplicate: its heartbeats stopped, or
+    it has run (or, going by its progress, will run) more than factor times its expected runtime, with
+    more than an expected runtime still to go -- otherwise a fresh start could not finish first.
+    """
+    now = time.time() if now is None else now
+    if now - beat['updated'] > STALE_SECONDS:
+        return True
+    if not beat.get('expected'):
+        return False
+    expected = max(beat['expected'], MIN_EXPECTED_SECONDS)
+    elapsed = now - beat['started']
+    progress = beat.get('progress')
+    if progress:
+        projected = elapsed / progress
+        slow = elapsed > factor * expected or (progress >= MIN_PROGRESS and projected > factor * expected)
+        return slow and projected - elapsed > expected
+    return elapsed > factor * expected
+
+
+class Attempt(object):
+    """
+    One attempt at a step.  Used as a context manager, it heartbeats from a background thread until the
+    block ends, and sets .lost once another attempt has claimed the step.
+    """
+
+    def __init__(self, store, key, speculative=False):
+        self.store = store
+        self.key = key
+        self.id = '{}-{}'.format(socket.gethostname(), uuid.uuid4().hex[:8])
+        self.name = '{}.{}.heartbeat'.format(key, self.id)
+        self.lost = False
+        self.log_path = None
+        self.beat = {'attempt': self.id, 'host': socket.gethostname(), 'speculative': speculative,
+                     'started': time.time(), 'expected': None, 'progress': None, 'state': 'running'}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def begin(self, expected, log_path):
+        """ Called as the step's tool starts: its expected runtime, and the log its progress is read from """
+        self.beat.update(started=time.time(), expected=expected)
+        self.log_path = log_path
+
+    def should_stop(self):
+        """ Polled while the tool runs (see autotune.run_monitored) """
+        return self.lost
+
+    def heartbeat(self):
+        if self.log_path:
+            self.beat['progress'] = parse_progress(self.log_path)
+        self.beat['updated'] = time.time()
+        self.store.put(self.name, json.dumps(self.beat))
+        winner = self.store.get(self.key + '.winner')
+        self.lost = bool(winner) and winner != self.id
+
+    def _run(self):
+        while not self._stop.wait(HEARTBEAT_SECONDS):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                sys.stderr.write('Heartbeat for {} failed: {}\n'.format(self.key, e))
+
+    def __enter__(self):
+        self.heartbeat()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._stop.set()
+        self._thread.join()
+        self.beat['state'] = 'failed' if exc_type else ('superseded' if self.lost else 'finished')
+        self.beat['updated'] = time.time()
+        try:
+            self.store.put(self.name, json.dumps(self.beat))
+        except Exception as e:
+            sys.stderr.write('Final heartbeat for {} failed: {}\n'.format(self.key, e))
+        return False
+
+
+def _as_list(outputs):
+    return [outputs] if isinstance(outputs, str) else list(outputs)
+
+
+def _discard(outputs):
+    for f in outputs:
+        if os.path.lexists(f):
+            scratch.remove(f)
+        transfers.remove_sidecar(f)
+
+
+def _wait_done(store, key):
+    """
+    Blocks until the winning attempt has published.  Raises RuntimeError if the winner stops
+    heartbeating first, after releasing its claim so a retry of the step runs it afresh.
+    """
+    while store.get(key + '.done') is None:
+        winner = store.get(key + '.winner')
+        beat = store.get('{}.{}.heartbeat'.format(key, winner)) if winner else None
+        if beat is None or time.time() - json.loads(beat)['updated'] > STALE_SECONDS:
+            store.delete(key + '.winner')
+            raise RuntimeError('The attempt that finished {} first vanished before publishing'.format(key))
+        time.sleep(WATCH_SECONDS)
+
+
+def run_step(gatk, sample, step, fn, speculative=False):
+    """
+    Runs fn(gatk, sample) -> output path(s) and publishes the outputs.  Returns the outputs, or [] if
+    another attempt's outputs won (they are in S3 by the time an original attempt returns).
+
+    With speculation on, the run is an Attempt: gatk.attempt is set while fn runs so run_java can report
+    progress and stop the tool when it has lost.
+    """
+    store = gatk.speculation_store()
+    if store is None:
+        outputs = _as_list(fn(gatk, sample))
+        for f in outputs:
+            gatk.publish(f)
+        return outputs
+
+    key = '{}.{}'.format(sample, step)
+    if store.get(key + '.winner') is not None:
+        # A retry of the original after the duplicate won, or a duplicate started too late
+        if not speculative:
+            _wait_done(store, key)
+        return []
+
+    with Attempt(store, key, speculative) as attempt:
+        gatk.attempt = attempt
+        try:
+            outputs = _as_list(fn(gatk, sample))
+        except Superseded:
+            outputs = None
+        finally:
+            del gatk.attempt
+        if outputs is not None and store.claim(key + '.winner', attempt.id):
+            for f in outputs:
+                gatk.publish(f)
+            store.put(key + '.done', attempt.id)
+            if speculative:
+                sys.stderr.write('Speculative {} finished first on {}\n'.format(key, attempt.beat['host']))
+            return outputs
+        attempt.lost = True
+
+    _discard(outputs or [])
+    sys.stderr.write('{} of {} superseded by another attempt\n'.format('Duplicate' if speculative else 'Original', key))
+    if not speculative:
+        _wait_done(store, key)
+    return []
+
+
+def watch(gatk, sample, step, fn, factor=DEFAULT_FACTOR):
+    """
+    Watchdog for one step: returns once the step has a winner, or after running a speculative duplicate
+    of it here if the original straggles.  Never duplicates onto the straggler's own node.
+    """
+    store = gatk.speculation_store()
+    key = '{}.{}'.format(sample, step)
+    idle_since = time.time()
+    while store.get(key + '.winner') is None:
+        now = time.time()
+        beats = [json.loads(text) for name, text in store.list(key + '.') if name.endswith('.heartbeat')]
+        running = [b for b in beats if b['state'] == 'running']
+        if any(b['speculative'] for b in running):
+            # A duplicate is already under way (this watchdog is a retry)
+            return
+        if running:
+            idle_since = now
+            beat = max(running, key=lambda b: b['updated'])
+            if is_straggler(beat, factor, now):
+                if beat['host'] == socket.gethostname():
+                    sys.stderr.write('Not duplicating {}: the watchdog landed on the same node\n'.format(key))
+                    return
+                sys.stderr.write('{} on {} is straggling ({:.0f}s in, expected {}s, progress {}); '
+                                 'running a duplicate\n'.format(key, beat['host'], now - beat['started'],
+                                                                beat.get('expected'), beat.get('progress')))
+                run_step(gatk, sample, step, fn, speculative=True)
+                return
+        elif now - idle_since > WATCH_IDLE_SECONDS:
+            return
+        time.sleep(WATCH_SECONDS)
@@ -0,0 +1,180 @@
+# John Vivian
+# 10-19-26
+
+"""
+Per-node scheduler for the S3/HTTP transfers made by SupportGATK.
+
+Targets (and the background uploader) run in separate processes, so the scheduler's state lives in a
+directory on the node (<local_dir>/transfer_slots/), one lease file per transfer that is waiting or
+in flight:
+
+    <dir>/<random>.lease  -- JSON {priority, state ('waiting' or 'active'), since, pid, name}
+    <dir>/admission.lock  -- flock held while a lease is created or admitted
+
+A lease is flocked by its owner for as long as it exists, so the lease of a process that died is seen
+as unlocked and removed.  Transfers are admitted in (priority, arrival) order, at most max_active at a
+time:
+
+    CRITICAL    a download a step is blocked on
+    NORMAL      a synchronous upload
+    BACKGROUND  queued uploads and cleanup deletes; deferred while any CRITICAL transfer is waiting or
+                in flight (for at most MAX_DEFER_SECONDS)
+
+With a bandwidth budget, every active transfer is throttled to a share of it weighted by priority
+(WEIGHTS), so a blocking download gets most of the link while a checkpoint upload trickles along.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import tempfile
+import time
+
+CRITICAL, NORMAL, BACKGROUND = 0, 1, 2
+WEIGHTS = {CRITICAL: 4, NORMAL: 2, BACKGROUND: 1}
+DEFAULT_MAX_ACTIVE = 4
+MAX_DEFER_SECONDS = 1800
+POLL_SECONDS = 0.5
+# How often a throttled transfer re-reads its share of the budget
+RATE_REFRESH_SECONDS = 1.0
+
+
+class Scheduler(object):
+    """
+    :param state_dir: node-wide directory shared by every process using the scheduler
+    :param max_active: transfers allowed in flight at once
+    :param bandwidth: total bytes/second for all active transfers, or None for no cap
+    """
+
+    def __init__(self, state_dir, max_active=DEFAULT_MAX_ACTIVE, bandwidth=None):
+        self.state_dir = state_dir
+        self.max_active = max_active
+        self.bandwidth = bandwidth
+
+    def slot(self, priority, name):
+        """ Context manager that blocks until the transfer is admitted; yields the Slot """
+        return Slot(self, priority, name)
+
+    def _admission_lock(self):
+        try:
+            os.makedirs(self.state_dir)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        f = open(os.path.join(self.state_dir, 'admission.lock'), 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def leases(self):
+        """ Every live lease as a dict (with 'path'); stale ones are removed.  Call with the admission lock. """
+        leases = []
+        for name in os.listdir(self.state_dir):
+            if not name.endswith('.lease'):
+                continue
+            path = os.path.join(self.state_dir, name)
+            try:
+                with open(path) as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except IOError:
+                        lease = json.load(f)
+                        lease['path'] = path
+                        leases.append(lease)
+                        continue
+                # Nobody holds it: its owner died without cleaning up
+                os.remove(path)
+            except (IOError, OSError, ValueError):
+                continue
+        return leases
+
+    def admissible(self, lease, leases):
+        """ True if lease may start now, given every live lease (its own included) """
+        others = [l for l in leases if l['path'] != lease['path']]
+        if sum(1 for l in others if l['state'] == 'active') >= self.max_active:
+            return False
+        key = (lease['priority'], lease['since'])
+        if any(l['state'] == 'waiting' and (l['priority'], l['since']) < key for l in others):
+            return False
+        if lease['priority'] == BACKGROUND and time.time() - lease['since'] < MAX_DEFER_SECONDS:
+            return not any(l['priority'] == CRITICAL for l in others)
+        return True
+
+    def share(self, priority, leases):
+        """ Bytes/second allowed to an active transfer of priority, or None if there is no budget """
+        if not self.bandwidth:
+            return None
+        total = sum(WEIGHTS[l['priority']] for l in leases if l['state'] == 'active') or WEIGHTS[priority]
+        return self.bandwidth * WEIGHTS[priority] / float(total)
+
+
+class Slot(object):
+    """ A scheduled transfer.  The transfer calls consumed(n) as bytes move, which throttles it. """
+
+    def __init__(self, scheduler, priority, name):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.name = name
+        self.f = None
+
+    def _write(self, state):
+        self.lease['state'] = state
+        self.f.seek(0)
+        self.f.truncate()
+        json.dump(dict((k, v) for k, v in self.lease.items() if k != 'path'), self.f)
+        self.f.flush()
+
+    def __enter__(self):
+        lock = self.scheduler._admission_lock()
+        try:
+            fd, path = tempfile.mkstemp(dir=self.scheduler.state_dir, suffix='.lease')
+            self.f = os.fdopen(fd, 'w')
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+            self.lease = {'priority': self.priority, 'since': time.time(), 'pid': os.getpid(), 'name': self.name,
+                          'path': path}
+            self._write('waiting')
+        finally:
+            lock.close()
+        while True:
+            lock = self.scheduler._admission_lock()
+            try:
+                if self.scheduler.admissible(self.lease, self.scheduler.leases()):
+                    self._write('active')
+                    break
+            finally:
+                lock.close()
+            time.sleep(POLL_SECONDS)
+        self._window_start, self._window_bytes, self._rate = time.time(), 0, self._current_share()
+        return self
+
+    def _current_share(self):
+        if not self.scheduler.bandwidth:
+            return None
+        lock = self.scheduler._admission_lock()
+        try:
+            return self.scheduler.share(self.priority, self.scheduler.leases())
+        finally:
+            lock.close()
+
+    def consumed(self, nbytes):
+        """ Records nbytes moved, sleeping as long as needed to stay within this transfer's share """
+        if self._rate is None:
+            return
+        self._window_bytes += nbytes
+        elapsed = time.time() - self._window_start
+        wait = self._window_bytes / self._rate - elapsed
+        if wait > 0:
+            time.sleep(wait)
+            elapsed += wait
+        # Start a new window with a fresh share once in a while, as transfers come and go
+        if elapsed >= RATE_REFRESH_SECONDS:
+            self._window_start, self._window_bytes, self._rate = time.time(), 0, self._current_share()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        path = self.lease['path']
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        self.f.close()
+        return False
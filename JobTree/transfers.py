@@ -0,0 +1,550 @@
+# John Vivian
+# 10-19-26
+
+"""
+Transfer helpers used by SupportGATK in jobtree_gatk_pipeline.py
+
+Checksums are computed while the bytes stream through (curl stdout on download, the part buffers on
+multipart upload) so a 20 GB BAM is never read an extra time just to be verified.  The digest of every
+file that has been verified is stored next to it in a small hidden sidecar:
+
+    <dir>/.<name>.digest    -- JSON {size, mtime, md5, multipart_etag, part_size}
+
+The sidecar is only trusted while the file's size and mtime still match, so a file that was truncated
+or rewritten after verification is treated as unverified.
+
+Multipart uploads keep their upload ID and the ETags of the parts S3 has acknowledged in
+<dir>/.<name>.upload, so a retried upload only sends the parts that are missing.
+
+Downloads never write to the final path.  They stream into <dir>/.<name>.part, resume from its length
+after an interruption, and are renamed into place only once size and checksum have been verified.
+
+Targets running at the same time on a node often need the same input.  download_lock() makes fetching
+a file single-flight: the first target holds a flock on <dir>/.<name>.lock (holding its pid as an
+in-progress marker) while it downloads; the others block on the lock and then find a verified file.
+"""
+
+import base64
+import calendar
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+
+# Part size used for every multipart upload.  S3 multipart ETags depend on it, so it is also stored in
+# the object metadata (x-amz-meta-part-size) for verifying downloads.
+PART_SIZE = 50000000
+MULTIPART_THRESHOLD = 1000000000
+READ_SIZE = 1024 * 1024
+
+# Downloads: attempts, and the exponential backoff between them (seconds)
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 2
+BACKOFF_CAP = 120
+# curl's exit status when the server answers a resumed request with the whole file
+CURL_CANNOT_RESUME = 33
+
+_ETAG_RE = re.compile(r'^[0-9a-f]{32}(-\d+)?$')
+
+
+class _PartHasher(object):
+    """ MD5 of each consecutive part_size block of a stream """
+
+    def __init__(self, part_size):
+        self.part_size = part_size
+        self.digests = []
+        self._md5 = hashlib.md5()
+        self._fill = 0
+
+    def update(self, view):
+        while len(view):
+            take = min(self.part_size - self._fill, len(view))
+            self._md5.update(view[:take].tobytes())
+            self._fill += take
+            view = view[take:]
+            if self._fill == self.part_size:
+                self.digests.append(self._md5.digest())
+                self._md5 = hashlib.md5()
+                self._fill = 0
+
+    def all_digests(self):
+        """ Digests of all completed parts, plus the trailing partial part if any """
+        return self.digests + [self._md5.digest()] if self._fill else list(self.digests)
+
+
+class StreamingDigest(object):
+    """
+    Incremental MD5 plus S3 ETag.  Feed bytes in order via update(); the multipart ETag is
+    md5(concat(md5(part_i))) + '-N', which is computed here one part at a time.
+
+    Objects uploaded by other tools may use a different part size than ours, so several part sizes
+    can be tracked at once (see candidate_part_sizes); the first one is the default.
+    """
+
+    def __init__(self, part_size=PART_SIZE, extra_part_sizes=()):
+        self.part_size = part_size
+        self.size = 0
+        self._md5 = hashlib.md5()
+        self._parts = [_PartHasher(p) for p in (part_size,) + tuple(p for p in extra_part_sizes if p != part_size)]
+
+    def update(self, data):
+        self._md5.update(data)
+        self.size += len(data)
+        for parts in self._parts:
+            parts.update(memoryview(data))
+
+    def md5(self):
+        return self._md5.hexdigest()
+
+    def part_digests(self, part_size=None):
+        part_size = part_size or self.part_size
+        for parts in self._parts:
+            if parts.part_size == part_size:
+                return parts.all_digests()
+        raise ValueError('Part size {} was not tracked'.format(part_size))
+
+    def part_sizes(self):
+        return [parts.part_size for parts in self._parts]
+
+    def etag(self, multipart=None, part_size=None):
+        """
+        ETag S3 would report for these bytes.  multipart defaults to the pipeline's own rule
+        (files larger than MULTIPART_THRESHOLD are uploaded in parts).
+        """
+        if multipart is None:
+            multipart = self.size > MULTIPART_THRESHOLD
+        if not multipart:
+            return self.md5()
+        digests = self.part_digests(part_size)
+        return '{}-{}'.format(hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+
+def candidate_part_sizes(size, etag):
+    """
+    Part sizes that could have produced a multipart etag for an object of this size: our own
+    PART_SIZE and the MiB multiples used by common clients (aws-cli 8 MiB, s3cmd 15 MiB, ...).
+    """
+    parts = etag_part_count(normalize_etag(etag))
+    if not parts or not size:
+        return []
+    mib = 1024 * 1024
+    common = [PART_SIZE, 5 * mib, 8 * mib, 15 * mib, 16 * mib, 64 * mib, 100 * mib, 128 * mib]
+    return [p for p in common if -(-size // p) == parts]
+
+
+def normalize_etag(etag):
+    """ Strip quotes from an ETag; returns None if it is not an MD5-based ETag (e.g. SSE-KMS) """
+    if not etag:
+        return None
+    etag = etag.strip('"').lower()
+    return etag if _ETAG_RE.match(etag) else None
+
+
+def etag_part_count(etag):
+    """ Number of parts encoded in a multipart ETag, 0 for single-part """
+    return int(etag.split('-')[1]) if etag and '-' in etag else 0
+
+
+def b64_md5(hex_digest):
+    """ Content-MD5 header value for a hex digest (boto wants both forms) """
+    return base64.b64encode(bytearray.fromhex(hex_digest)).decode('ascii')
+
+
+def _beside(file_path, pattern):
+    # Next to the file itself, so state follows a file placed on another volume through a symlink
+    head, tail = os.path.split(os.path.realpath(file_path))
+    return os.path.join(head, pattern.format(tail))
+
+
+def sidecar_path(file_path):
+    return _beside(file_path, '.{}.digest')
+
+
+def write_sidecar(file_path, md5, multipart_etag=None):
+    """ Record the verified digest of file_path """
+    st = os.stat(file_path)
+    with open(sidecar_path(file_path), 'w') as f:
+        json.dump({'size': st.st_size, 'mtime': st.st_mtime, 'md5': md5,
+                   'multipart_etag': multipart_etag, 'part_size': PART_SIZE}, f)
+
+
+def record_digest(file_path, digest):
+    """ write_sidecar for a StreamingDigest that saw every byte of file_path """
+    write_sidecar(file_path, digest.md5(), digest.etag(True))
+
+
+def read_sidecar(file_path):
+    """ Returns the recorded digest dict if it is still valid for file_path, otherwise None """
+    try:
+        with open(sidecar_path(file_path)) as f:
+            record = json.load(f)
+        st = os.stat(file_path)
+    except (IOError, OSError, ValueError):
+        return None
+    if record.get('size') != st.st_size or record.get('mtime') != st.st_mtime:
+        return None
+    return record
+
+
+def remove_sidecar(file_path):
+    try:
+        os.remove(sidecar_path(file_path))
+    except OSError:
+        pass
+
+
+def upload_state_path(file_path):
+    return _beside(file_path, '.{}.upload')
+
+
+def load_upload_state(file_path):
+    """ The saved state of an unfinished multipart upload of file_path, or None """
+    try:
+        with open(upload_state_path(file_path)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_upload_state(file_path, state):
+    """ Written after every part, via a rename so a crash never leaves a half-written state file """
+    path = upload_state_path(file_path)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(path + '.tmp', path)
+
+
+def remove_upload_state(file_path):
+    try:
+        os.remove(upload_state_path(file_path))
+    except OSError:
+        pass
+
+
+def upload_state_is_current(state, file_path, key_name):
+    """ True if state is for key_name and file_path has not changed since the upload started """
+    st = os.stat(file_path)
+    return (state.get('key') == key_name and state.get('size') == st.st_size and
+            state.get('mtime') == st.st_mtime and state.get('part_size') == PART_SIZE)
+
+
+def sweep_multipart_uploads(bucket, prefix='', max_age_hours=0):
+    """
+    Aborts incomplete multipart uploads under prefix that were started more than max_age_hours ago,
+    so parts orphaned by a target that never came back stop being billed.  Returns how many were aborted.
+    """
+    cutoff = time.time() - max_age_hours * 3600
+    swept = 0
+    for mp in bucket.list_multipart_uploads():
+        if not mp.key_name.startswith(prefix):
+            continue
+        started = calendar.timegm(time.strptime(mp.initiated[:19], '%Y-%m-%dT%H:%M:%S'))
+        if started <= cutoff:
+            mp.cancel_upload()
+            swept += 1
+    return swept
+
+
+def digest_file(file_path, part_size=PART_SIZE, extra_part_sizes=()):
+    """ Full read of file_path.  Only used when a skip decision cannot be made any other way. """
+    digest = StreamingDigest(part_size, extra_part_sizes)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(chunk)
+    return digest
+
+
+def local_matches_remote(file_path, remote_size, remote_etag, allow_hash=True, trust_size=True, remote_md5=None):
+    """
+    True if the local file has the same content as a remote object with the given size/ETag.
+    Size is compared first (free).  The ETag comparison uses the sidecar if it is valid; otherwise,
+    if allow_hash, the file is hashed once and the sidecar written so the next check is free.
+    remote_md5, the object's MD5 if recorded in its metadata, is used in place of an ETag.  When the remote
+    side has no usable checksum, a matching size is taken as a match only if trust_size.
+    """
+    if not os.path.exists(file_path) or remote_size is None or os.path.getsize(file_path) != remote_size:
+        return False
+    remote_etag = normalize_etag(remote_md5) or normalize_etag(remote_etag)
+    if remote_etag is None:
+        # No usable checksum on the remote side: size is all there is to go on
+        return trust_size
+    multipart = etag_part_count(remote_etag) > 0
+    record = read_sidecar(file_path)
+    if record:
+        if not multipart:
+            return record['md5'] == remote_etag
+        if record.get('multipart_etag') == remote_etag:
+            return True
+    if not allow_hash:
+        return False
+    digest = digest_file(file_path, extra_part_sizes=candidate_part_sizes(remote_size, remote_etag))
+    record_digest(file_path, digest)
+    return verify(digest, remote_size, remote_etag)
+
+
+def parse_http_headers(raw):
+    """ Headers of the last response in curl -sIL output, lower-cased keys """
+    headers = {}
+    for line in raw.splitlines():
+        line = line.strip()
+        if line.upper().startswith('HTTP/'):
+            headers = {'status': line.split()[1] if len(line.split()) > 1 else ''}
+        elif ':' in line:
+            k, v = line.split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+    return headers
+
+
+def head_headers(url):
+    """
+    HEAD request via curl (following redirects).  Returns the lower-cased headers of the final response,
+    or None if the request failed.
+    """
+    try:
+        raw = subprocess.check_output(['curl', '-fsIL', url])
+    except subprocess.CalledProcessError:
+        return None
+    except OSError:
+        raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+    return parse_http_headers(raw.decode('latin-1') if isinstance(raw, bytes) else raw)
+
+
+def head_url(url):
+    """
+    HEAD request via curl.  Returns (size, etag) with None for anything the server did not report.
+    """
+    headers = head_headers(url) or {}
+    size = headers.get('content-length')
+    return (int(size) if size and size.isdigit() else None), headers.get('etag')
+
+
+def range_get(url, start, length):
+    """
+    First `length` bytes of url from offset start, via an HTTP range request.  Reading stops after
+    length bytes even if the server ignores the Range header and sends the whole file.
+    """
+    try:
+        proc = subprocess.Popen(['curl', '-fsL', '-r', '{}-{}'.format(start, start + length - 1), url],
+                                stdout=subprocess.PIPE)
+    except OSError:
+        raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+    chunks = []
+    remaining = length
+    while remaining > 0:
+        chunk = proc.stdout.read(min(READ_SIZE, remaining))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+    data = b''.join(chunks)
+    if not data:
+        raise RuntimeError('Range request returned no data: {}'.format(url))
+    return data
+
+
+class TransferError(RuntimeError):
+    """ A transfer failed in a way that is worth retrying (network error, non-zero curl exit) """
+    pass
+
+
+class DiscardPartial(TransferError):
+    """ The partial download on disk cannot be resumed from and has to be restarted """
+    pass
+
+
+def lock_path(file_path):
+    # Beside the path itself, not a symlink's target: the first downloader may place the file elsewhere
+    head, tail = os.path.split(file_path)
+    return os.path.join(head, '.{}.lock'.format(tail))
+
+
+@contextlib.contextmanager
+def download_lock(file_path):
+    """
+    Node-wide exclusive lock for fetching file_path.  Callers check for a verified copy again once they
+    hold it, since whoever held it before may have just downloaded the file.
+    """
+    with open(lock_path(file_path), 'a+') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            f.seek(0)
+            sys.stderr.write('Waiting for {} (being fetched by pid {})\n'.format(os.path.basename(file_path),
+                                                                                 f.read().strip() or '?'))
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            f.truncate()
+            f.write(str(os.getpid()))
+            f.flush()
+            yield
+        finally:
+            f.truncate(0)
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def partial_path(file_path):
+    return _beside(file_path, '.{}.part')
+
+
+def backoff(attempt):
+    """ Seconds to wait before retry number attempt (0-based): exponential, with full jitter """
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def resumable_download(fetch, file_path, remote_size, remote_etag, extra_part_sizes=(), attempts=MAX_ATTEMPTS,
+                       stats=None):
+    """
+    Downloads into a hidden partial file next to file_path (or next to the file a symlink at file_path
+    points to), which is renamed into place only once its bytes match remote_size/remote_etag.
+    fetch(start, fp) writes the remote bytes from offset start onwards to fp and raises TransferError
+    (or IOError) on failure.  Each retry waits backoff() and then resumes from whatever reached disk,
+    including a partial file left by an earlier target.
+    Returns the StreamingDigest of the complete file.  Raises RuntimeError once attempts are used up.
+    :param stats: optional metrics.Transfer; its bytes and retries are updated as the download goes, and
+                  its throttle (if it has one) is called with every chunk written
+    """
+    name = os.path.basename(file_path)
+    part = partial_path(file_path)
+    throttle = getattr(stats, 'throttle', None)
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(backoff(attempt - 1))
+            if stats is not None:
+                stats.retries += 1
+        start = os.path.getsize(part) if os.path.exists(part) else 0
+        if remote_size is not None and start > remote_size:
+            start = 0
+        # The digest has to cover the bytes already on disk as well as the new ones
+        digest = StreamingDigest(PART_SIZE, extra_part_sizes)
+        if start:
+            with open(part, 'rb') as f:
+                for chunk in iter(lambda: f.read(READ_SIZE), b''):
+                    digest.update(chunk)
+        try:
+            if remote_size is None or start < remote_size:
+                with open(part, 'ab' if start else 'wb') as f:
+                    fetch(start, HashingWriter(f, digest, throttle))
+        except DiscardPartial as e:
+            sys.stderr.write('Cannot resume {} ({}), restarting\n'.format(name, e))
+            os.remove(part)
+            continue
+        except (TransferError, IOError) as e:
+            sys.stderr.write('Download of {} interrupted at {} bytes ({}), retrying\n'.format(name, digest.size, e))
+            continue
+        finally:
+            if stats is not None:
+                stats.bytes += digest.size - start
+        if verify(digest, remote_size, remote_etag):
+            # Through a symlink to where the partial is, rather than replacing the link
+            os.rename(part, os.path.realpath(file_path))
+            record_digest(file_path, digest)
+            return digest
+        sys.stderr.write('Checksum mismatch for {}, restarting download\n'.format(name))
+        os.remove(part)
+    raise RuntimeError('Download of {} failed after {} attempts'.format(name, attempts))
+
+
+def _curl_fetch(url, etag):
+    # If-Range makes the server send the whole object instead of a range if it has changed since the
+    # partial file was started; curl then refuses to resume, and the partial is discarded
+    if_range = ['-H', 'If-Range: {}'.format(etag)] if etag and not etag.startswith('W/') else []
+
+    def fetch(start, fp):
+        cmd = ['curl', '-fsL'] + (['-C', str(start)] + if_range if start else []) + [url]
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        except OSError:
+            raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+        for chunk in iter(lambda: proc.stdout.read(READ_SIZE), b''):
+            fp.write(chunk)
+        if proc.wait() == CURL_CANNOT_RESUME:
+            raise DiscardPartial('server did not honour the range request')
+        if proc.returncode != 0:
+            raise TransferError('curl exited with {}'.format(proc.returncode))
+    return fetch
+
+
+def curl_download(url, file_path, extra_part_sizes=(), remote_size=None, remote_etag=None, attempts=MAX_ATTEMPTS,
+                  stats=None):
+    """
+    Resumable, verified download of url into file_path (see resumable_download).  remote_size and
+    remote_etag come from a HEAD request the caller has already made; without them only curl's exit
+    status is checked.  Returns the StreamingDigest.
+    """
+    return resumable_download(_curl_fetch(url, remote_etag), file_path, remote_size, remote_etag,
+                              extra_part_sizes, attempts, stats)
+
+
+def _s3_fetch(key):
+    etag = key.etag
+
+    def fetch(start, fp):
+        # If-Match fails the request (412) if the object was replaced since the partial was started
+        headers = {'If-Match': etag}
+        if start:
+            headers['Range'] = 'bytes={}-'.format(start)
+        try:
+            key.get_contents_to_file(fp, headers=headers)
+        except IOError:
+            raise
+        except Exception as e:
+            if getattr(e, 'status', None) in (412, 416):
+                raise DiscardPartial(str(e))
+            raise TransferError(str(e))
+    return fetch
+
+
+def s3_download(key, file_path, extra_part_sizes=(), attempts=MAX_ATTEMPTS, stats=None):
+    """ Resumable, verified download of a boto Key into file_path.  Returns the StreamingDigest. """
+    return resumable_download(_s3_fetch(key), file_path, key.size, key.etag, extra_part_sizes, attempts, stats)
+
+
+class HashingWriter(object):
+    """
+    File-like wrapper for boto's get_contents_to_file: hashes everything written through it, and passes
+    the size of each write to throttle(nbytes) if given
+    """
+
+    def __init__(self, fp, digest, throttle=None):
+        self.fp = fp
+        self.digest = digest
+        self.throttle = throttle
+
+    def write(self, data):
+        self.fp.write(data)
+        self.digest.update(data)
+        if self.throttle is not None:
+            self.throttle(len(data))
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+def verify(digest, remote_size, remote_etag):
+    """ True if the bytes that passed through digest match what the remote reported """
+    if remote_size is not None and digest.size != remote_size:
+        return False
+    remote_etag = normalize_etag(remote_etag)
+    if remote_etag is None:
+        return True
+    parts = etag_part_count(remote_etag)
+    if not parts:
+        return digest.md5() == remote_etag
+    tried = [p for p in digest.part_sizes() if len(digest.part_digests(p)) == parts]
+    if not tried:
+        # Uploaded with a part size we did not track -- the length check is all we have
+        return True
+    return any(digest.etag(True, p) == remote_etag for p in tried)
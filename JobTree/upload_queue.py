@@ -0,0 +1,192 @@
+#!/usr/bin/env python2.7
+# John Vivian
+# 10-19-26
+
+"""
+Background S3 uploads for SupportGATK, so a target can spawn the next step as soon as its output is on
+local disk instead of after a multi-GB upload.
+
+jobTree runs every target in its own short-lived process, so a thread would die with the target.
+Instead each run has a spool directory on the node (<local_dir>/upload_spool/<run>/) and one detached
+uploader process draining it:
+
+    <spool>/<id>.job      -- JSON {file_path, step, gatk}: pending (id = hash of file_path)
+    <spool>/<id>.failed   -- JSON {file_path, error}: the uploader gave up on it
+    <spool>/uploader.lock -- flock held by the live uploader
+
+enqueue() writes a job and makes sure an uploader is running; wait() is the durability barrier, which
+blocks until the given files (or all of them) have left the spool.  The uploader exits after
+IDLE_SECONDS without work and is restarted by the next enqueue() or wait().
+
+Run directly only by ensure_uploader():  python upload_queue.py <spool>
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+import metrics
+import transfer_scheduler
+
+IDLE_SECONDS = 60
+POLL_SECONDS = 1
+LOCK_FILE = 'uploader.lock'
+
+
+def _job_id(file_path):
+    return hashlib.md5(os.path.abspath(file_path).encode('utf-8')).hexdigest()
+
+
+def _write_json(path, obj):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.rename(path + '.tmp', path)
+
+
+def _mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def enqueue(spool, gatk, file_path):
+    """
+    Queues file_path for upload with gatk.upload_to_s3.  gatk's attributes are stored in the job (they
+    are plain data), so the uploader can rebuild it without unpickling anything.
+    """
+    _mkdir_p(spool)
+    job_id = _job_id(file_path)
+    failed = os.path.join(spool, job_id + '.failed')
+    if os.path.exists(failed):
+        os.remove(failed)
+    _write_json(os.path.join(spool, job_id + '.job'), {'file_path': file_path, 'step': metrics.current_step(),
+                                                       'gatk': vars(gatk)})
+    ensure_uploader(spool)
+
+
+def _try_lock(spool):
+    """ Returns an open, exclusively locked lock file, or None if another uploader holds it """
+    f = open(os.path.join(spool, LOCK_FILE), 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        f.close()
+        return None
+    return f
+
+
+def ensure_uploader(spool):
+    """ Starts a detached uploader for spool unless one is already running """
+    lock = _try_lock(spool)
+    if lock is None:
+        return
+    lock.close()
+    script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    with open(os.devnull, 'r+') as devnull, open(os.path.join(spool, 'uploader.log'), 'a') as log:
+        # A new session, so the uploader outlives the target that started it
+        subprocess.Popen([sys.executable, script, spool], stdin=devnull, stdout=devnull, stderr=log,
+                         close_fds=True, preexec_fn=os.setsid)
+
+
+def _pending(spool):
+    try:
+        names = os.listdir(spool)
+    except OSError:
+        return []
+    jobs = []
+    for name in names:
+        if name.endswith('.job'):
+            try:
+                jobs.append((os.path.getmtime(os.path.join(spool, name)), os.path.join(spool, name)))
+            except OSError:
+                # Finished between listdir and stat
+                pass
+    return [j for _, j in sorted(jobs)]
+
+
+def _upload(job_path):
+    """ Runs one job; the job file is removed either way, with a .failed record if the upload failed """
+    from jobtree_gatk_pipeline import SupportGATK
+
+    with open(job_path) as f:
+        job = json.load(f)
+    mtime = os.path.getmtime(job_path)
+    gatk = SupportGATK.__new__(SupportGATK)
+    gatk.__dict__.update(job['gatk'])
+    metrics.set_step(job.get('step') or 'unknown')
+    try:
+        gatk.upload_to_s3(job['file_path'], transfer_scheduler.BACKGROUND)
+        error = None
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+        sys.stderr.write('Upload of {} failed: {}\n'.format(job['file_path'], error))
+    # The file may have been re-queued while it was uploading; that newer job stays
+    if os.path.exists(job_path) and os.path.getmtime(job_path) == mtime:
+        if error:
+            _write_json(job_path[:-len('.job')] + '.failed', {'file_path': job['file_path'], 'error': error})
+        os.remove(job_path)
+
+
+def run(spool):
+    """ Uploader main loop; returns once the spool has been empty for IDLE_SECONDS """
+    while True:
+        lock = _try_lock(spool)
+        if lock is None:
+            return
+        idle_since = time.time()
+        try:
+            while time.time() - idle_since < IDLE_SECONDS:
+                jobs = _pending(spool)
+                if not jobs:
+                    time.sleep(POLL_SECONDS)
+                    continue
+                _upload(jobs[0])
+                idle_since = time.time()
+        finally:
+            lock.close()
+        # A job queued between the last look and releasing the lock would otherwise be stranded
+        if not _pending(spool):
+            return
+
+
+def wait(spool, file_paths=None, timeout=None):
+    """
+    Durability barrier: blocks until the given files (default: every queued file) are no longer pending.
+    Returns {file_path: error} for the ones the uploader gave up on.
+    """
+    ids = None if file_paths is None else set(_job_id(f) for f in file_paths)
+    start = time.time()
+    while True:
+        pending = [j for j in _pending(spool) if ids is None or os.path.basename(j)[:-len('.job')] in ids]
+        if not pending:
+            break
+        if timeout is not None and time.time() - start > timeout:
+            raise RuntimeError('Timed out waiting for {} upload(s) in {}'.format(len(pending), spool))
+        ensure_uploader(spool)
+        time.sleep(POLL_SECONDS)
+
+    failures = {}
+    for name in (os.listdir(spool) if os.path.isdir(spool) else []):
+        if name.endswith('.failed') and (ids is None or name[:-len('.failed')] in ids):
+            with open(os.path.join(spool, name)) as f:
+                record = json.load(f)
+            failures[record['file_path']] = record['error']
+    return failures
+
+
+def clear_failure(spool, file_path):
+    try:
+        os.remove(os.path.join(spool, _job_id(file_path) + '.failed'))
+    except OSError:
+        pass
+
+
+if __name__ == '__main__':
+    run(sys.argv[1])
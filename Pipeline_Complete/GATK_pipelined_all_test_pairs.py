@@ -0,0 +1,319 @@
+#!/usr/bin/env python2.7
+# John Vivian
+# 10-19-26
+
+"""
+Pipelined replacement for GATK_pipeline_all_test_pairs
+
+The bash driver runs every pair strictly in sequence:  download -> index -> RTC -> IR -> BR -> PR -> MuTect.
+Here the work is split into three stages that each run on their own thread, so that the NIC and the CPUs
+are busy at the same time:
+
+    fetch   -- download + samtools index the BAMs for pair N+1 (and N+2, ... up to --lookahead)
+    compute -- GATK + MuTect for pair N
+    upload  -- push the VCF for pair N-1 to S3 and clear its working directory
+
+Prefetching is bounded twice: never more than --lookahead pairs may be fetched (or fetching) ahead of the
+pair being computed -- fetch takes a lookahead slot before it starts on a pair and compute hands it back
+when it picks the pair up -- and a pair is only fetched when the disk holding DATA has room for it on top
+of the space reserved for the pair currently being computed (intermediates are estimated at --footprint
+times the input BAM size).
+
+Every pair works in its own directory (DATA/pair<N>/) so that overlapping stages never collide on the
+fixed intermediate names (normal.indel.bam, tumor.recal_data.table, ...).
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import urllib2
+from Queue import Queue, Empty, Full
+
+BAM_URL = 'https://s3-us-west-2.amazonaws.com/bd2k-test-data/{}'
+SENTINEL = None
+# How often a stage blocked on a queue checks whether another stage has failed
+POLL_SECONDS = 1
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pairs', nargs='+', type=int, default=[0, 2, 3, 4, 5, 6, 7, 8, 9],
+                        help='Test pair numbers to run, in order')
+    parser.add_argument('--data', default='/home/ubuntu/data', help='Directory holding reference data')
+    parser.add_argument('--tools', default='/home/ubuntu/tools', help='Directory holding the jars')
+    parser.add_argument('--out', default='/home/ubuntu/VCFs', help='Directory VCFs are written to')
+    parser.add_argument('--cores', type=int, default=4, help='Threads given to each GATK invocation')
+    parser.add_argument('--mem', type=int, default=14000, help='MuTect heap in MB (GATK gets half)')
+    parser.add_argument('--lookahead', type=int, default=1,
+                        help='Max number of pairs fetched (or being fetched) ahead of the one being computed')
+    parser.add_argument('--footprint', type=float, default=3.0,
+                        help='Peak disk usage of a pair being computed, as a multiple of its input BAMs')
+    parser.add_argument('--bucket', default=None, help='If set, upload VCFs to this S3 bucket')
+    return parser
+
+
+def free_bytes(path):
+    """ Free space available to a non-root user on the volume holding path """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def remote_size(url):
+    """ Content-Length of url via a HEAD request, 0 if it cannot be determined """
+    request = urllib2.Request(url)
+    request.get_method = lambda: 'HEAD'
+    try:
+        return int(urllib2.urlopen(request).info().getheader('Content-Length', 0))
+    except (urllib2.URLError, ValueError):
+        return 0
+
+
+def run_parallel(commands):
+    """ Equivalent of "cmd1 & cmd2 & wait" that raises if either command fails """
+    procs = [subprocess.Popen(cmd) for cmd in commands]
+    codes = [p.wait() for p in procs]
+    if any(codes):
+        raise RuntimeError('Command failed ({}): {}'.format(codes, commands))
+
+
+class Pair(object):
+    """ State for a single normal/tumor test pair as it moves through the stages """
+
+    def __init__(self, num, data):
+        self.num = num
+        self.normal = 'testexome.pair{}.normal.bam'.format(num)
+        self.tumor = 'testexome.pair{}.tumor.bam'.format(num)
+        self.work_dir = os.path.join(data, 'pair{}'.format(num))
+        self.input_size = 0
+        self.vcf = None
+
+    def path(self, name):
+        return os.path.join(self.work_dir, name)
+
+
+class DiskBudget(object):
+    """
+    Tracks space promised to pairs that are fetched or computing, so the fetch stage only starts
+    a download when the volume can hold it alongside everything already in flight.
+    """
+
+    def __init__(self, path, footprint):
+        self.path = path
+        self.footprint = footprint
+        self.reserved = {}
+        self.cond = threading.Condition()
+
+    def _pending(self):
+        # Bytes still to be written by pairs already admitted
+        return sum(self.reserved.values()) - sum(self._on_disk(p) for p in self.reserved)
+
+    def _on_disk(self, num):
+        work_dir = os.path.join(self.path, 'pair{}'.format(num))
+        total = 0
+        for root, dirs, files in os.walk(work_dir):
+            total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        return total
+
+    def admit(self, pair, stop=None):
+        """
+        Block until there is room to fetch and compute pair, then reserve it.  Returns False, reserving
+        nothing, if stop (a threading.Event) is set first.
+        """
+        want = int(pair.input_size * self.footprint)
+        with self.cond:
+            # Always admit when nothing is in flight, otherwise a single oversized pair would deadlock
+            while self.reserved and free_bytes(self.path) - max(self._pending(), 0) < want:
+                if stop is not None and stop.is_set():
+                    return False
+                self.cond.wait(POLL_SECONDS if stop is not None else 30)
+            self.reserved[pair.num] = want
+            return True
+
+    def release(self, pair):
+        with self.cond:
+            self.reserved.pop(pair.num, None)
+            self.cond.notify_all()
+
+
+class PipelinedDriver(object):
+    """
+    Runs fetch, compute, and upload on separate threads connected by queues.  fetch takes one of
+    lookahead slots before it admits and downloads a pair, and compute returns the slot as it takes the
+    pair off the fetched queue, which is what keeps fetch from running arbitrarily far ahead of compute.
+
+    A failing stage sets stop, which every stage checks between pairs and while waiting on a queue, so
+    no stage is left blocked on a queue nobody will ever read or write again.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.budget = DiskBudget(args.data, args.footprint)
+        self.fetched = Queue()
+        self.slots = Queue()
+        for _ in range(max(args.lookahead, 1)):
+            self.slots.put(True)
+        self.computed = Queue()
+        self.errors = []
+        self.stop = threading.Event()
+        # The pair each stage is working on, whose reservation is released if the stage fails
+        self.current = {}
+
+    def _put(self, queue, item):
+        """ queue.put that gives up once stop is set.  Returns False if it gave up. """
+        while not self.stop.is_set():
+            try:
+                queue.put(item, timeout=POLL_SECONDS)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _get(self, queue):
+        """ queue.get that returns SENTINEL once stop is set """
+        while not self.stop.is_set():
+            try:
+                return queue.get(timeout=POLL_SECONDS)
+            except Empty:
+                pass
+        return SENTINEL
+
+    # Stage 1
+    def fetch(self, pairs):
+        for pair in pairs:
+            if self._get(self.slots) is SENTINEL:
+                return
+            pair.input_size = remote_size(BAM_URL.format(pair.normal)) + remote_size(BAM_URL.format(pair.tumor))
+            if not self.budget.admit(pair, self.stop):
+                return
+            self.current['fetch'] = pair
+            if not os.path.isdir(pair.work_dir):
+                os.makedirs(pair.work_dir)
+            sys.stdout.write('\n[fetch] pair{}: downloading {} bytes\n'.format(pair.num, pair.input_size))
+            run_parallel([['wget', '-q', '-O', pair.path(pair.normal), BAM_URL.format(pair.normal)],
+                          ['wget', '-q', '-O', pair.path(pair.tumor), BAM_URL.format(pair.tumor)]])
+            run_parallel([['samtools', 'index', pair.path(pair.normal)],
+                          ['samtools', 'index', pair.path(pair.tumor)]])
+            if not self._put(self.fetched, pair):
+                return
+            self.current.pop('fetch')
+        self._put(self.fetched, SENTINEL)
+
+    # Stage 2
+    def compute(self):
+        pair = self._get(self.fetched)
+        while pair is not SENTINEL:
+            self.slots.put(True)
+            self.current['compute'] = pair
+            sys.stdout.write('\n[compute] pair{}: starting GATK\n'.format(pair.num))
+            self.gatk(pair)
+            if not self._put(self.computed, pair):
+                return
+            self.current.pop('compute')
+            pair = self._get(self.fetched)
+        self._put(self.computed, SENTINEL)
+
+    # Stage 3
+    def upload(self):
+        bucket = None
+        if self.args.bucket:
+            import boto
+            bucket = boto.connect_s3().get_bucket(self.args.bucket)
+        pair = self._get(self.computed)
+        while pair is not SENTINEL:
+            self.current['upload'] = pair
+            if bucket is not None:
+                sys.stdout.write('\n[upload] pair{}: {}\n'.format(pair.num, pair.vcf))
+                key = bucket.new_key(os.path.basename(pair.vcf))
+                key.set_contents_from_filename(pair.vcf)
+            shutil.rmtree(pair.work_dir, ignore_errors=True)
+            self.budget.release(pair)
+            self.current.pop('upload')
+            pair = self._get(self.computed)
+
+    def gatk(self, pair):
+        a = self.args
+        gatk_jar = os.path.join(a.tools, 'GenomeAnalysisTK.jar')
+        mutect_jar = os.path.join(a.tools, 'mutect-1.1.7.jar')
+        ref = os.path.join(a.data, 'Homo_sapiens_assembly19.fasta')
+        phase = os.path.join(a.data, '1000G_phase1.indels.hg19.sites.fixed.vcf')
+        mills = os.path.join(a.data, 'Mills_and_1000G_gold_standard.indels.hg19.sites.fixed.vcf')
+        dbsnp = os.path.join(a.data, 'dbsnp_132_b37.leftAligned.vcf')
+        cosmic = os.path.join(a.data, 'b37_cosmic_v54_120711.vcf')
+        hmem = '-Xmx{}m'.format(a.mem // 2)
+        samples = [('normal', pair.normal), ('tumor', pair.tumor)]
+
+        # RTC
+        run_parallel([['java', hmem, '-jar', gatk_jar, '-T', 'RealignerTargetCreator', '-nt', str(a.cores),
+                       '-R', ref, '-I', pair.path(bam), '-known', phase, '-known', mills,
+                       '--downsampling_type', 'NONE', '-o', pair.path(s + '.intervals')] for s, bam in samples])
+        # IR
+        run_parallel([['java', hmem, '-jar', gatk_jar, '-T', 'IndelRealigner', '-R', ref, '-I', pair.path(bam),
+                       '-targetIntervals', pair.path(s + '.intervals'), '--downsampling_type', 'NONE',
+                       '-known', phase, '-known', mills, '-maxReads', '720000', '-maxInMemory', '5400000',
+                       '-o', pair.path(s + '.indel.bam')] for s, bam in samples])
+        for s, bam in samples:
+            os.remove(pair.path(bam))
+            os.remove(pair.path(bam + '.bai'))
+        # BR
+        run_parallel([['java', hmem, '-jar', gatk_jar, '-T', 'BaseRecalibrator', '-nct', str(a.cores),
+                       '-R', ref, '-I', pair.path(s + '.indel.bam'), '-knownSites', dbsnp,
+                       '-o', pair.path(s + '.recal_data.table')] for s, bam in samples])
+        # PR
+        run_parallel([['java', '-Xmx6500m', '-jar', gatk_jar, '-T', 'PrintReads', '-nct', str(a.cores),
+                       '-R', ref, '--emit_original_quals', '-I', pair.path(s + '.indel.bam'),
+                       '-BQSR', pair.path(s + '.recal_data.table'), '-o', pair.path(s + '.bqsr.bam')]
+                      for s, bam in samples])
+        for s, bam in samples:
+            os.remove(pair.path(s + '.indel.bam'))
+            os.remove(pair.path(s + '.indel.bai'))
+        # MuTect
+        pair.vcf = os.path.join(a.out, 'Pair{}.lod10.dbsnp.cosmic.vcf'.format(pair.num))
+        subprocess.check_call(['java', '-Xmx{}m'.format(a.mem), '-jar', mutect_jar, '--analysis_type', 'MuTect',
+                               '--reference_sequence', ref, '--cosmic', cosmic, '--tumor_lod', '10',
+                               '--dbsnp', dbsnp, '--input_file:normal', pair.path('normal.bqsr.bam'),
+                               '--input_file:tumor', pair.path('tumor.bqsr.bam'),
+                               '--out', pair.path('MuTect.out'), '--coverage_file', pair.path('MuTect.coverage'),
+                               '--vcf', pair.vcf])
+
+    def _guard(self, fn, *args):
+        """ Record a stage failure, release the failed pair's disk, and stop the other stages """
+        try:
+            fn(*args)
+        except Exception as e:
+            self.errors.append(e)
+            sys.stderr.write('\n{} stage failed: {}\n'.format(fn.__name__, e))
+            self.stop.set()
+            pair = self.current.pop(fn.__name__, None)
+            if pair is not None:
+                self.budget.release(pair)
+
+    def run(self, pairs):
+        if not os.path.isdir(self.args.out):
+            os.makedirs(self.args.out)
+        threads = [threading.Thread(target=self._guard, args=(self.fetch, pairs)),
+                   threading.Thread(target=self._guard, args=(self.compute,)),
+                   threading.Thread(target=self._guard, args=(self.upload,))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        # Upload exits once the sentinel reaches it or a stage fails.  The others notice stop within a poll,
+        # unless fetch is inside a download, which is left to the daemon thread.
+        threads[2].join()
+        for t in threads[:2]:
+            t.join(2 * POLL_SECONDS)
+        if self.errors:
+            raise RuntimeError('Pipeline failed: {}'.format(self.errors[0]))
+
+
+def main():
+    args = build_parser().parse_args()
+    pairs = [Pair(num, args.data) for num in args.pairs]
+    PipelinedDriver(args).run(pairs)
+    sys.stdout.write('\nAll pairs complete.\n')
+
+
+if __name__ == '__main__':
+    main()